@@ -6,10 +6,53 @@ import os
 import platform
 import subprocess
 import json
+import bisect
 from datetime import datetime, timezone
 import pathlib
 from io import StringIO
 import csv
+import shutil
+import tempfile
+import atexit
+import asyncio
+import functools
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager, closing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .manifest import (
+    scan_manifest,
+)
+
+from .archivetree import (
+    ArchiveTree,
+    archive_id,
+    cache_archive,
+    is_archive,
+    link_tree,
+    strip_archive_ext,
+)
+
+from .projectjournal import (
+    JOURNAL_ID,
+    ProjectJournal,
+    insert_pairs,
+    index_mapper,
+    inverse_order,
+    journal_path,
+    move_range,
+    remove_indices,
+    reorder,
+    replay,
+)
+
+from .undostore import (
+    DEFAULT_UNDO_BYTES,
+    UndoStore,
+    undo_path,
+)
 
 from .find_pycodetool import pycodetool
 
@@ -77,7 +120,7 @@ def split_root(path):
 
 
 def extract(src_file, new_parent_dir, auto_sub=True,
-            auto_sub_name=None):
+            auto_sub_name=None, cache_dir=None):
     """
     Extract any known archive file type to a specified directory.
 
@@ -93,15 +136,87 @@ def extract(src_file, new_parent_dir, auto_sub=True,
         a subdirectory that is the name of the original directory).
     auto_sub_name -- If auto_sub is true, rename the extracted or
         created directory to the value of this string.
+    cache_dir -- Keep each extracted archive here in a directory named
+        by the archive's content hash, so an archive that is in many
+        versions is only extracted once (and hard-linked after that).
+        If None, a temporary cache is used.
+
+    Returns:
+    the directory containing the files.
     """
-    raise NotImplementedError("There is nothing implemented here yet.")
+    return extract_many([(src_file, new_parent_dir, auto_sub,
+                          auto_sub_name)], jobs=1, cache_dir=cache_dir)[0]
+
+
+def extract_many(requests, jobs=None, cache_dir=None):
+    '''
+    Extract several archives, extracting different archives at the same
+    time in separate processes (See extract).
+
+    Sequential arguments:
+    requests -- a list of (src_file, new_parent_dir, auto_sub,
+        auto_sub_name) tuples (See the arguments of extract).
+
+    Keyword arguments:
+    jobs -- The maximum number of processes (None for one per CPU).
+    cache_dir -- See extract.
+
+    Returns:
+    a list of the directories containing the files, in the same order
+    as requests.
+    '''
+    temp_cache = None
+    if cache_dir is None:
+        temp_cache = tempfile.mkdtemp(prefix="anewcommit-extract-")
+        cache_dir = temp_cache
+    elif not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    try:
+        keys = [archive_id(request[0]) for request in requests]
+        roots = [ArchiveTree(request[0]).single_root() if request[2]
+                 else None for request in requests]
+        # ^ Decide where each goes from its member list (before
+        #   extracting anything).
+        todo = {}
+        for request, key in zip(requests, keys):
+            if not os.path.isdir(os.path.join(cache_dir, key)):
+                todo[key] = (request[0], cache_dir, key)
+        if (len(todo) > 1) and (jobs != 1):
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                list(executor.map(cache_archive, todo.values()))
+        else:
+            for job in todo.values():
+                cache_archive(job)
+        results = []
+        for request, key, root in zip(requests, keys, roots):
+            src_file, new_parent_dir, auto_sub, auto_sub_name = request
+            src_dir = os.path.join(cache_dir, key)
+            dst_dir = new_parent_dir
+            if auto_sub:
+                sub = strip_archive_ext(os.path.basename(src_file))
+                if root is not None:
+                    src_dir = os.path.join(src_dir, root)
+                    sub = root
+                if auto_sub_name:
+                    sub = auto_sub_name
+                dst_dir = os.path.join(new_parent_dir, sub)
+                if os.path.exists(dst_dir):
+                    raise ValueError('"{}" already exists.'.format(dst_dir))
+            echo1('* extracting "{}" to "{}"'.format(src_file, dst_dir))
+            link_tree(src_dir, dst_dir)
+            results.append(dst_dir)
+        return results
+    finally:
+        if temp_cache is not None:
+            shutil.rmtree(temp_cache)
 
 
 default_ignores = ["Thumbs.db", ".DS_Store", "error_log", "temp"]
 
 
 def newest_file_dt_in(parent, too_new_dt=None, level=0,
-                      ignores=default_ignores):
+                      ignores=default_ignores, archives=False,
+                      index_dir=None):
     '''
     Get the datetime of the latest file in parent recursively.
 
@@ -109,6 +224,12 @@ def newest_file_dt_in(parent, too_new_dt=None, level=0,
     too_new_dt -- skip files with a datetime >= too_new_dt if not None.
     level -- Determine the directory depth for debugging use only (doesn't
         affect results).
+    archives -- Look inside of archives (See ArchiveTree) as if they
+        were directories, instead of using the date of the archive file.
+        The path of a file in an archive is the archive's path joined
+        with the member's path.
+    index_dir -- Keep a member index of each tar archive here (See
+        ArchiveTree) so the next scan doesn't decompress anything.
 
     Returns:
     a tuple (path, datetime)
@@ -128,7 +249,16 @@ def newest_file_dt_in(parent, too_new_dt=None, level=0,
             continue
         mdt = None
         m_path = None
-        if os.path.isfile(subPath):
+        if archives and is_archive(subPath):
+            too_new = None
+            if too_new_dt is not None:
+                too_new = too_new_dt.timestamp()
+            tree = ArchiveTree(subPath, index_dir=index_dir)
+            rel, mtime = tree.newest(too_new=too_new)
+            if rel is not None:
+                m_path = os.path.join(subPath, rel)
+                mdt = datetime.fromtimestamp(mtime, tz=timezone.utc)
+        elif os.path.isfile(subPath):
             # mtime = os.path.getmtime(subPath)
             mtime = pathlib.Path(subPath).stat().st_mtime
             # ^ pathlib stat best cross-platform way according to
@@ -141,6 +271,8 @@ def newest_file_dt_in(parent, too_new_dt=None, level=0,
                 too_new_dt=too_new_dt,
                 level=level+1,
                 ignores=ignores,
+                archives=archives,
+                index_dir=index_dir,
             )
         if mdt is None:
             # It must be an empty directory, or file dates are >= too_new_dt
@@ -152,10 +284,64 @@ def newest_file_dt_in(parent, too_new_dt=None, level=0,
     if newest_dt is None:
         if level == 0:
             echo0("- no date < {} could be found in {}"
-                  "".format(too_new_dt, subPath))
+                  "".format(too_new_dt, parent))
     return path, newest_dt
 
 
+def newest_in_sources(sources, too_new_dt=None, archives=False,
+                      index_dir=None):
+    '''
+    Get the newest file in several directories (See newest_file_dt_in,
+    which also explains the keyword arguments).
+
+    Returns:
+    a tuple (path, datetime), or (None, None) if there is no file older
+    than too_new_dt.
+    '''
+    newest_path = None
+    newest_dt = None
+    for source in sources:
+        this_path, this_dt = newest_file_dt_in(
+            source,
+            too_new_dt=too_new_dt,
+            archives=archives,
+            index_dir=index_dir,
+        )
+        if this_dt is None:
+            continue
+        if (newest_dt is None) or (this_dt > newest_dt):
+            newest_dt = this_dt
+            newest_path = this_path
+    return newest_path, newest_dt
+
+
+async def run_process(cmd_parts, stop_timeout=5.0):
+    '''
+    Run a program without blocking the event loop, discarding its
+    standard output. If the task is cancelled, the program is terminated
+    (then killed if it doesn't stop within stop_timeout seconds) before
+    the cancellation continues, so no child process is left running.
+
+    Returns:
+    the exit code.
+    '''
+    process = await asyncio.create_subprocess_exec(
+        *cmd_parts,
+        stdout=asyncio.subprocess.DEVNULL,
+    )
+    try:
+        return await process.wait()
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), stop_timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        raise
+
+
 def open_file(path):
     # based on <https://stackoverflow.com/a/16204023/4541104>:
     if platform.system() == "Windows":
@@ -186,7 +372,38 @@ def split_statement(statement):
     return parts
 
 
+_parsed_statements = OrderedDict()  # the least recently used first
+_parsed_statements_lock = threading.Lock()
+PARSED_STATEMENTS_MAX = 10000
+
+
 def parse_statement(statement):
+    '''
+    Parse a statement such as 'use "Primary Site" as www' into a
+    dictionary with the keys 'command' and (depending on the command)
+    'source' and 'destination'.
+
+    Each distinct statement is only parsed once (until it is one of the
+    least recently used after PARSED_STATEMENTS_MAX others), and each
+    caller gets its own copy of the result.
+
+    Raises:
+    ValueError if the statement isn't valid.
+    '''
+    with _parsed_statements_lock:
+        result = _parsed_statements.get(statement)
+        if result is not None:
+            _parsed_statements.move_to_end(statement)
+            return dict(result)
+    result = _parse_statement(statement)
+    with _parsed_statements_lock:
+        _parsed_statements[sys.intern(statement)] = result
+        while len(_parsed_statements) > PARSED_STATEMENTS_MAX:
+            _parsed_statements.popitem(last=False)
+    return dict(result)
+
+
+def _parse_statement(statement):
     result = {}
     parts = split_statement(statement)
     if len(parts) > 0:
@@ -244,24 +461,49 @@ MODES = [
     'overlay',
 ]
 
-last_luid_i = -1
-used_luids = set()
 
+class LuidAllocator:
+    '''
+    Generate luids (locally-unique IDs, See _new_process) for one
+    project. Each ANCProject has its own, so separate projects can be
+    loaded and changed at the same time (such as in separate threads)
+    without renumbering each other's actions, and the luids a project
+    generates don't depend on what else the process has loaded.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_i = -1
+        self._used = set()
 
-def use_luid(luid):
-    global last_luid_i
-    used_luids.add(luid)
-    luid_i = int(luid)  # saved as string, so convert to int
-    if luid_i > last_luid_i:
-        last_luid_i = luid_i
+    def __contains__(self, luid):
+        with self._lock:
+            return luid in self._used
 
+    def use(self, luid):
+        '''
+        Mark a luid as used so generate never returns it.
 
-def gen_luid():
-    global last_luid_i
-    last_luid_i += 1
-    new_luid = str(last_luid_i)
-    used_luids.add(new_luid)
-    return new_luid
+        Returns:
+        False if it was already used, otherwise True.
+        '''
+        with self._lock:
+            if luid in self._used:
+                return False
+            self._used.add(luid)
+            try:
+                luid_i = int(luid)  # saved as string, so convert to int
+            except ValueError:
+                return True  # It can't collide with a generated one.
+            if luid_i > self._last_i:
+                self._last_i = luid_i
+            return True
+
+    def generate(self):
+        with self._lock:
+            self._last_i += 1
+            new_luid = str(self._last_i)
+            self._used.add(new_luid)
+            return new_luid
 
 
 def find_param(haystack, needle, min_param=0, max_param=-1, fs=",",
@@ -288,7 +530,8 @@ def find_param(haystack, needle, min_param=0, max_param=-1, fs=",",
 def _new_process(luid=None):
     '''
     Keyword arguments:
-    luid -- If None, generate a LUID (a locally-unique ID). The value
+    luid -- If None, the project generates a LUID (a locally-unique ID)
+        when the action is added to it (See LuidAllocator). The value
         must be a node ID that is unique within the scope of the
         project file, for any use such as by gui component dictionaries.
         There is one luid for each action, so there may be multiple
@@ -296,8 +539,6 @@ def _new_process(luid=None):
         every widget in your widget system, you can use `luid + "." +
         key` for the key where key is the key in the action dictionary.
     '''
-    if luid is None:
-        luid = gen_luid()
     return {
         'luid': luid,
         'verb': 'no_op',
@@ -320,6 +561,18 @@ TRANSITION_VERBS = [
 
 # The special verb is get_version, and is added via add_version.
 
+HEAVY_FIELDS = [
+    'manifest',
+]
+# ^ Fields of an action that are saved in a side file (in the
+#   "anewcommit-data" directory next to anewcommit.json) and only loaded
+#   when used (See ANCProject.get_field).
+SIDE_KEY = 'side_data'
+# ^ The path of the side file of an action, relative to the project file.
+
+DATE_FMT = "%Y-%m-%d"
+# ^ The format of the 'date' of a version (See ANCProject.mark_dates).
+
 VERBS_HELP = {
     'pre_process': 'Make changes to the next version before a commit.',
     'post_process': 'Make changes to the previous version.',
@@ -330,7 +583,8 @@ VERBS_HELP = {
 def new_version(path, mode='delete_then_add', luid=None, name=None):
     '''
     Keyword arguments:
-    luid -- If None, generate a LUID. See _new_process for more info.
+    luid -- If None, the project generates one. See _new_process for
+        more info.
     name -- Set the visible name (Used as commit summary if this source is
         committed). If None, the name will be generated as the leaf of the
         path.
@@ -355,13 +609,12 @@ def new_pre_process(luid=None):
     A pre-process verb affects the next version in the list of _actions.
 
     Keyword arguments:
-    luid -- If None, generate a LUID. See _new_process for more info.
+    luid -- If None, the project generates one. See _new_process for
+        more info.
     '''
-    action = _new_process()
+    action = _new_process(luid=luid)
     action['verb'] = 'pre_process'
     action['commit'] = True
-    if luid is None:
-        luid = gen_luid()
     return action
 
 
@@ -372,9 +625,10 @@ def new_post_process(luid=None):
     commit may make committing the next version more clean.
 
     Keyword arguments:
-    luid -- If None, generate a LUID. See _new_process for more info.
+    luid -- If None, the project generates one. See _new_process for
+        more info.
     '''
-    action = _new_process()
+    action = _new_process(luid=luid)
     action['verb'] = 'post_process'
     action['commit'] = True
     return action
@@ -423,6 +677,78 @@ def join_action_path(action, key, path=None):
     return dst
 
 
+def normalize_destination(destination):
+    '''
+    Convert the destination of a "use" statement to the form used by
+    version_pairs: relative to the root of the commit, without a
+    leading or trailing slash, and "" for the root.
+    '''
+    dst = os.path.normpath(destination.strip("/"))
+    if dst == ".":
+        dst = ""
+    return dst
+
+
+def destination_root(destination):
+    '''
+    Get the first directory of a destination from normalize_destination
+    (or "" for the root).
+    '''
+    return split_subs(destination)[0]
+
+
+def version_pairs(action, whole=True):
+    '''
+    Get the (source, destination) pairs that make up a version, where
+    source is an absolute path and destination is relative to the root
+    of the commit ("" for the root), based on "use" statements.
+
+    Sequential arguments:
+    action -- This must be a version action such as created using the
+        new_version function.
+
+    Keyword arguments:
+    whole -- If there are no "use" statements with a destination, use the
+        entire version as the root (otherwise return an empty list).
+    '''
+    statements = action.get('statements')
+    if statements is None:
+        statements = []
+    commands = [(statement, parse_statement(statement))
+                for statement in statements]
+    return _use_pairs(action, commands, whole=whole)
+
+
+def _use_pairs(action, commands, whole=True):
+    '''
+    Get version_pairs from (statement, command) pairs where each command
+    is from parse_statement.
+    '''
+    pairs = []
+    for statement, command in commands:
+        if command['command'] != "use":
+            continue
+        dst = command.get('destination')
+        if dst is None:
+            continue
+        dst = normalize_destination(dst)
+        src = action['path']
+        source = command.get('source')
+        if source is not None:
+            src = os.path.join(src, source)
+        if (".." in split_subs(dst)) or (".." in split_subs(src)):
+            raise ValueError(
+                'paths must not contain ".." (luid={}, statement={})'
+                ''.format(action['luid'], statement)
+            )
+        pairs.append((src, dst))
+    if whole and (len(pairs) == 0):
+        pairs.append((action['path'], ""))
+    # Put the root first so that syncing it doesn't undo the others:
+    pairs.sort(key=lambda pair: pair[1] != "")
+    return pairs
+
+
 def substep_to_str(ss):
     name = None
     if (len(ss) > 2) and (len(ss) < 3) and isinstance(ss[1], int):
@@ -435,6 +761,16 @@ def substep_to_str(ss):
     return name
 
 
+def _flush_at_exit(project_ref):
+    project = project_ref()
+    if project is None:
+        return
+    try:
+        project.flush()
+    except RuntimeError as ex:
+        echo0("Error: unsaved changes were lost: {}".format(ex))
+
+
 class ANCProject:
     '''
     Manage a list of version directories.
@@ -444,8 +780,31 @@ class ANCProject:
         be stored here.
     path -- This is the explicit path to a project file, usually
         "anewcommit.json" in project_dir.
+    auto_save -- Save after each change (The write is coalesced by
+        request_save, so see save_scheduler and batch).
+    save_scheduler -- If None, request_save writes the file immediately
+        unless a batch is in progress. Otherwise, set it to a function
+        that accepts (seconds, callback) and calls callback later on the
+        thread that changes the project (such as a wrapper for tkinter's
+        after method), so all changes within save_delay seconds are
+        written once.
+    journaled -- Save changes made by ANCProject methods by appending
+        them to a journal (See projectjournal) instead of rewriting the
+        project file. The journal is compacted into the project file
+        after journal_max changes or when save is called. A journal is
+        replayed by load either way.
+    persist_undo -- Keep the undo steps in a file next to the project
+        file (See undostore) so undo survives a restart.
+    undo_max_bytes -- Forget the oldest undo steps when all of the
+        steps are larger than this (as JSON).
+    async_jobs -- The maximum number of child processes and filesystem
+        walks that the async methods (such as build_cache and scan_all)
+        run at once, for all calls together (None for one per CPU).
     _actions -- This is a list of _actions to take, such as pre-processing
-        or post-processing a version.
+        or post-processing a version. Change it using methods such as
+        insert, remove and swap so the luid index stays current (If the
+        list is replaced or resized some other way, the index is rebuilt
+        on the next lookup).
     '''
     default_settings = {}
 
@@ -453,22 +812,59 @@ class ANCProject:
         self.path = None
         self.project_dir = None
         self._actions = []
+        self.luids = LuidAllocator()
+        self._reset_indices()
         self.remove_redo = False  # Remove redo after undo.
+        self.persist_undo = False
+        self._undo_steps = UndoStore(max_bytes=DEFAULT_UNDO_BYTES)
         self.clear_undo()
         self.data = {
             'actions': self._actions,
         }
         self.auto_save = True
+        self.save_delay = 1.0
+        self.save_scheduler = None
+        self._dirty = False
+        self._save_scheduled = False
+        self._batch_depth = 0
+        self.journaled = False
+        self.journal_max = 1000
+        self._journal = None
+        self._journal_lines = []  # changes not yet in the journal
+        self._needs_snapshot = False  # True if a change has no entry
+        self._side_saved = {}  # luid -> {key: value as in the side file}
+        self._listeners = []  # [callback, with_entries] (See add_listener)
+        self._captured = None  # entries recorded by _changed during undo
+        self._commands = {}  # luid -> (statements tuple, get_commands list)
+        self.statement_errors = []  # See validate_statements
+        self.async_jobs = None
+        self._async_semaphore = None  # (loop, semaphore) See _async_limit
+        atexit.register(_flush_at_exit, weakref.ref(self))
+
+    @property
+    def undo_max_bytes(self):
+        return self._undo_steps.max_bytes
+
+    @undo_max_bytes.setter
+    def undo_max_bytes(self, max_bytes):
+        self._undo_steps.max_bytes = max_bytes
+        self._undo_step_i = max(-1,
+                                self._undo_step_i - self._undo_steps.evict())
 
     def clear_undo(self):
-        self._undo_steps = []
+        self._undo_steps.clear()
         self._undo_step_i = -1
+        self._typing = None
+        # ^ (step index, luid, key) of the last step that later typing
+        #   in the same field can be merged into (See _add_undo_step).
 
     def clear(self):
         self.clear_undo()
         del self._actions[:]
+        self._reset_indices()
+        self._commands = {}
         # self.data['actions'] = self._actions
-        # TODO: if self.auto_save: self.save()
+        self._changed(["clear"], save=False)
 
     def has_undo(self):
         if len(self._undo_steps) < 1:
@@ -478,14 +874,30 @@ class ANCProject:
     def has_redo(self):
         return self._undo_step_i+1 < len(self._undo_steps)
 
-    def _add_undo_step(self, step):
+    def _add_undo_step(self, step, coalesce=False):
         '''
         Add a dictionary that describes how to undo what was just done.
+
+        Keyword arguments:
+        coalesce -- Merge a step that sets one field into the previous
+            step if that step also had coalesce and set the same field
+            (such as for each character typed into the field).
         '''
         step_i = self._undo_step_i
         if self.remove_redo:
             if len(self._undo_steps) > (self._undo_step_i+1):
-                self._undo_steps = self._undo_steps[:self._undo_step_i+1]
+                self._undo_steps.drop(self._undo_step_i+1,
+                                      len(self._undo_steps))
+        typing = None
+        if coalesce and (len(step) == 1) and (step[0][0] == "set"):
+            typing = (step[0][1], step[0][2])
+            if ((self._typing == (self._undo_step_i,) + typing)
+                    and (self._undo_step_i == (len(self._undo_steps)-1))):
+                # Keep the value from before the first of several changes
+                # to the same field.
+                return True, None
+        self._typing = None
+        step = [self._undo_substep(ss) for ss in step]
         if self._undo_step_i == (len(self._undo_steps)-1):
             self._undo_steps.append(step)
             self._undo_step_i += 1
@@ -498,6 +910,10 @@ class ANCProject:
                                      self._undo_steps[self._undo_step_i],
                                      len(self._undo_steps)))
         echo1("* _add_undo_step({}) at {}".format(step, step_i))
+        self._undo_step_i = max(-1,
+                                self._undo_step_i - self._undo_steps.evict())
+        if typing is not None:
+            self._typing = (self._undo_step_i,) + typing
         msg = None
         if not self.has_undo():
             msg = ("There is no undo after adding an undo step at {}"
@@ -505,20 +921,64 @@ class ANCProject:
             echo0("  * "+msg)
         return True, msg
 
+    def _undo_substep(self, substep):
+        '''
+        Get a copy of an undo substep that doesn't contain any
+        HEAVY_FIELDS already in a side file (The side file is loaded if
+        the undo step inserts the action again).
+        '''
+        if substep[0] == "insert":
+            return [substep[0], substep[1], self._slim_action(substep[2])]
+        if substep[0] == "insert_many":
+            return [substep[0], [[index, self._slim_action(action)]
+                                 for index, action in substep[1]]]
+        return substep
+
+    def _slim_action(self, action):
+        saved = self._side_saved.get(action.get('luid'), {})
+        heavy = [key for key in HEAVY_FIELDS if key in action]
+        if ((len(heavy) == 0) or (action.get(SIDE_KEY) is None)
+                or any(saved.get(key) is not action[key] for key in heavy)):
+            return action
+        return {k: v for k, v in action.items() if k not in HEAVY_FIELDS}
+
     def undo(self, redo=False):
         '''
+        Undo (or redo) one step. Typing after this is a new step.
+
         A substep
         is a command in the form of a list, and a step is a list of
         lists (commands).
 
         Returns:
-        a list of luids that were affected.
+        a tuple (results, error) where results is None on failure or a
+        dict of lists of indices that were affected ('added', 'removed',
+        'swapped', 'changed') or luids ('swapped_luids'), and
+        results['entries'] is the list of changes in the form of
+        journal entries (See projectjournal) in the order they were
+        made.
         '''
+        self._typing = None
+        self._captured = []
+        try:
+            with self.batch():
+                # ^ Save after the position changes so a persisted undo
+                #   file matches the project.
+                results, err = self._undo(redo=redo)
+        finally:
+            entries = self._captured
+            self._captured = None
+        if results is not None:
+            results['entries'] = entries
+        return results, err
+
+    def _undo(self, redo=False):
         results = {}
         results['added'] = []
         results['removed'] = []
         results['swapped'] = []
         results['swapped_luids'] = []
+        results['changed'] = []
         do_s = "redo" if redo else "undo"
         step_i = self._undo_step_i
         if redo:
@@ -543,16 +1003,42 @@ class ANCProject:
                 results['swapped'].append(ss[1])
                 results['swapped'].append(ss[2])
             elif ss[0] == "swap_where_luid":
-                redo_ss = self.swap(ss[1], ss[2], add_undo_step=False)
+                redo_ss = self.swap_where_luid(ss[1], ss[2],
+                                               add_undo_step=False)
                 results['swapped_luids'].append(ss[1])
                 results['swapped_luids'].append(ss[2])
+            elif ss[0] == "insert_many":
+                redo_ss = self._insert_pairs(ss[1], add_undo_step=False,
+                                             notify=False)
+                results['added'] += [pair[0] for pair in ss[1]]
+            elif ss[0] == "remove_many":
+                redo_ss = self.remove_many(ss[1], add_undo_step=False,
+                                           notify=False)
+                results['removed'] += list(ss[1])
+            elif ss[0] == "move_range":
+                redo_ss = self.move_range(ss[1], ss[2], ss[3],
+                                          add_undo_step=False, notify=False)
+                results['changed'].append(min(ss[1], ss[3]))
+            elif ss[0] == "reorder":
+                redo_ss = self.reorder(ss[1], add_undo_step=False,
+                                       notify=False)
+                moved = [new_index for new_index, index in enumerate(ss[1])
+                         if new_index != index]
+                if len(moved) > 0:
+                    results['changed'].append(moved[0])
+            elif ss[0] == "set":
+                redo_ss = ["set", ss[1], ss[2],
+                           self.set_field(ss[1], ss[2], ss[3],
+                                          add_undo_step=False)]
+                results['changed'].append(self._find_where('luid', ss[1]))
             else:
                 return results, ("Error: {} {} isn't implemented."
                                  "".format(do_s, ss))
             if redo_ss is not None:
                 redo_step.append(redo_ss)
         if redo:
-            self._undo_steps[self._undo_step_i] = redo_step
+            self._undo_steps[step_i] = redo_step
+            # ^ Now it is the step that undoes the redo.
             self._undo_step_i += 1
         else:
             self._undo_steps[self._undo_step_i] = redo_step
@@ -564,12 +1050,18 @@ class ANCProject:
         return results, None
 
     def append_action(self, action, do_save=True):
+        self._claim_luids([action])
+        self._check_indexed_list()
         self._actions.append(action)
+        self._indexed_len += 1
+        self._index_path(action)
+        self._indices_changed(["insert", len(self._actions)-1],
+                              inserted=[len(self._actions)-1])
         self._add_undo_step([
             ['remove', len(self._actions)-1],
         ])
-        if do_save:
-            self.save()
+        self._changed(["insert", len(self._actions)-1, action],
+                      save=do_save)
 
     def add_transition(self, verb, do_save=True):
         '''
@@ -645,7 +1137,8 @@ class ANCProject:
             self._actions[i]['statements'] = []
         if statement not in self._actions[i]['statements']:
             self._actions[i]['statements'].append(statement)
-            self.save()
+            self._changed(["set", luid, 'statements',
+                           self._actions[i]['statements']])
             return True
         return False
 
@@ -665,11 +1158,176 @@ class ANCProject:
             self._actions[i]['statements'] = []
         if statement in self._actions[i]['statements']:
             self._actions[i]['statements'].remove(statement)
-            self.save()
+            self._changed(["set", luid, 'statements',
+                           self._actions[i]['statements']])
             return True
         return False
 
+    def _reset_indices(self):
+        '''
+        Forget the luid and path indices (They are rebuilt from _actions
+        on the next lookup).
+        '''
+        self._luid_indices = {}  # luid -> index in _actions
+        self._path_luids = {}  # path -> list of luids
+        self._indexed = None  # the list object that the indices describe
+        self._indexed_len = 0
+        self._stale_i = 0  # luid indices from here on need updating
+        self._range_index = None  # See _get_range_index
+        self._dest_index = None  # See _get_dest_index
+        self._date_index = None  # See _get_date_index
+
+    def _rebuild_indices(self):
+        self._reset_indices()
+        self._indexed = self._actions
+        self._indexed_len = len(self._actions)
+        for action in self._actions:
+            self._index_path(action)
+
+    def _check_indexed_list(self):
+        '''
+        Rebuild the indices if _actions was replaced or resized without
+        using a method that keeps them up to date.
+        '''
+        if ((self._indexed is not self._actions)
+                or (self._indexed_len != len(self._actions))):
+            self._rebuild_indices()
+
+    def _update_indices(self):
+        self._check_indexed_list()
+        for i in range(self._stale_i, len(self._actions)):
+            self._luid_indices[self._actions[i].get('luid')] = i
+        self._stale_i = len(self._actions)
+
+    def _index_path(self, action):
+        path = action.get('path')
+        if path is None:
+            return
+        luids = self._path_luids.get(path)
+        if luids is None:
+            luids = []
+            self._path_luids[path] = luids
+        luids.append(action.get('luid'))
+
+    def _unindex_path(self, action):
+        luids = self._path_luids.get(action.get('path'))
+        if luids is None:
+            return
+        if action.get('luid') in luids:
+            luids.remove(action.get('luid'))
+        if len(luids) < 1:
+            del self._path_luids[action.get('path')]
+
+    def _indices_changed(self, entry=None, removed=(), inserted=()):
+        '''
+        Update the cached indices after the order or count of actions
+        changed.
+
+        Keyword arguments:
+        entry -- The change as a journal entry (See projectjournal), so
+            the destination index can be shifted in place (See
+            _shift_destinations). If None, it is cleared instead.
+        removed -- The (index, action) pairs that the change removed,
+            with the index each had before the change.
+        inserted -- The index of each action that the change inserted.
+        '''
+        self._range_index = None
+        self._date_index = None
+        if self._dest_index is not None:
+            if entry is None:
+                self._dest_index = None
+            else:
+                self._shift_destinations(entry, removed, inserted)
+        if get_verbosity() > 1:
+            self.check_indices()
+
+    def check_indices(self):
+        '''
+        Compare the luid and path indices to a full scan of _actions
+        (This is slow, so it only runs after each change when verbosity
+        is 2 or more, but it can be called any time for debugging).
+
+        Raises:
+        RuntimeError if an index doesn't match _actions.
+        '''
+        self._update_indices()
+        luid_indices = {}
+        path_luids = {}
+        for i in range(len(self._actions)):
+            action = self._actions[i]
+            luid_indices[action.get('luid')] = i
+            if action.get('path') is not None:
+                path_luids.setdefault(action['path'], set()).add(
+                    action.get('luid')
+                )
+        if luid_indices != self._luid_indices:
+            raise RuntimeError(
+                "The luid index {} doesn't match the actions {}"
+                "".format(self._luid_indices, luid_indices)
+            )
+        indexed = {path: set(luids)
+                   for path, luids in self._path_luids.items()}
+        if path_luids != indexed:
+            raise RuntimeError(
+                "The path index {} doesn't match the actions {}"
+                "".format(indexed, path_luids)
+            )
+        if self._date_index is not None:
+            indexed = self._date_index['keys']
+            self._date_index = None
+            rebuilt = self._get_date_index()['keys']
+            if indexed != rebuilt:
+                raise RuntimeError(
+                    "The date index {} doesn't match the actions {}"
+                    "".format(indexed, rebuilt)
+                )
+        if self._dest_index is not None:
+            indexed = self._dest_index
+            self._dest_index = None
+            rebuilt = self._get_dest_index()
+            self._dest_index = indexed
+            for key in ('roots', 'destinations'):
+                if indexed[key] != rebuilt[key]:
+                    raise RuntimeError(
+                        "The destination index {} doesn't match the"
+                        " actions {}".format(indexed[key], rebuilt[key])
+                    )
+
+    def _luid_index(self, luid):
+        self._update_indices()
+        i = self._luid_indices.get(luid)
+        if i is None:
+            return -1
+        if self._actions[i].get('luid') != luid:
+            # The luid was changed directly, so trust nothing.
+            self._rebuild_indices()
+            self._update_indices()
+            i = self._luid_indices.get(luid, -1)
+        return i
+
+    def find_path(self, path):
+        '''
+        Get the index of each action that has the given path, in order.
+        '''
+        self._update_indices()
+        luids = self._path_luids.get(path, [])
+        indices = sorted(self._luid_index(luid) for luid in luids)
+        for i in indices:
+            if (i < 0) or (self._actions[i].get('path') != path):
+                # The path was changed directly, so trust nothing.
+                self._rebuild_indices()
+                return sorted(self._luid_index(luid)
+                              for luid in self._path_luids.get(path, []))
+        return indices
+
     def _find_where(self, name, value):
+        if name == 'luid':
+            return self._luid_index(value)
+        if (name == 'path') and (value is not None):
+            indices = self.find_path(value)
+            if len(indices) > 0:
+                return indices[0]
+            return -1
         for i in range(len(self._actions)):
             if self._actions[i].get(name) == value:
                 return i
@@ -681,34 +1339,36 @@ class ANCProject:
         or the index of the version it affects, and *range* is the entire range
         of indices affecting the version that the index represents or affects.
         '''
-        # prev_luid = None
-        # version_luid = None  # The luid of the affected version.
-        # next_luid = None
-        # prev_i = None
-        # next_i = None
+        ranges, range_ids, version_indices = self._get_range_index()
+        if near_index < 0:
+            near_index += len(self._actions)
+        range_i = range_ids[near_index]
         version_i = None  # The index of the affected version.
-        near_action = self._actions[near_index]
-        if near_action['verb'] in VERSION_VERBS:
+        if self._actions[near_index]['verb'] in VERSION_VERBS:
             version_i = near_index
-        ranges = self.get_ranges()
-        # affected_range_i = None
-        affected_range = None
-        for range_i in range(len(ranges)):
-            r = ranges[range_i]
-            if near_index in r:
-                # affected_range_i = range_i
-                affected_range = r
-        if version_i is None:
-            for i in affected_range:
-                if self._actions[i]['verb'] in VERSION_VERBS:
-                    version_i = i
-                    break
-        return version_i, affected_range
+        else:
+            version_i = version_indices[range_i]
+        return version_i, ranges[range_i]
 
     def get_ranges(self):
         '''
-        Get each group of actions by version.
+        Get each group of actions by version. The result is cached until
+        the actions are changed, so don't modify the lists in it.
+        '''
+        return list(self._get_range_index()[0])
+
+    def _get_range_index(self):
+        '''
+        Get the cached tuple (ranges, range_ids, version_indices), where
+        range_ids[i] is the index in ranges of the range that contains
+        action i, and version_indices[r] is the index of the version in
+        ranges[r] (or None if the range has no version). The cache is
+        cleared by any method that changes the order, count or verbs of
+        the actions.
         '''
+        self._check_indexed_list()
+        if self._range_index is not None:
+            return self._range_index
         ranges = []
         this_range = []
         ENDERS = VERSION_VERBS + ['pre_process']
@@ -736,25 +1396,346 @@ class ANCProject:
         if len(this_range) > 0:
             ranges.append(this_range)
 
-        totals = {}
+        range_ids = [None] * len(self._actions)
+        version_indices = []
         for rI in range(len(ranges)):
+            version_indices.append(None)
             for i in ranges[rI]:
-                key = str(rI)
-                count = totals.get(key)
-                if count is None:
-                    count = 0
+                range_ids[i] = rI
                 if self._actions[i]['verb'] in VERSION_VERBS:
-                    count += 1
-                totals[key] = count
-                if count > 1:
-                    echo0("ENDERS={}".format(ENDERS))
-                    echo0("ranges={}".format(ranges))
-                    raise RuntimeError(
-                        "The data wasn't grouped correctly. The action set has"
-                        " more than one version."
-                    )
+                    if version_indices[rI] is not None:
+                        echo0("ENDERS={}".format(ENDERS))
+                        echo0("ranges={}".format(ranges))
+                        raise RuntimeError(
+                            "The data wasn't grouped correctly. The action"
+                            " set has more than one version."
+                        )
+                    version_indices[rI] = i
+
+        self._range_index = (ranges, range_ids, version_indices)
+        return self._range_index
+
+    def get_commands(self, luid):
+        '''
+        Get the parsed statements of an action. The result is kept until
+        the statements of the action change, so don't modify it.
+
+        Returns:
+        a list of (statement, command, error) tuples where command is
+        from parse_statement or None if the statement is invalid, in
+        which case error is the reason.
+        '''
+        action = self.get_action(luid)
+        if action is None:
+            raise ValueError("There is no '{}' {}".format('luid', luid))
+        statements = tuple(action.get('statements') or ())
+        cached = self._commands.get(luid)
+        if (cached is not None) and (cached[0] == statements):
+            return cached[1]
+        commands = []
+        for statement in statements:
+            try:
+                commands.append((statement, parse_statement(statement),
+                                 None))
+            except ValueError as ex:
+                commands.append((statement, None, str(ex)))
+        self._commands[luid] = (statements, commands)
+        return commands
+
+    def validate_statements(self):
+        '''
+        Parse the statements of every action so errors appear early.
+
+        Returns:
+        a list of error strings (empty if all statements are valid).
+        '''
+        errors = []
+        for action in self._actions:
+            if not action.get('statements'):
+                continue
+            for statement, command, error in \
+                    self.get_commands(action['luid']):
+                if error is not None:
+                    errors.append('{} (luid={}, name={})'
+                                  ''.format(error, action['luid'],
+                                            action.get('name')))
+        return errors
+
+    def _get_dest_index(self):
+        '''
+        Get the cached destination index, a dict where 'roots' maps the
+        first directory of each destination to the sorted indices of the
+        actions that have a "use" statement with that root,
+        'destinations' does the same for each whole destination (See
+        normalize_destination), and 'luids' maps each luid to the
+        (roots, destinations) sets it was indexed under. Changes to the
+        order or count of actions shift it (See _shift_destinations),
+        and changes to statements update it (See _statements_changed).
+        '''
+        self._check_indexed_list()
+        if self._dest_index is not None:
+            return self._dest_index
+        self._dest_index = {
+            'roots': {},
+            'destinations': {},
+            'luids': {},
+        }
+        for i in range(len(self._actions)):
+            self._index_destinations(i)
+        return self._dest_index
+
+    def _index_destinations(self, i):
+        action = self._actions[i]
+        roots = set()
+        destinations = set()
+        if action.get('statements'):
+            for statement, command, error in \
+                    self.get_commands(action['luid']):
+                if (error is not None) or (command['command'] != "use"):
+                    continue
+                dst = command.get('destination')
+                if dst is None:
+                    continue
+                dst = normalize_destination(dst)
+                destinations.add(dst)
+                roots.add(destination_root(dst))
+        if self._dest_index is None:
+            return
+            # ^ get_commands rebuilt the indices (See _luid_index).
+        self._dest_index['luids'][action['luid']] = (roots, destinations)
+        for key, values in (('roots', roots),
+                            ('destinations', destinations)):
+            by_value = self._dest_index[key]
+            for value in values:
+                indices = by_value.get(value)
+                if indices is None:
+                    indices = []
+                    by_value[value] = indices
+                bisect.insort(indices, i)
+
+    def _unindex_destinations(self, luid, i):
+        roots, destinations = self._dest_index['luids'].pop(luid,
+                                                            ((), ()))
+        for key, values in (('roots', roots),
+                            ('destinations', destinations)):
+            by_value = self._dest_index[key]
+            for value in values:
+                indices = by_value[value]
+                pos = bisect.bisect_left(indices, i)
+                if (pos < len(indices)) and (indices[pos] == i):
+                    del indices[pos]
+                if len(indices) < 1:
+                    del by_value[value]
+
+    def _shift_destinations(self, entry, removed, inserted):
+        '''
+        Update the destination index in place after the change in entry
+        instead of parsing the statements of every action again.
+        '''
+        if entry[0] == "set":
+            return
+        for index, action in removed:
+            self._unindex_destinations(action.get('luid'), index)
+        new_index = index_mapper(entry)
+        keep_order = entry[0] in ("insert", "remove", "insert_many",
+                                  "remove_many")
+        # ^ Other changes can move an index past another one.
+        for key in ('roots', 'destinations'):
+            for indices in self._dest_index[key].values():
+                indices[:] = [new_index(index) for index in indices]
+                if not keep_order:
+                    indices.sort()
+        for index in inserted:
+            self._index_destinations(index)
+
+    def _statements_changed(self, luid):
+        if self._dest_index is None:
+            return
+        i = self._luid_index(luid)
+        if (i < 0) or (self._dest_index is None):
+            # ^ _luid_index may have rebuilt the indices.
+            self._dest_index = None
+            return
+        self._unindex_destinations(luid, i)
+        self._index_destinations(i)
+
+    def _dest_list(self, destination, root):
+        dst = normalize_destination(destination)
+        key = 'destinations'
+        if root:
+            key = 'roots'
+            dst = destination_root(dst)
+        return self._get_dest_index()[key].get(dst, [])
+
+    def destination_indices(self, destination, before=None, root=False):
+        '''
+        Get the indices of actions with a "use" statement that has the
+        destination, in order.
+
+        Sequential arguments:
+        destination -- The destination (It is normalized the same way as
+            by version_pairs).
+
+        Keyword arguments:
+        before -- Only get indices lower than this.
+        root -- Match any destination with the same first directory
+            instead of only the whole destination.
+        '''
+        indices = self._dest_list(destination, root)
+        if before is None:
+            return list(indices)
+        return indices[:bisect.bisect_left(indices, before)]
+
+    def find_destination(self, destination, before=None, root=False):
+        '''
+        Find the last action (before a given index if not None) that has a
+        "use" statement with the destination (See destination_indices).
+
+        Returns:
+        the index, or -1 if there is none.
+        '''
+        indices = self._dest_list(destination, root)
+        pos = len(indices)
+        if before is not None:
+            pos = bisect.bisect_left(indices, before)
+        if pos < 1:
+            return -1
+        return indices[pos-1]
+
+    def version_pairs(self, luid, whole=True):
+        '''
+        Get the version_pairs of a version using the parsed statements
+        kept by get_commands.
+
+        Raises:
+        ValueError if a statement is invalid.
+        '''
+        action = self.get_action(luid)
+        if action is None:
+            raise ValueError("There is no '{}' {}".format('luid', luid))
+        commands = []
+        if action.get('statements'):
+            for statement, command, error in self.get_commands(luid):
+                if error is not None:
+                    raise ValueError(error)
+                commands.append((statement, command))
+        return _use_pairs(action, commands, whole=whole)
+
+    def _get_date_index(self):
+        '''
+        Get the cached date index, a dict where 'keys' is a sorted list of
+        (datetime, index) tuples for each version with a valid 'date'
+        (See DATE_FMT), and 'luids' maps the luid of each of those
+        versions to its datetime. Changes to the order or count of
+        actions clear it, and changes to dates update it (See
+        _date_changed).
+        '''
+        self._check_indexed_list()
+        if self._date_index is not None:
+            return self._date_index
+        self._date_index = {
+            'keys': [],
+            'luids': {},
+        }
+        for i in range(len(self._actions)):
+            date_dt = self._version_date(self._actions[i])
+            if date_dt is not None:
+                self._date_index['keys'].append((date_dt, i))
+                self._date_index['luids'][self._actions[i]['luid']] = \
+                    date_dt
+        self._date_index['keys'].sort()
+        return self._date_index
+
+    def _version_date(self, action):
+        if action['verb'] not in VERSION_VERBS:
+            return None
+        date_str = action.get('date')
+        if date_str is None:
+            return None
+        try:
+            return datetime.strptime(date_str, DATE_FMT)
+        except ValueError:
+            return None  # such as "(no date in range)"
+
+    def _date_changed(self, luid):
+        if self._date_index is None:
+            return
+        i = self._luid_index(luid)
+        if (i < 0) or (self._date_index is None):
+            # ^ _luid_index may have rebuilt the indices.
+            self._date_index = None
+            return
+        keys = self._date_index['keys']
+        old_dt = self._date_index['luids'].pop(luid, None)
+        if old_dt is not None:
+            pos = bisect.bisect_left(keys, (old_dt, i))
+            if (pos < len(keys)) and (keys[pos] == (old_dt, i)):
+                del keys[pos]
+        date_dt = self._version_date(self._actions[i])
+        if date_dt is not None:
+            bisect.insort(keys, (date_dt, i))
+            self._date_index['luids'][luid] = date_dt
+
+    def _date_key(self, date):
+        if isinstance(date, datetime):
+            if date.tzinfo is not None:
+                raise ValueError("The datetime must be timezone-naive"
+                                 " (like the 'date' of a version).")
+            return date
+        return datetime.strptime(date, DATE_FMT)
+
+    def versions_between(self, start=None, stop=None):
+        '''
+        Get the indices of the versions with a date from start up to (but
+        not including) stop, in order by date (then by index).
+
+        Keyword arguments:
+        start -- A date string (See DATE_FMT) or naive datetime (None for
+            no lower limit).
+        stop -- The same for the upper limit.
+        '''
+        keys = self._get_date_index()['keys']
+        low = 0
+        high = len(keys)
+        if start is not None:
+            low = bisect.bisect_left(keys, (self._date_key(start), -1))
+        if stop is not None:
+            high = bisect.bisect_left(keys, (self._date_key(stop), -1))
+        return [i for date_dt, i in keys[low:high]]
+
+    def version_before(self, date):
+        '''
+        Find the version with the latest date before the given date (the
+        latest of those in the list if several have that date).
+
+        Returns:
+        the index, or -1 if no version has an earlier date.
+        '''
+        keys = self._get_date_index()['keys']
+        pos = bisect.bisect_left(keys, (self._date_key(date), -1))
+        if pos < 1:
+            return -1
+        return keys[pos-1][1]
 
-        return ranges
+    def dates_out_of_order(self):
+        '''
+        Find versions that are dated earlier than a version before them
+        (Versions without a valid date are ignored).
+
+        Returns:
+        a list of (index, newer_index) tuples in order, where newer_index
+        is the index of the latest-dated version before index (the first
+        one if several have that date).
+        '''
+        results = []
+        newest = None
+        for date_dt, i in sorted(self._get_date_index()['keys'],
+                                 key=lambda key: key[1]):
+            if (newest is not None) and (date_dt < newest[0]):
+                results.append((i, newest[1]))
+            elif (newest is None) or (date_dt > newest[0]):
+                newest = (date_dt, i)
+        return results
 
     def get_action(self, luid):
         i = self._find_where('luid', luid)
@@ -763,33 +1744,67 @@ class ANCProject:
         return None
 
     def _use_all_luids(self):
+        self.luids = LuidAllocator()
         bad_indices = []
         for i in range(len(self._actions)):
             action = self._actions[i]
-            if action['luid'] in used_luids:
+            if not self.luids.use(action['luid']):
                 bad_indices.append(i)
-            use_luid(action['luid'])
         return bad_indices
 
+    def _claim_luids(self, actions):
+        '''
+        Give each action that is about to be added a luid from this
+        project if it has none (or has one that is already in the
+        project).
+        '''
+        claimed = set()
+        for action in actions:
+            luid = action.get('luid')
+            if ((luid is None) or (luid in claimed)
+                    or (self._luid_index(luid) > -1)):
+                action['luid'] = self.luids.generate()
+                if luid is not None:
+                    echo0("* replacing duplicate luid {} with {}"
+                          "".format(luid, action['luid']))
+            else:
+                self.luids.use(luid)
+            claimed.add(action['luid'])
+
     def load(self, path):
         with open(path, 'r') as ins:
             try:
                 self.data = json.load(ins)
                 self.path = path
                 self._actions = self.data['actions']
-                for action in self._actions:
-                    for k, v in action.items():
-                        action[k] = s2or3(v)
+                self._journal = ProjectJournal(journal_path(path))
+                self._journal_lines = []
+                self._needs_snapshot = False
+                self._dirty = False
+                replay(self._actions,
+                       self._journal.load(self.data.get(JOURNAL_ID)))
+                self._side_saved = {}
+                if self.persist_undo:
+                    self._load_undo()
+                if sys.version_info.major < 3:
+                    for action in self._actions:
+                        for k, v in action.items():
+                            action[k] = s2or3(v)
                 bad_indices = self._use_all_luids()
                 msg = None
                 for i in bad_indices:
-                    new_luid = gen_luid()
+                    new_luid = self.luids.generate()
                     if msg is None:
                         msg = ""
                     msg += ("* replacing duplicate luid in {}"
                             " with {}"
                             "".format(self._actions[i], new_luid))
                     self._actions[i]['luid'] = new_luid
+                self._rebuild_indices()
+                self._commands = {}
+                self.statement_errors = self.validate_statements()
+                for error in self.statement_errors:
+                    echo0("Error: {}".format(error))
                 self.project_dir = self.data.get('project_dir')
                 if self.project_dir is None:
                     self.project_dir = os.path.dirname(path)
@@ -802,27 +1817,299 @@ class ANCProject:
             #     return False, str(ex)
         return False, "unknown error"
 
-    def save(self):
+    def _get_journal(self):
         if self.path is None:
             if self.project_dir is None:
                 raise RuntimeError("The project dir or path must be set.")
             self.path = os.path.join(self.project_dir, "anewcommit.json")
-        with open(self.path, 'w') as outs:
-            json.dump(self.data, outs, indent=2, sort_keys=True)
+        if ((self._journal is None)
+                or (self._journal.path != journal_path(self.path))):
+            self._journal = ProjectJournal(journal_path(self.path))
+        return self._journal
+
+    def save(self):
+        '''
+        Write the whole project file now (and compact the journal into
+        it). The file is replaced atomically, so an interrupted save
+        leaves the previous version intact.
+        '''
+        journal = self._get_journal()
+        self.data[JOURNAL_ID] = self.data.get(JOURNAL_ID, 0) + 1
+        # ^ A new id makes load ignore the old journal (and undo file)
+        #   even if the program stops before the journal is discarded.
+        data = self._snapshot_data()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as outs:
+            json.dump(data, outs, indent=2, sort_keys=True)
+            outs.flush()
+            os.fsync(outs.fileno())
+        os.replace(tmp_path, self.path)
+        journal.discard()
+        self._journal_lines = []
+        self._needs_snapshot = False
+        self._dirty = False
+        self._sync_undo()
         echo1('* wrote "{}"'.format(self.path))
+        self._collect_side_files()
         return True
 
+    def _side_dir(self):
+        return os.path.splitext(os.path.basename(self.path))[0] + "-data"
+
+    def _collect_side_files(self):
+        '''
+        Remove side files that neither an action nor an undo step refers
+        to (such as those of removed actions once the undo steps that
+        could insert them again are gone).
+
+        Returns:
+        the number of files removed.
+        '''
+        data_name = self._side_dir()
+        side_dir = os.path.join(os.path.dirname(self.path), data_name)
+        if not os.path.isdir(side_dir):
+            return 0
+        used = set()
+        for action in self._actions:
+            used.add(action.get(SIDE_KEY))
+        for step in self._undo_steps:
+            for substep in step:
+                if substep[0] == "insert":
+                    used.add(substep[2].get(SIDE_KEY))
+                elif substep[0] == "insert_many":
+                    for index, action in substep[1]:
+                        used.add(action.get(SIDE_KEY))
+                elif (substep[0] == "set") and (substep[2] == SIDE_KEY):
+                    used.add(substep[3])
+        count = 0
+        for name in os.listdir(side_dir):
+            if not name.endswith(".json"):
+                continue  # such as a .tmp file being written
+            if os.path.join(data_name, name) in used:
+                continue
+            os.remove(os.path.join(side_dir, name))
+            count += 1
+        if count > 0:
+            echo1('* removed {} unused file(s) from "{}"'
+                  ''.format(count, side_dir))
+        return count
+
+    def get_field(self, luid, key, default=None):
+        '''
+        Get a value from an action, loading it from the side file of the
+        action first if it is one of the HEAVY_FIELDS.
+        '''
+        action = self.get_action(luid)
+        if action is None:
+            raise ValueError("There is no '{}' {}".format('luid', luid))
+        if key in HEAVY_FIELDS:
+            self._load_side(action)
+        return action.get(key, default)
+
+    def _load_side(self, action):
+        '''
+        Load the HEAVY_FIELDS of an action from its side file unless
+        they are already loaded.
+        '''
+        rel = action.get(SIDE_KEY)
+        if (rel is None) or (self.path is None):
+            return
+        if any(key in action for key in HEAVY_FIELDS):
+            return
+        path = os.path.join(os.path.dirname(self.path), rel)
+        try:
+            with open(path, 'r') as ins:
+                values = json.load(ins)
+        except (OSError, ValueError) as ex:
+            echo0('* ignored the side file "{}" of {}: {}'
+                  ''.format(path, action.get('luid'), ex))
+            return
+        saved = {}
+        for key in HEAVY_FIELDS:
+            if key in values:
+                action[key] = values[key]
+                saved[key] = values[key]
+        self._side_saved[action.get('luid')] = saved
+
+    def _snapshot_data(self):
+        '''
+        Get a copy of self.data where the HEAVY_FIELDS of each action are
+        replaced by a reference to its side file. A side file is only
+        written if a value in it was replaced since it was last loaded
+        or written (so change heavy values by setting the key, not by
+        modifying the value).
+        '''
+        data_name = self._side_dir()
+        actions = []
+        for action in self._actions:
+            heavy = [key for key in HEAVY_FIELDS if key in action]
+            if len(heavy) == 0:
+                actions.append(action)
+                continue
+            luid = action.get('luid')
+            saved = self._side_saved.get(luid, {})
+            if ((action.get(SIDE_KEY) is None)
+                    or any(saved.get(key) is not action[key]
+                           for key in heavy)):
+                values = {key: action[key] for key in heavy}
+                rel = os.path.join(data_name, "{}.json".format(luid))
+                path = os.path.join(os.path.dirname(self.path), rel)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path + ".tmp", 'w') as outs:
+                    json.dump(values, outs, sort_keys=True)
+                    outs.flush()
+                    os.fsync(outs.fileno())
+                os.replace(path + ".tmp", path)
+                action[SIDE_KEY] = rel
+                self._side_saved[luid] = values
+            actions.append({k: v for k, v in action.items()
+                            if k not in HEAVY_FIELDS})
+        data = dict(self.data)
+        data['actions'] = actions
+        return data
+
+    def _undo_state(self):
+        '''
+        Identify the saved project data that the undo steps apply to.
+        '''
+        return [self.data.get(JOURNAL_ID), self._get_journal().count]
+
+    def _sync_undo(self):
+        if not self.persist_undo:
+            return
+        if self._undo_steps.path is None:
+            self._undo_steps.path = undo_path(self.path)
+        self._undo_steps.sync(self._undo_state(), self._undo_step_i)
+
+    def _load_undo(self):
+        store = self._undo_steps
+        state, position = store.load(undo_path(self.path))
+        if state == self._undo_state():
+            self._undo_step_i = position
+            return
+        if len(store) > 0:
+            echo1('* discarded undo steps in "{}" that are for another'
+                  ' version of the project'.format(store.path))
+        self.clear_undo()
+
+    def _changed(self, entry, save=True):
+        '''
+        Record a change that ANCProject made to the actions.
+
+        Sequential arguments:
+        entry -- The change as a journal entry (See projectjournal).
+
+        Keyword arguments:
+        save -- Request a save (If False, the next save is a full
+            snapshot so the change isn't lost).
+        '''
+        if self._captured is not None:
+            self._captured.append(entry)
+        if (entry[0] == "set") and (entry[2] == 'statements'):
+            self._statements_changed(entry[1])
+        elif (entry[0] == "set") and (entry[2] == 'date'):
+            self._date_changed(entry[1])
+        if not save:
+            self._needs_snapshot = True
+            return False
+        if self.journaled:
+            self._journal_lines.append(json.dumps(entry, sort_keys=True))
+        else:
+            self._needs_snapshot = True
+        return self._request_flush()
+
+    def request_save(self):
+        '''
+        Mark the project as changed and save it now or later (See
+        save_scheduler and batch). Call this after changing an action
+        directly (The next write is a full snapshot, since the change
+        isn't in the journal).
+
+        Returns:
+        True if the file was written now, otherwise False.
+        '''
+        self._needs_snapshot = True
+        return self._request_flush()
+
+    def _request_flush(self):
+        self._dirty = True
+        if self._batch_depth > 0:
+            return False
+        if self.save_scheduler is None:
+            return self.flush()
+        if not self._save_scheduled:
+            self._save_scheduled = True
+            self.save_scheduler(self.save_delay, self._scheduled_flush)
+        return False
+
+    def _scheduled_flush(self):
+        self._save_scheduled = False
+        if self._batch_depth > 0:
+            return  # The batch will request a save when it ends.
+        self.flush()
+
+    def flush(self):
+        '''
+        Write the project file if there are unsaved changes.
+
+        Returns:
+        True if the file was written, otherwise False.
+        '''
+        if not self._dirty:
+            return False
+        if self.journaled and not self._needs_snapshot:
+            journal = self._get_journal()
+            journal_id = self.data.get(JOURNAL_ID)
+            count = journal.count + len(self._journal_lines)
+            if (journal_id is not None) and (count <= self.journal_max):
+                journal.append(journal_id, self._journal_lines)
+                self._journal_lines = []
+                self._dirty = False
+                self._sync_undo()
+                echo1('* journaled changes to "{}"'.format(self.path))
+                return True
+        return self.save()
+
+    def is_dirty(self):
+        return self._dirty
+
+    @contextmanager
+    def batch(self):
+        '''
+        Defer saving until the end of a group of changes, such as in:
+        with project.batch():
+            for path in paths:
+                project.add_version(path)
+        Batches can be nested. The file is written (or the write is
+        scheduled) once when the outermost batch ends.
+        '''
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if (self._batch_depth == 0) and self._dirty:
+                self._request_flush()
+
     def get_project_dir(self):
         if self.project_dir is None:
             raise RuntimeError("The project dir or path must be set.")
         return self.project_dir
 
     def remove(self, index, add_undo_step=True):
+        self._check_indexed_list()
+        if index < 0:
+            index += len(self._actions)
         action = self._actions.pop(index)
+        self._indexed_len -= 1
+        self._stale_i = min(self._stale_i, index)
+        self._luid_indices.pop(action.get('luid'), None)
+        self._unindex_path(action)
+        self._indices_changed(["remove", index],
+                              removed=[(index, action)])
         echo1("* removed [{}]: {}".format(index, action))
         echo1("  len {}".format(len(self._actions)))
-        if self.auto_save:
-            self.save()
         undo_substep = [
             "insert",
             index,
@@ -830,6 +2117,8 @@ class ANCProject:
         ]
         if add_undo_step:
             self._add_undo_step([undo_substep])
+            # ^ before saving, so the side file (if any) is kept
+        self._changed(["remove", index], save=self.auto_save)
         return undo_substep
 
     def insert(self, index, action, add_undo_step=True):
@@ -853,7 +2142,15 @@ class ANCProject:
             raise IndexError("The index {} is beyond len {}"
                              "".format(index, len(self._actions)))
         # ^ insert at >=len actually works, so ensure the number is sane.
+        self._claim_luids([action])
+        self._check_indexed_list()
+        if index < 0:
+            index = max(0, index + len(self._actions))
         self._actions.insert(index, action)
+        self._indexed_len += 1
+        self._stale_i = min(self._stale_i, index)
+        self._index_path(action)
+        self._indices_changed(["insert", index], inserted=[index])
         echo1("* inserted [{}]: {}".format(index, action))
         echo1("  len {}".format(len(self._actions)))
         undo_substep = [
@@ -862,10 +2159,25 @@ class ANCProject:
         ]
         if add_undo_step:
             self._add_undo_step([undo_substep])
-        if self.auto_save:
-            self.save()
+        self._changed(["insert", index, action], save=self.auto_save)
         return undo_substep
 
+    def _swap_actions(self, index, other_index):
+        self._check_indexed_list()
+        if index < 0:
+            index += len(self._actions)
+        if other_index < 0:
+            other_index += len(self._actions)
+        tmp_action = self._actions[index]
+        self._actions[index] = self._actions[other_index]
+        self._actions[other_index] = tmp_action
+        if index < self._stale_i:
+            self._luid_indices[self._actions[index].get('luid')] = index
+        if other_index < self._stale_i:
+            self._luid_indices[self._actions[other_index].get('luid')] = \
+                other_index
+        self._indices_changed(["swap", index, other_index])
+
     def swap(self, index, other_index, add_undo_step=True):
         '''
         Keyword arguments:
@@ -873,9 +2185,7 @@ class ANCProject:
             step, or there is some particular internal reason not to record a
             step.
         '''
-        tmp_action = self._actions[index]
-        self._actions[index] = self._actions[other_index]
-        self._actions[other_index] = tmp_action
+        self._swap_actions(index, other_index)
         undo_substep = [
             "swap",
             index,
@@ -883,8 +2193,7 @@ class ANCProject:
         ]
         if add_undo_step:
             self._add_undo_step([undo_substep])
-        if self.auto_save:
-            self.save()
+        self._changed(["swap", index, other_index], save=self.auto_save)
         return undo_substep
 
     def swap_where_luid(self, luid, other_luid, add_undo_step=True):
@@ -901,9 +2210,7 @@ class ANCProject:
         if other_index < 0:
             raise ValueError("There is no '{}' {}".format('luid', other_luid))
 
-        tmp_action = self._actions[index]
-        self._actions[index] = self._actions[other_index]
-        self._actions[other_index] = tmp_action
+        self._swap_actions(index, other_index)
         undo_substep = [
             "swap_where_luid",
             luid,
@@ -911,8 +2218,247 @@ class ANCProject:
         ]
         if add_undo_step:
             self._add_undo_step([undo_substep])
-        if self.auto_save:
-            self.save()
+        self._changed(["swap", index, other_index], save=self.auto_save)
+        return undo_substep
+
+    def add_listener(self, callback, with_entries=False):
+        '''
+        Call callback(min_index) after a bulk change (such as by
+        insert_many, remove_many, move_range or append_statement_many),
+        where min_index is the first index in _actions that may differ.
+        Changes by undo or by single-action methods don't notify
+        listeners (The caller already knows what changed, and undo
+        returns the entries in results['entries']).
+
+        Keyword arguments:
+        with_entries -- Call callback(min_index, entries) instead, where
+            entries is the list of changes in the form of journal
+            entries (See projectjournal), so a view can update only
+            what changed.
+        '''
+        self._listeners.append([callback, with_entries])
+
+    def remove_listener(self, callback):
+        for index, (listener, _) in enumerate(self._listeners):
+            if listener == callback:
+                del self._listeners[index]
+                return
+        raise ValueError("The callback isn't a listener.")
+
+    def _notify(self, min_index, entries):
+        for callback, with_entries in self._listeners:
+            if with_entries:
+                callback(min_index, entries)
+            else:
+                callback(min_index)
+
+    def _insert_pairs(self, pairs, add_undo_step=True, notify=True):
+        self._check_indexed_list()
+        if len(pairs) == 0:
+            return None
+        self._claim_luids([pair[1] for pair in pairs])
+        insert_pairs(self._actions, pairs)
+        self._indexed_len += len(pairs)
+        self._stale_i = min(self._stale_i, pairs[0][0])
+        for index, action in pairs:
+            self._index_path(action)
+        self._indices_changed(["insert_many", pairs],
+                              inserted=[pair[0] for pair in pairs])
+        undo_substep = [
+            "remove_many",
+            [pair[0] for pair in pairs],
+        ]
+        if add_undo_step:
+            self._add_undo_step([undo_substep])
+        self._changed(["insert_many", pairs], save=self.auto_save)
+        if notify:
+            self._notify(pairs[0][0], [["insert_many", pairs]])
+        return undo_substep
+
+    def insert_many(self, index, actions, add_undo_step=True, notify=True):
+        '''
+        Insert several actions in one pass, as one undo step.
+
+        Sequential arguments:
+        index -- Insert the first action here (The rest follow it).
+        actions -- Insert these action dictionaries.
+
+        Keyword arguments:
+        add_undo_step -- (See insert)
+        notify -- Call each listener once (See add_listener).
+
+        Returns:
+        an undo substep (See insert).
+        '''
+        if index > len(self._actions):
+            raise IndexError("The index {} is beyond len {}"
+                             "".format(index, len(self._actions)))
+        if index < 0:
+            index = max(0, index + len(self._actions))
+        return self._insert_pairs(
+            [[index+offset, action] for offset, action in enumerate(actions)],
+            add_undo_step=add_undo_step,
+            notify=notify,
+        )
+
+    def remove_many(self, indices, add_undo_step=True, notify=True):
+        '''
+        Remove several actions in one pass, as one undo step.
+
+        Sequential arguments:
+        indices -- Remove the actions at these indices (in any order).
+
+        Keyword arguments:
+        add_undo_step -- (See insert)
+        notify -- Call each listener once (See add_listener).
+
+        Returns:
+        an undo substep (See insert).
+        '''
+        self._check_indexed_list()
+        count = len(self._actions)
+        indices = sorted(set((index + count) if index < 0 else index
+                             for index in indices))
+        if len(indices) == 0:
+            return None
+        if (indices[0] < 0) or (indices[-1] >= count):
+            raise IndexError("The indices {} are not all within len {}"
+                             "".format(indices, count))
+        pairs = remove_indices(self._actions, indices)
+        self._indexed_len -= len(pairs)
+        self._stale_i = min(self._stale_i, indices[0])
+        for index, action in pairs:
+            self._luid_indices.pop(action.get('luid'), None)
+            self._unindex_path(action)
+        self._indices_changed(["remove_many", indices], removed=pairs)
+        undo_substep = [
+            "insert_many",
+            pairs,
+        ]
+        if add_undo_step:
+            self._add_undo_step([undo_substep])
+        self._changed(["remove_many", indices], save=self.auto_save)
+        if notify:
+            self._notify(indices[0], [["remove_many", indices]])
+        return undo_substep
+
+    def move_range(self, start, stop, to, add_undo_step=True, notify=True):
+        '''
+        Move several actions in one pass, as one undo step.
+
+        Sequential arguments:
+        start -- The index of the first action to move.
+        stop -- The index after the last action to move.
+        to -- The index where the first action should be afterward.
+
+        Keyword arguments:
+        add_undo_step -- (See insert)
+        notify -- Call each listener once (See add_listener).
+
+        Returns:
+        an undo substep (See insert).
+        '''
+        self._check_indexed_list()
+        move_range(self._actions, start, stop, to)
+        # ^ raises IndexError if the range or destination is bad
+        self._stale_i = min(self._stale_i, start, to)
+        self._indices_changed(["move_range", start, stop, to])
+        undo_substep = [
+            "move_range",
+            to,
+            to + stop - start,
+            start,
+        ]
+        if add_undo_step:
+            self._add_undo_step([undo_substep])
+        self._changed(["move_range", start, stop, to], save=self.auto_save)
+        if notify:
+            self._notify(min(start, to), [["move_range", start, stop, to]])
+        return undo_substep
+
+    def reorder(self, order, add_undo_step=True, notify=True):
+        '''
+        Put all of the actions in a new order in one pass, as one undo
+        step.
+
+        Sequential arguments:
+        order -- A list of every current index, in the new order.
+
+        Keyword arguments:
+        add_undo_step -- (See insert)
+        notify -- Call each listener once (See add_listener).
+
+        Returns:
+        an undo substep (See insert), or None if nothing moved.
+        '''
+        self._check_indexed_list()
+        order = list(order)
+        min_index = None
+        for new_index, index in enumerate(order):
+            if new_index != index:
+                min_index = new_index
+                break
+        if min_index is None:
+            if sorted(order) != list(range(len(self._actions))):
+                raise IndexError("The order {} isn't a reordering of {}"
+                                 " actions".format(order, len(self._actions)))
+            return None
+        reorder(self._actions, order)
+        # ^ raises IndexError if order isn't a reordering
+        self._stale_i = min(self._stale_i, min_index)
+        self._indices_changed(["reorder", order])
+        undo_substep = [
+            "reorder",
+            inverse_order(order),
+        ]
+        if add_undo_step:
+            self._add_undo_step([undo_substep])
+        self._changed(["reorder", order], save=self.auto_save)
+        if notify:
+            self._notify(min_index, [["reorder", order]])
+        return undo_substep
+
+    def append_statement_many(self, luids, statement, add_undo_step=True,
+                              notify=True):
+        '''
+        Add a statement to several actions (skipping any that already
+        have it), as one undo step.
+
+        Returns:
+        the list of luids that the statement was added to.
+        '''
+        parse_statement(statement)  # call this to validate/raise exception
+        undo_step = []
+        entries = []
+        added = []
+        min_index = None
+        for luid in luids:
+            i = self._find_where('luid', luid)
+            if i < 0:
+                raise ValueError("There is no '{}' {}".format('luid', luid))
+            statements = self._actions[i].get('statements')
+            if statements is None:
+                statements = []
+            if statement in statements:
+                continue
+            undo_step.append(["set", luid, 'statements',
+                              self._actions[i].get('statements')])
+            statements = statements + [statement]
+            self._actions[i]['statements'] = statements
+            entries.append(["set", luid, 'statements', statements])
+            added.append(luid)
+            if (min_index is None) or (i < min_index):
+                min_index = i
+        if len(added) == 0:
+            return added
+        if add_undo_step:
+            self._add_undo_step(undo_step)
+        with self.batch():
+            for entry in entries:
+                self._changed(entry, save=self.auto_save)
+        if notify:
+            self._notify(min_index, entries)
+        return added
 
     def insert_where(self, name, value, action, direction=-1):
         '''
@@ -954,6 +2500,48 @@ class ANCProject:
     def remove_where_luid(self, luid):
         return self.remove_where('luid', luid)
 
+    def set_field(self, luid, key, value, add_undo_step=True,
+                  coalesce=False):
+        '''
+        Set a value in an action. Use this instead of changing the action
+        dictionary directly so cached ranges and indices stay current and
+        the change is saved (if auto_save) as a journal entry.
+
+        Sequential arguments:
+        luid -- Change the action with this luid.
+        key -- Change this key (It can't be 'luid').
+        value -- Set the key to this value.
+
+        Keyword arguments:
+        add_undo_step -- Record the old value so the change can be undone.
+            Changes to HEAVY_FIELDS can't be undone.
+        coalesce -- Make repeated changes to the same field one undo step
+            (for text typed into the field, See _add_undo_step).
+
+        Returns:
+        the old value, or None if the key wasn't present.
+        '''
+        if key == 'luid':
+            raise ValueError("The luid of an action can't be changed.")
+        i = self._find_where('luid', luid)
+        if i < 0:
+            raise ValueError("There is no '{}' {}".format('luid', luid))
+        action = self._actions[i]
+        old_value = action.get(key)
+        if key == 'path':
+            self._unindex_path(action)
+        action[key] = value
+        if key == 'path':
+            self._index_path(action)
+        if key in ('verb', 'path'):
+            self._indices_changed(["set", luid, key, value])
+        if add_undo_step and (key not in HEAVY_FIELDS):
+            self._add_undo_step([["set", luid, key, old_value]],
+                                coalesce=coalesce)
+            # ^ A key that was added is set to None by undo.
+        self._changed(["set", luid, key, value], save=self.auto_save)
+        return old_value
+
     def set_commit(self, luid, on):
         '''
         Turn the commit option of the version or process off or on.
@@ -1025,87 +2613,477 @@ class ANCProject:
             os.makedirs(path)
         return path
 
-    def generate_cache(self, luid, do_uncommitted=False):
-        unfiltered_commits_dir = self.get_cached_dir("commits")
-        tmp_dir = os.path.join(unfiltered_commits_dir, luid)
+    def get_archive_index_dir(self):
+        '''
+        Get _anewcommit_cache/archive-index (See archiveindex), or None
+        if the project has no project_dir yet.
+        '''
+        if self.project_dir is None:
+            return None
+        return self.get_cached_dir("archive-index")
+
+    def get_archive_tree(self, path):
+        '''
+        Get an ArchiveTree that keeps its member index in
+        _anewcommit_cache/archive-index.
+        '''
+        return ArchiveTree(path, index_dir=self.get_archive_index_dir())
+
+    def extract(self, src_file, new_parent_dir, auto_sub=True,
+                auto_sub_name=None):
+        '''
+        Extract an archive using the project's extraction cache
+        (_anewcommit_cache/extracted, See the extract function).
+        '''
+        return extract(src_file, new_parent_dir, auto_sub=auto_sub,
+                       auto_sub_name=auto_sub_name,
+                       cache_dir=self.get_cached_dir("extracted"))
+
+    def sync_version(self, action, dst_dir, resync=False):
+        '''
+        Copy a version into dst_dir using rsync, placing each source of
+        the version at its destination (See version_pairs).
+
+        Sequential arguments:
+        action -- This must be a version action such as created using the
+            new_version function.
+        dst_dir -- Copy the version's files into this directory.
+
+        Keyword arguments:
+        resync -- Delete files in dst_dir that are not in the version
+            even if the mode is not 'delete_then_add'.
+
+        Returns:
+        False (the value resync should have for the next version, since
+        any deletions necessary were done).
+        '''
+        with closing(self._rsync_commands(action, dst_dir,
+                                          resync=resync)) as commands:
+            for src, cmd_parts in commands:
+                sys.stderr.write('* getting "{}"...'.format(src))
+                sys.stderr.flush()
+                # See <https://stackoverflow.com/a/61139019/4541104>:
+                with subprocess.Popen(
+                    cmd_parts, stdout=subprocess.PIPE, text=True,
+                ) as process:
+                    # bufsize=1,  # allow backspace processing
+                    pass
+                    # for line in iter(process.stdout.readline, b''):
+                    #     print(line.strip())
+                if process.returncode != 0:
+                    raise RuntimeError(
+                        "rsync failed with code {}: {}"
+                        "".format(process.returncode, cmd_parts)
+                    )
+                echo0("OK\n")
+        return False
+
+    async def sync_version_async(self, action, dst_dir, resync=False):
+        '''
+        Do sync_version without blocking the event loop (See
+        run_process).
+        '''
+        with closing(self._rsync_commands(action, dst_dir,
+                                          resync=resync)) as commands:
+            for src, cmd_parts in commands:
+                echo1('* getting "{}"...'.format(src))
+                async with self._async_limit():
+                    code = await run_process(cmd_parts)
+                if code != 0:
+                    raise RuntimeError(
+                        "rsync failed with code {}: {}"
+                        "".format(code, cmd_parts)
+                    )
+        return False
+
+    def _rsync_commands(self, action, dst_dir, resync=False):
+        '''
+        Get the rsync command for each (source, destination) pair of a
+        version (See sync_version).
+
+        Returns:
+        (yields) a tuple (source, cmd_parts) for each pair. The include
+        and exclude files for a command are deleted when the next one is
+        requested (or when the generator is closed).
+        '''
+        mode = action['mode']  # The mode only applies to 'get_version'
+        if mode == 'delete_then_add':
+            resync = True
+        elif mode == 'overlay':
+            pass
+        pairs = self.version_pairs(action['luid'])
+        dst_roots = [destination_root(dst) for src, dst in pairs if dst != ""]
+        for src, dst in pairs:
+            cmd_parts = [
+                'rsync',
+                '-rt',
+                # '--info=progress2',
+            ]
+            if resync:
+                cmd_parts.append("--delete")
+            if dst == "":
+                # Don't delete other destinations when syncing the root:
+                for dst_root in dst_roots:
+                    cmd_parts += ['--exclude', "/" + dst_root + "/"]
+            ignore_root = action['path']
+            echo1('* Any absolute paths in gitignore will assume'
+                  ' "{}" is the directory containing ".gitignore".'
+                  ''.format(ignore_root))
+            include_tmp, exclude_tmp = self.get_rsync_pair(
+                ignore_root,
+                src,
+            )
+            try:
+                # The FIRST pattern is matched when using rsync, so
+                #   include must come first:
+                if include_tmp is not None:
+                    cmd_parts += ['--include-from', include_tmp]
+                if exclude_tmp is not None:
+                    cmd_parts += ['--exclude-from', exclude_tmp]
+
+                dst_path = dst_dir
+                if dst != "":
+                    dst_path = os.path.join(dst_dir, dst)
+                if not os.path.isdir(dst_path):
+                    os.makedirs(dst_path)
+                cmd_parts.append(src+"/")
+                cmd_parts.append(dst_path)
+                yield src, cmd_parts
+            finally:
+                if exclude_tmp is not None:
+                    os.remove(exclude_tmp)
+                if include_tmp is not None:
+                    os.remove(include_tmp)
+
+    def update_manifest(self, luid):
+        '''
+        Scan the sources of a version and store the result in
+        action['manifest'] (See the manifest submodule). Only files that
+        are new or changed since the last scan are hashed.
+
+        Returns:
+        the manifest.
+        '''
+        action = self.get_action(luid)
+        if action is None:
+            raise ValueError("There is no '{}' {}".format('luid', luid))
+        if action['verb'] not in VERSION_VERBS:
+            raise ValueError("Only a version can have a manifest"
+                             " (verb={}).".format(action['verb']))
+        sources = [src for src, dst in self.version_pairs(luid)]
+        self._load_side(action)
+        manifest, hashed = scan_manifest(action['path'], sources,
+                                         old=action.get('manifest'))
+        echo1("* hashed {}/{} file(s) in {}"
+              "".format(hashed, len(manifest), action['path']))
+        action['manifest'] = manifest
+        return manifest
+
+    def add_versions_in(self, path):
+        '''
+        Replace the actions with a version for each directory in path,
+        and use path as the project_dir. The project file is written
+        (once) even if there are no versions.
+
+        Returns:
+        the list of new version actions.
+        '''
+        self.clear()
+        self.project_dir = path
+        names = set(action.get('name') for action in self._actions)
+        actions = []
+        for sub in os.listdir(path):
+            subPath = os.path.join(path, sub)
+            if not os.path.isdir(subPath):
+                continue
+            name = sub
+            new_number = 1
+            while name in names:
+                new_number += 1
+                name = sub + " ({})".format(new_number)
+            actions.append(new_version(subPath, name=name))
+            names.add(name)
+        with self.batch():
+            self.request_save()  # Save the cleared list either way.
+            self.insert_many(len(self._actions), actions)
+            # ^ one undo step, one write and one refresh for all versions
+        return actions
+
+    def version_luids(self):
+        '''
+        Get the luid of the version in each range (See get_ranges), in
+        order.
+        '''
+        version_indices = self._get_range_index()[2]
+        return [self._actions[i]['luid'] for i in version_indices
+                if i is not None]
+
+    def version_sources(self, luid):
+        '''
+        Get the directories that the files of a version come from: the
+        source of each "use" statement that has a source and a
+        destination, or else the whole version.
+
+        Raises:
+        ValueError if a statement is invalid.
+        '''
+        action = self.get_action(luid)
+        if action is None:
+            raise ValueError("There is no '{}' {}".format('luid', luid))
+        parent = action['path']
+        sources = []
+        if action.get('statements'):
+            for statement, command, error in self.get_commands(luid):
+                if error is not None:
+                    raise ValueError(error)
+                if 'destination' not in command:
+                    continue
+                source = command.get('source')
+                if source is None:
+                    continue
+                    # There is no source, so the whole thing is the source
+                    # (there shouldn't be any other "use" statements in
+                    # this case).
+                sources.append(os.path.join(parent, source))
+        if len(sources) == 0:
+            # If there are no specified subprojects in the source,
+            #   use the entire source:
+            sources = [parent]
+        return sources
+
+    def mark_dates(self, too_new_dt=None, luids=None, jobs=1,
+                   date_fmt=DATE_FMT, progress=None):
+        '''
+        Set the 'date' of versions to the date of the newest file in
+        their sources (See version_sources) and 'newest_path' to the
+        file, as one undo step. Files in archives count (using the
+        member index in _anewcommit_cache/archive-index, so archives are
+        only decompressed the first time).
+
+        Keyword arguments:
+        too_new_dt -- Skip files with a datetime >= too_new_dt (It must be
+            timezone-aware) if not None.
+        luids -- Mark these versions (None for every version).
+        jobs -- The maximum number of processes searching at once (None
+            for one per CPU).
+        date_fmt -- The strftime format of the date.
+        progress -- If not None, call progress(done, count, luid) as
+            each version is searched.
+
+        Returns:
+        a list of (luid, newest_path, date) tuples in the order of luids,
+        where date is a string.
+        '''
+        if luids is None:
+            luids = self.version_luids()
+        requests = [self.version_sources(luid) for luid in luids]
+        index_dir = self.get_archive_index_dir()
+        found = [None] * len(luids)
+        if (len(requests) > 1) and (jobs != 1):
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = {}
+                for pos, sources in enumerate(requests):
+                    future = executor.submit(newest_in_sources, sources,
+                                             too_new_dt=too_new_dt,
+                                             archives=True,
+                                             index_dir=index_dir)
+                    futures[future] = pos
+                for done, future in enumerate(as_completed(futures)):
+                    pos = futures[future]
+                    found[pos] = future.result()
+                    if progress is not None:
+                        progress(done+1, len(luids), luids[pos])
+        else:
+            for pos, sources in enumerate(requests):
+                found[pos] = newest_in_sources(sources,
+                                               too_new_dt=too_new_dt,
+                                               archives=True,
+                                               index_dir=index_dir)
+                if progress is not None:
+                    progress(pos+1, len(luids), luids[pos])
+        return self._set_dates(luids, found, date_fmt)
+
+    async def scan_all(self, too_new_dt=None, luids=None, date_fmt=DATE_FMT,
+                       progress=None, executor=None):
+        '''
+        Do mark_dates without blocking the event loop: The versions are
+        searched in executor (None for the loop's default executor), up
+        to async_jobs at once. If it is cancelled, nothing is marked.
+        '''
+        if luids is None:
+            luids = self.version_luids()
+        requests = [self.version_sources(luid) for luid in luids]
+        index_dir = self.get_archive_index_dir()
+        found = [None] * len(luids)
+        loop = asyncio.get_running_loop()
+        limit = self._async_limit()
+
+        async def search(pos):
+            async with limit:
+                return pos, await loop.run_in_executor(
+                    executor,
+                    functools.partial(newest_in_sources, requests[pos],
+                                      too_new_dt=too_new_dt, archives=True,
+                                      index_dir=index_dir),
+                )
+
+        tasks = [asyncio.ensure_future(search(pos))
+                 for pos in range(len(requests))]
+        try:
+            for done, next_task in enumerate(asyncio.as_completed(tasks)):
+                pos, found[pos] = await next_task
+                if progress is not None:
+                    progress(done+1, len(luids), luids[pos])
+        finally:
+            for task in tasks:
+                task.cancel()
+            # ^ Only searches that haven't started can stop (A search
+            #   that is running finishes in its thread).
+        return self._set_dates(luids, found, date_fmt)
+
+    def _set_dates(self, luids, found, date_fmt):
+        '''
+        Set the 'date' and 'newest_path' of each version from found (a
+        list of (newest_path, newest_dt) tuples from newest_in_sources in
+        the order of luids) as one undo step (See mark_dates).
+        '''
+        results = []
+        undo_step = []
+        entries = []
+        min_index = None
+        with self.batch():
+            for luid, (newest_path, newest_dt) in zip(luids, found):
+                if newest_dt is not None:
+                    date_str = newest_dt.strftime(date_fmt)
+                    if len(date_str.strip()) == 0:
+                        date_str = "(bad date)"
+                else:
+                    date_str = "(no date in range)"
+                results.append((luid, newest_path, date_str))
+                action = self.get_action(luid)
+                for key, value in (('date', date_str),
+                                   ('newest_path', newest_path)):
+                    if (key in action) and (action[key] == value):
+                        continue
+                    undo_step.append(["set", luid, key, action.get(key)])
+                    self.set_field(luid, key, value, add_undo_step=False)
+                    entries.append(["set", luid, key, value])
+                    i = self._find_where('luid', luid)
+                    if (min_index is None) or (i < min_index):
+                        min_index = i
+        if min_index is not None:
+            self._add_undo_step(undo_step)
+            self._notify(min_index, entries)
+        return results
+
+    def sort_versions_by_date(self, add_undo_step=True, notify=True):
+        '''
+        Put the versions with a valid date in order by date (each with
+        the actions in its range, See get_ranges), as one undo step.
+        Ranges without a dated version stay where they are, and versions
+        with the same date stay in the same order.
+
+        Returns:
+        an undo substep (See insert), or None if nothing moved.
+        '''
+        ranges, range_ids, version_indices = self._get_range_index()
+        date_of_range = {}
+        for date_dt, i in self._get_date_index()['keys']:
+            date_of_range[range_ids[i]] = date_dt
+        dated = sorted(date_of_range)  # range numbers in list order
+        by_date = sorted(dated, key=lambda range_i: date_of_range[range_i])
+        placed = dict(zip(dated, by_date))
+        order = []
+        for range_i in range(len(ranges)):
+            order += ranges[placed.get(range_i, range_i)]
+        return self.reorder(order, add_undo_step=add_undo_step,
+                            notify=notify)
+
+    def find_applicable(self, statement, luids=None):
+        '''
+        Get the versions where a statement applies: those that contain
+        the source of the statement, or all of them if it has no source.
+
+        Keyword arguments:
+        luids -- Only check these versions (None for every version).
+
+        Returns:
+        the list of luids.
+        '''
+        command = parse_statement(statement)
+        if luids is None:
+            luids = self.version_luids()
+        relPath = command.get('source')
+        if (relPath is not None) and (relPath.strip() == ""):
+            relPath = None
+        if relPath is None:
+            return list(luids)
+        return [luid for luid in luids
+                if os.path.isdir(os.path.join(self.get_action(luid)['path'],
+                                              relPath))]
+
+    def generate_cache(self, luid, do_uncommitted=False, progress=None):
+        '''
+        Sync every version up to and including the luid into
+        _anewcommit_cache/commits/<luid>.
+
+        Keyword arguments:
+        do_uncommitted -- Include versions that are not set to commit.
+        progress -- If not None, call progress(index, count) before
+            each version is synced instead of printing the percentage.
+
+        Returns:
+        the directory.
+        '''
+        tmp_dir = os.path.join(self.get_cached_dir("commits"), luid)
+        echo0("+ generating {}".format(tmp_dir))
+        resync = True  # always resync the first time.
+        for index, count, action in self._cache_steps(luid, do_uncommitted):
+            if progress is not None:
+                progress(index, count)
+            else:
+                progress_f = float(index) / float(count)
+                print("{}%".format(round(progress_f*100.0, 1)))
+            resync = self.sync_version(action, tmp_dir, resync=resync)
+        return tmp_dir
+
+    async def build_cache(self, luid, do_uncommitted=False, progress=None):
+        '''
+        Do generate_cache without blocking the event loop. Cancelling it
+        stops rsync (See run_process).
+        '''
+        tmp_dir = os.path.join(self.get_cached_dir("commits"), luid)
         echo0("+ generating {}".format(tmp_dir))
-        last_i = self._find_where('luid', luid)
         resync = True  # always resync the first time.
-        progress_max = float(last_i+1)
+        for index, count, action in self._cache_steps(luid, do_uncommitted):
+            if progress is not None:
+                progress(index, count)
+            resync = await self.sync_version_async(action, tmp_dir,
+                                                   resync=resync)
+        return tmp_dir
+
+    def _cache_steps(self, luid, do_uncommitted):
+        '''
+        Get the versions that generate_cache syncs.
+
+        Returns:
+        (yields) a tuple (index, count, action) for each version, where
+        count is the number of actions up to and including the luid.
+        '''
+        last_i = self._find_where('luid', luid)
         for index in range(0, last_i+1):
             action = self._actions[index]
-            progress_f = float(index) / progress_max
             if not do_uncommitted:
                 if action.get('commit') is not True:
                     continue
             if action['verb'] in VERSION_VERBS:
-                mode = action['mode']  # The mode only applies to 'get_version'
-                cmd_start = [
-                    'rsync',
-                    '-rt',
-                    # '--info=progress2',
-                ]
-                if mode == 'delete_then_add':
-                    resync = True
-                if resync:
-                    cmd_start.append("--delete")
-                    resync = False
-                elif mode == 'overlay':
-                    pass
                 statements = action.get('statements')
                 if statements is None:
                     echo0('  - {} has no statements,'
-                          ' so it will not be used.')
+                          ' so it will not be used.'
+                          ''.format(action.get('name')))
                     continue
-                progress_subpart_increment = 1.0 / float(len(statements))
-                progress_subpart = -progress_subpart_increment
-                for statement in statements:
-                    progress_subpart += progress_subpart_increment
-                    progress_numerator = float(index) + progress_subpart
-                    progress_f = progress_numerator / progress_max
-                    print("{}%".format(round(progress_f*100.0, 1)))
-                    cmd_parts = cmd_start.copy()
-                    src = join_action_path(action, 'source')
-                    dst = join_action_path(action, 'destination', path=tmp_dir)
-                    ignore_root = src
-                    source_parts = None
-                    if action.get('source') is not None:
-                        source_parts = split_subs()
-                        while len(source_parts) > 1:
-                            ignore_root = os.path.dirname(source_parts)
-                            source_parts = source_parts[:-1]
-                        source_parts = None
-                    echo0('* Any absolute paths in gitignore will assume'
-                          ' "{}" is the directory containing ".gitignore".'
-                          ''.format(ignore_root))
-                    include_tmp, exclude_tmp = self.get_rsync_pair(
-                        ignore_root,
-                        src,
-                    )
-                    # The FIRST pattern is matched when using rsync, so
-                    #   include must come first:
-                    if include_tmp is not None:
-                        cmd_start += ['--include-from', include_tmp]
-                    if exclude_tmp is not None:
-                        cmd_start += ['--exclude-from', exclude_tmp]
-
-                    cmd_parts.append(src+"/")
-                    cmd_parts.append(dst)
-                    sys.stderr.write('* getting "{}"...'.format(src))
-                    sys.stderr.flush()
-                    # See <https://stackoverflow.com/a/61139019/4541104>:
-                    with subprocess.Popen(
-                        cmd_parts, stdout=subprocess.PIPE, text=True,
-                    ) as process:
-                        # bufsize=1,  # allow backspace processing
-                        pass
-                        # for line in iter(process.stdout.readline, b''):
-                        #     print(line.strip())
-                    if exclude_tmp is not None:
-                        os.remove(exclude_tmp)
-                    if include_tmp is not None:
-                        os.remove(include_tmp)
-                    echo0("OK\n")
+                yield index, last_i+1, action
             else:
                 if action.get('mode') is not None:
                     raise ValueError(
@@ -1113,7 +3091,18 @@ class ANCProject:
                         ' a mode: {}'.format(action.get('mode'), VERSION_VERBS)
                     )
                 # TODO: do non-version verbs
-        return tmp_dir
+
+    def _async_limit(self):
+        '''
+        Get the semaphore that limits how many child processes and
+        filesystem walks the async methods run at once (See async_jobs).
+        '''
+        loop = asyncio.get_running_loop()
+        if (self._async_semaphore is None) or (
+                self._async_semaphore[0] is not loop):
+            jobs = self.async_jobs or os.cpu_count() or 1
+            self._async_semaphore = (loop, asyncio.Semaphore(jobs))
+        return self._async_semaphore[1]
 
 
 def main():
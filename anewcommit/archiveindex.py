@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+'''
+Build (once) and use a member index of a tar archive so one member can
+be read, or every mtime listed, without decompressing the whole archive.
+
+The index is a JSON "sidecar" file named by the archive's content hash
+(See archive_id and stat_archive_id in archivetree), normally in
+_anewcommit_cache/archive-index (See ANCProject.get_archive_tree). It
+lists each member with the offset of its data in the uncompressed tar,
+and a list of "pieces" of the compressed file that can each be
+decompressed on their own:
+
+- bz2: each compressed block (bit offsets, since blocks aren't aligned
+  to bytes).
+- xz: each block listed in the xz index (Only files made by multithreaded
+  xz, or with --block-size, have more than one).
+- gz: each gzip member (Only files made by bgzip or by concatenating
+  gzip files have more than one).
+- tar (uncompressed): the whole file, since any offset can be read
+  directly.
+
+Reading a member only decompresses from the start of the piece that
+contains the member's data. Listing members (names, sizes and mtimes)
+only reads the index.
+'''
+from __future__ import print_function
+import os
+import bz2
+import json
+import lzma
+import mmap
+import zlib
+import struct
+import bisect
+import tarfile
+import posixpath
+import tempfile
+
+from anewcommit.manifest import (
+    BLOB_CHUNK_SIZE,
+)
+
+INDEX_VERSION = 2
+# ^ 2: hard links have entries (See _list_members).
+
+BZ2_BLOCK_MAGIC = 0x314159265359
+BZ2_EOS_MAGIC = 0x177245385090
+
+XZ_MAGIC = b"\xfd7zXZ\x00"
+
+# Indices of a member in index['members']:
+I_NAME = 0
+I_MODE = 1
+I_SIZE = 2
+I_MTIME = 3
+I_OFFSET = 4
+I_LINK = 5
+
+# Indices of a piece in index['pieces']:
+P_KIND = 0
+P_START = 1
+P_END = 2
+P_OFFSET = 3
+
+
+def archive_format(path):
+    '''
+    Detect the compression of a tar file from its first bytes.
+
+    Returns:
+    "gz", "bz2", "xz" or "tar".
+    '''
+    with open(path, 'rb') as ins:
+        start = ins.read(6)
+    if start.startswith(b"\x1f\x8b"):
+        return "gz"
+    if start.startswith(b"BZh"):
+        return "bz2"
+    if start.startswith(XZ_MAGIC):
+        return "xz"
+    return "tar"
+
+
+def read_bits(data, bit, count):
+    '''
+    Read count bits (most significant first) starting at a bit offset.
+
+    Returns:
+    an int, or None if data ends first.
+    '''
+    start = bit // 8
+    byte_count = (bit % 8 + count + 7) // 8
+    if start + byte_count > len(data):
+        return None
+    value = int.from_bytes(data[start:start+byte_count], 'big')
+    return (value >> (byte_count * 8 - bit % 8 - count)) & ((1 << count) - 1)
+
+
+def find_bits(data, magic):
+    '''
+    Find every bit offset of a 48-bit magic number in data.
+    '''
+    results = []
+    for shift in range(8):
+        if shift == 0:
+            needle = magic.to_bytes(6, 'big')
+            lead = 0
+        else:
+            # Only the 5 middle bytes are whole when the magic isn't
+            # aligned, so search for those then check the rest:
+            needle = (magic << (8 - shift)).to_bytes(7, 'big')[1:6]
+            lead = 1
+        at = data.find(needle)
+        while at != -1:
+            start = at - lead
+            if start >= 0:
+                bit = start * 8 + shift
+                if read_bits(data, bit, 48) == magic:
+                    results.append(bit)
+            at = data.find(needle, at + 1)
+    return sorted(results)
+
+
+def aligned_bits(data, start, end):
+    '''
+    Copy the bits from start to end (bit offsets) to new bytes, shifted
+    so the first bit is the top of the first byte.
+    '''
+    chunk = data[start//8:(end+7)//8]
+    count = end - start
+    value = int.from_bytes(chunk, 'big')
+    value >>= len(chunk) * 8 - start % 8 - count
+    value &= (1 << count) - 1
+    length = (count + 7) // 8
+    return (value << (length * 8 - count)).to_bytes(length, 'big')
+
+
+def bz2_pieces(data):
+    '''
+    List each block of a bz2 file (including files with several bz2
+    streams) as a piece (without P_OFFSET, which needs decompression).
+    '''
+    starts = find_bits(data, BZ2_BLOCK_MAGIC)
+    bounds = sorted(starts + find_bits(data, BZ2_EOS_MAGIC))
+    bounds.append(len(data) * 8)
+    pieces = []
+    for start in starts:
+        end = bounds[bisect.bisect_right(bounds, start)]
+        pieces.append(["bz2-block", start, end])
+    return pieces
+
+
+def _xz_varint(data, at):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[at]
+        at += 1
+        value |= (byte & 0x7f) << shift
+        if not (byte & 0x80):
+            return value, at
+        shift += 7
+
+
+def xz_pieces(data):
+    '''
+    List each block of a single-stream xz file as a piece (with
+    P_OFFSET) using the index at the end of the file.
+
+    Returns:
+    a list of pieces, or None if the file isn't one xz stream.
+    '''
+    size = len(data)
+    if (size < 24) or (data[size-2:size] != b"YZ"):
+        return None
+    backward_size = (struct.unpack("<I", data[size-8:size-4])[0] + 1) * 4
+    at = size - 12 - backward_size
+    if (at < 12) or (data[at] != 0):
+        return None
+    count, at = _xz_varint(data, at + 1)
+    pieces = []
+    start = 12
+    offset = 0
+    for _ in range(count):
+        unpadded, at = _xz_varint(data, at)
+        uncompressed, at = _xz_varint(data, at)
+        end = start + unpadded
+        pieces.append(["xz-block", start, end, offset])
+        start = end + (-end % 4)
+        offset += uncompressed
+    if start != size - 12 - backward_size:
+        return None  # concatenated streams or stream padding
+    return pieces
+
+
+def iter_piece(data, piece):
+    '''
+    Decompress one piece of an archive.
+
+    Sequential arguments:
+    data -- The whole archive file (such as an mmap).
+    piece -- an item from index['pieces'].
+    '''
+    kind = piece[P_KIND]
+    start = piece[P_START]
+    end = piece[P_END]
+    if kind == "tar":
+        for at in range(start, end, BLOB_CHUNK_SIZE):
+            yield data[at:min(at + BLOB_CHUNK_SIZE, end)]
+        return
+    if kind == "bz2-block":
+        unzipper = bz2.BZ2Decompressor()
+        out = unzipper.decompress(b"BZh9" + aligned_bits(data, start, end))
+        while out:
+            yield out
+            out = unzipper.decompress(b"")
+        return
+    unzipper = _new_unzipper(kind)
+    if kind == "xz-block":
+        yield unzipper.decompress(data[0:12])  # the stream header
+    fresh = False
+    for at in range(start, end, BLOB_CHUNK_SIZE):
+        chunk = data[at:min(at + BLOB_CHUNK_SIZE, end)]
+        while chunk:
+            if fresh and (kind != "bz2") and not chunk.strip(b"\0"):
+                return  # padding after the last gzip member or xz stream
+            fresh = False
+            out = unzipper.decompress(chunk)
+            if out:
+                yield out
+            if (kind == "xz-block") or (not unzipper.eof):
+                break
+            # another gzip member, bz2 stream or xz stream may follow:
+            chunk = unzipper.unused_data
+            unzipper = _new_unzipper(kind)
+            fresh = True
+    if kind == "xz-block":
+        # The rest of the block is only decoded if asked for, since the
+        # next block isn't part of the data:
+        while not unzipper.eof:
+            out = unzipper.decompress(b"")
+            if not out:
+                break
+            yield out
+
+
+def _new_unzipper(kind):
+    if kind == "gz":
+        return zlib.decompressobj(31)
+    if kind == "bz2":
+        return bz2.BZ2Decompressor()
+    if kind in ("xz", "xz-block"):
+        return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+    raise ValueError("Unknown piece kind {}".format(kind))
+
+
+def _gz_chunks(data, pieces):
+    '''
+    Decompress a gzip file, adding each gzip member to pieces.
+    '''
+    start = 0
+    offset = 0
+    end = len(data)
+    while start < end:
+        if data[start:start+2] != b"\x1f\x8b":
+            break  # padding
+        unzipper = zlib.decompressobj(31)
+        piece = ["gz", start, None, offset]
+        at = start
+        while not unzipper.eof:
+            if at >= end:
+                raise EOFError("The gzip file ended early.")
+            chunk = data[at:min(at + BLOB_CHUNK_SIZE, end)]
+            at += len(chunk)
+            out = unzipper.decompress(chunk)
+            offset += len(out)
+            if out:
+                yield out
+        piece[P_END] = at - len(unzipper.unused_data)
+        pieces.append(piece)
+        start = piece[P_END]
+
+
+def _piece_chunks(data, planned, pieces):
+    '''
+    Decompress each planned piece, adding it to pieces with its offset.
+    '''
+    offset = 0
+    for piece in planned:
+        piece = piece[:3] + [offset]
+        for out in iter_piece(data, piece):
+            offset += len(out)
+            yield out
+        pieces.append(piece)
+
+
+class ChunkReader:
+    '''
+    Read chunks as a file (for tarfile).
+    '''
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+
+    def read(self, size=-1):
+        while (size < 0) or (len(self._buffer) < size):
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        out = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return out
+
+
+def _list_members(chunks):
+    '''
+    List the members of a tar from its uncompressed data. A hard link
+    gets a copy of its target's entry (with its own name and mtime), so
+    its data is read from the target's offset.
+    '''
+    chunks = iter(chunks)
+    members = []
+    by_name = {}
+    with tarfile.open(fileobj=ChunkReader(chunks), mode='r|') as tf:
+        for member in tf:
+            if member.issym():
+                link = member.linkname
+                size = len(link.encode("utf-8", "surrogateescape"))
+                members.append([member.name, "120000", size, member.mtime,
+                                member.offset_data, link])
+            elif member.islnk():
+                target = by_name.get(posixpath.normpath(member.linkname))
+                if target is None:
+                    continue  # The target isn't in the archive.
+                entry = list(target)
+                entry[I_NAME] = member.name
+                entry[I_MTIME] = member.mtime
+                members.append(entry)
+            elif member.isreg():
+                if member.mode & 0o100:
+                    mode = "100755"
+                else:
+                    mode = "100644"
+                members.append([member.name, mode, member.size,
+                                member.mtime, member.offset_data, None])
+            else:
+                continue
+            by_name[posixpath.normpath(member.name)] = members[-1]
+    for _ in chunks:
+        pass  # Finish so that every piece is listed.
+    return members
+
+
+def build_index(path):
+    '''
+    Read a tar archive once to list its members and pieces.
+
+    Returns:
+    a dict with the keys version, format, size, members and pieces (See
+    the module documentation and the I_ and P_ constants).
+    '''
+    fmt = archive_format(path)
+    with open(path, 'rb') as ins:
+        size = os.fstat(ins.fileno()).st_size
+        if size == 0:
+            raise ValueError('"{}" is empty.'.format(path))
+        data = mmap.mmap(ins.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pieces = []
+            if fmt == "tar":
+                pieces = [["tar", 0, size, 0]]
+                members = _list_members(iter_piece(data, pieces[0]))
+            elif fmt == "gz":
+                members = _list_members(_gz_chunks(data, pieces))
+            else:
+                planned = None
+                if fmt == "bz2":
+                    planned = bz2_pieces(data)
+                else:
+                    planned = xz_pieces(data)
+                members = None
+                if planned:
+                    try:
+                        members = _list_members(
+                            _piece_chunks(data, planned, pieces)
+                        )
+                    except (OSError, EOFError, lzma.LZMAError,
+                            tarfile.TarError):
+                        # such as a false block magic in bz2 data
+                        pieces = []
+                if members is None:
+                    pieces = []
+                    members = _list_members(_piece_chunks(
+                        data, [[fmt, 0, size]], pieces
+                    ))
+        finally:
+            data.close()
+    return {
+        'version': INDEX_VERSION,
+        'format': fmt,
+        'size': size,
+        'members': members,
+        'pieces': pieces,
+    }
+
+
+def load_index(path, index_dir, key):
+    '''
+    Load the index of an archive from index_dir, building and saving
+    it first if necessary.
+
+    Sequential arguments:
+    path -- The archive.
+    key -- The archive_id of the archive.
+    '''
+    index_path = os.path.join(index_dir, key + ".json")
+    if os.path.isfile(index_path):
+        with open(index_path, 'r') as ins:
+            index = json.load(ins)
+        if index.get('version') == INDEX_VERSION:
+            return index
+    index = build_index(path)
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    fd, tmp_path = tempfile.mkstemp(prefix="tmp-", dir=index_dir)
+    with os.fdopen(fd, 'w') as outs:
+        json.dump(index, outs)
+    os.replace(tmp_path, index_path)
+    return index
+
+
+def iter_member(path, index, member):
+    '''
+    Read a member's data, only decompressing from the start of the piece
+    that contains it.
+
+    Sequential arguments:
+    path -- The archive.
+    index -- The index of the archive (See load_index).
+    member -- an item from index['members'].
+    '''
+    if member[I_LINK] is not None:
+        yield member[I_LINK].encode("utf-8", "surrogateescape")
+        return
+    pieces = index['pieces']
+    offsets = [piece[P_OFFSET] for piece in pieces]
+    first = max(0, bisect.bisect_right(offsets, member[I_OFFSET]) - 1)
+    skip = member[I_OFFSET] - pieces[first][P_OFFSET]
+    left = member[I_SIZE]
+    if left == 0:
+        return
+    with open(path, 'rb') as ins:
+        data = mmap.mmap(ins.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if pieces[first][P_KIND] == "tar":
+                start = member[I_OFFSET]
+                piece = ["tar", start, start + left, start]
+                for chunk in iter_piece(data, piece):
+                    yield chunk
+                return
+            for piece in pieces[first:]:
+                for out in iter_piece(data, piece):
+                    if skip >= len(out):
+                        skip -= len(out)
+                        continue
+                    out = out[skip:skip+left]
+                    skip = 0
+                    left -= len(out)
+                    yield out
+                    if left == 0:
+                        return
+        finally:
+            data.close()
+    raise EOFError("The archive ended before the end of {}"
+                   "".format(member[I_NAME]))
@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+'''
+Read the members of a tar (optionally gz, bz2 or xz compressed) or zip
+archive as if they were files in a directory, without extracting the
+archive to disk.
+
+Tar archives are read as a stream (in one pass from start to end), so
+reading the whole tree costs one decompression and memory use doesn't
+depend on the size of the archive (each member is read in pieces of
+BLOB_CHUNK_SIZE).
+
+Paths in the tree are relative, use "/", and never start with "./" (See
+normalize_member). Like manifest.py, modes are git tree modes such as
+"100644" and times are in seconds since the epoch.
+'''
+from __future__ import print_function
+import os
+import json
+import time
+import shutil
+import hashlib
+import tarfile
+import zipfile
+import tempfile
+
+from anewcommit.archiveindex import (
+    I_MODE,
+    I_MTIME,
+    I_NAME,
+    I_SIZE,
+    iter_member,
+    load_index,
+)
+
+from anewcommit.manifest import (
+    BLOB_CHUNK_SIZE,
+    scan_manifest,
+)
+
+ARCHIVE_EXTENSIONS = [".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz",
+                      ".txz", ".tar", ".zip"]
+
+A_MODE = 0
+A_SIZE = 1
+A_MTIME = 2
+
+
+def strip_archive_ext(name):
+    for ext in ARCHIVE_EXTENSIONS:
+        if name.lower().endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def is_archive(path):
+    '''
+    Check whether path is a file with a known archive extension.
+    '''
+    if strip_archive_ext(path) == path:
+        return False
+    return os.path.isfile(path)
+
+
+def normalize_member(name):
+    '''
+    Convert a member name such as "./a/b" or "/a/b" to "a/b".
+    '''
+    parts = [part for part in name.replace("\\", "/").split("/")
+             if part not in ("", ".")]
+    if ".." in parts:
+        raise ValueError('"{}" is outside of the archive.'.format(name))
+    return "/".join(parts)
+
+
+def member_mode(mode):
+    '''
+    Get the git tree mode of a regular file from its permission bits.
+    '''
+    if mode & 0o100:
+        return "100755"
+    return "100644"
+
+
+def _iter_reader(ins, size=None):
+    got = 0
+    while True:
+        chunk = ins.read(BLOB_CHUNK_SIZE)
+        if not chunk:
+            break
+        got += len(chunk)
+        yield chunk
+    if (size is not None) and (got != size):
+        raise RuntimeError("The member was {} bytes instead of {}."
+                           "".format(got, size))
+
+
+def strip_single_root(files):
+    '''
+    If every path in the dict files is under one directory, remove that
+    directory from every path (like auto_sub in extract).
+    '''
+    roots = set(path.split("/", 1)[0] for path in files)
+    if len(roots) != 1:
+        return files
+    if any("/" not in path for path in files):
+        return files
+    return dict((path.split("/", 1)[1], value)
+                for path, value in files.items())
+
+
+def _hard_link_entry(members, member):
+    '''
+    Get the (mode, size, mtime) of a tar hard link member from the entry
+    of its target in members, or None if the target isn't there (A tar
+    hard link always comes after its target).
+    '''
+    target = members.get(normalize_member(member.linkname))
+    if target is None:
+        return None
+    return target[A_MODE], target[A_SIZE], member.mtime
+
+
+def single_root(paths):
+    '''
+    Get the directory that contains everything if there is exactly one
+    item at the top of the archive and it is a directory, otherwise None.
+
+    Sequential arguments:
+    paths -- The (normalized) member paths of files.
+    '''
+    root = None
+    for path in paths:
+        parts = path.split("/", 1)
+        if len(parts) < 2:
+            return None
+        if root is None:
+            root = parts[0]
+        elif parts[0] != root:
+            return None
+    return root
+
+
+class ArchiveTree:
+    '''
+    Present an archive file as a read-only directory tree.
+
+    Only regular files, symlinks and hard links are members of the tree
+    (Directories are implied by the paths, like in git). A hard link has
+    the mode, size and data of its target.
+
+    If index_dir is set, a member index of a tar archive is kept there
+    (See archiveindex), so after the first time, listing members needs no
+    decompression and reading one member only decompresses part of the
+    archive. A zip archive already has a central directory, so it
+    doesn't need one.
+    '''
+    def __init__(self, path, index_dir=None):
+        self.path = path
+        self.index_dir = index_dir
+        self.is_zip = path.lower().endswith(".zip")
+        self._members = None
+        self._index = None
+        self._indexed = None
+
+    def _get_index(self):
+        '''
+        Load (or build) the member index if index_dir is set.
+
+        Returns:
+        a dict where each key is a relative path and each value is an item
+        from the index's 'members', or None if there is no index.
+        '''
+        if self.is_zip or (self.index_dir is None):
+            return None
+        if self._indexed is None:
+            self._index = load_index(self.path, self.index_dir,
+                                     stat_archive_id(self.path,
+                                                     self.index_dir))
+            indexed = {}
+            for member in self._index['members']:
+                indexed[normalize_member(member[I_NAME])] = member
+            self._indexed = indexed
+        return self._indexed
+
+    def _zip_info(self, info):
+        unix_mode = info.external_attr >> 16
+        mtime = time.mktime(info.date_time + (0, 0, -1))
+        if (unix_mode & 0o170000) == 0o120000:
+            return "120000", info.file_size, mtime
+        return member_mode(unix_mode), info.file_size, mtime
+
+    def walk(self):
+        '''
+        Read every file in the archive in the order they are stored
+        (except that hard links in a tar come last, since their data is
+        read again in a second pass).
+
+        Returns:
+        (yields) a tuple (rel, mode, size, mtime, chunks) for each file
+        where chunks is an iterator of bytes that is only valid until the
+        next tuple (For a symlink, the data is the target).
+        '''
+        members = {}
+        if self.is_zip:
+            with zipfile.ZipFile(self.path) as zf:
+                for info in zf.infolist():
+                    if info.is_dir():
+                        continue
+                    rel = normalize_member(info.filename)
+                    mode, size, mtime = self._zip_info(info)
+                    members[rel] = (mode, size, mtime)
+                    with zf.open(info) as ins:
+                        yield rel, mode, size, mtime, _iter_reader(ins, size)
+            self._members = members
+            return
+        links = {}
+        link_targets = {}
+        with tarfile.open(self.path, 'r|*') as tf:
+            for member in tf:
+                rel = normalize_member(member.name)
+                if member.issym():
+                    data = member.linkname.encode("utf-8", "surrogateescape")
+                    members[rel] = ("120000", len(data), member.mtime)
+                    yield rel, "120000", len(data), member.mtime, iter([data])
+                elif member.islnk():
+                    entry = _hard_link_entry(members, member)
+                    if entry is None:
+                        continue
+                    members[rel] = entry
+                    target = normalize_member(member.linkname)
+                    target = link_targets.get(target, target)
+                    # ^ a link to a link reads the same data
+                    link_targets[rel] = target
+                    links.setdefault(target, []).append((rel, member.mtime))
+                elif member.isreg():
+                    mode = member_mode(member.mode)
+                    members[rel] = (mode, member.size, member.mtime)
+                    ins = tf.extractfile(member)
+                    yield (rel, mode, member.size, member.mtime,
+                           _iter_reader(ins, member.size))
+        if links:
+            for item in self._walk_links(links):
+                yield item
+        self._members = members
+
+    def _walk_links(self, links):
+        '''
+        Read the targets of the hard links in a tar again (A tar stream
+        can't go back to data that was already read).
+
+        Sequential arguments:
+        links -- a dict where each key is the relative path of a target
+            and each value is a list of (rel, mtime) for its links.
+
+        Returns:
+        (yields) the same tuples as walk, for each link.
+        '''
+        with tarfile.open(self.path, 'r|*') as tf:
+            for member in tf:
+                copies = links.pop(normalize_member(member.name), None)
+                if copies is None:
+                    continue
+                if member.issym():
+                    data = member.linkname.encode("utf-8", "surrogateescape")
+                    for rel, mtime in copies:
+                        yield rel, "120000", len(data), mtime, iter([data])
+                elif member.isreg():
+                    mode = member_mode(member.mode)
+                    with tempfile.SpooledTemporaryFile(
+                            max_size=BLOB_CHUNK_SIZE) as spool:
+                        # ^ so several links can read it
+                        shutil.copyfileobj(tf.extractfile(member), spool)
+                        for rel, mtime in copies:
+                            spool.seek(0)
+                            yield (rel, mode, member.size, mtime,
+                                   _iter_reader(spool, member.size))
+                if not links:
+                    break
+
+    def members(self):
+        '''
+        List the files in the archive (Only the first call reads the
+        archive, and not at all if walk already finished).
+
+        Returns:
+        a dict where each key is a relative path and each value is
+        a tuple (mode, size, mtime) (Use A_MODE, A_SIZE, A_MTIME).
+        '''
+        if self._members is not None:
+            return self._members
+        members = {}
+        indexed = self._get_index()
+        if indexed is not None:
+            for rel, member in indexed.items():
+                members[rel] = (member[I_MODE], member[I_SIZE],
+                                member[I_MTIME])
+        elif self.is_zip:
+            with zipfile.ZipFile(self.path) as zf:
+                for info in zf.infolist():
+                    if info.is_dir():
+                        continue
+                    members[normalize_member(info.filename)] = \
+                        self._zip_info(info)
+        else:
+            with tarfile.open(self.path, 'r|*') as tf:
+                for member in tf:
+                    if member.issym():
+                        data = member.linkname.encode("utf-8",
+                                                      "surrogateescape")
+                        members[normalize_member(member.name)] = (
+                            "120000", len(data), member.mtime
+                        )
+                    elif member.islnk():
+                        entry = _hard_link_entry(members, member)
+                        if entry is not None:
+                            members[normalize_member(member.name)] = entry
+                    elif member.isreg():
+                        members[normalize_member(member.name)] = (
+                            member_mode(member.mode), member.size,
+                            member.mtime
+                        )
+        self._members = members
+        return members
+
+    def single_root(self):
+        '''
+        Get the only top directory of the archive or None (See
+        single_root).
+        '''
+        return single_root(self.members().keys())
+
+    def iter_chunks(self, rel):
+        '''
+        Read one file from the archive in pieces.
+        '''
+        indexed = self._get_index()
+        if indexed is not None:
+            if rel not in indexed:
+                raise KeyError('There is no "{}" in "{}"'
+                               ''.format(rel, self.path))
+            for chunk in iter_member(self.path, self._index, indexed[rel]):
+                yield chunk
+            return
+        if self.is_zip:
+            with zipfile.ZipFile(self.path) as zf:
+                for info in zf.infolist():
+                    if info.is_dir():
+                        continue
+                    if normalize_member(info.filename) != rel:
+                        continue
+                    with zf.open(info) as ins:
+                        for chunk in _iter_reader(ins, info.file_size):
+                            yield chunk
+                    return
+        else:
+            for got, mode, size, mtime, chunks in self.walk():
+                if got == rel:
+                    for chunk in chunks:
+                        yield chunk
+                    return
+        raise KeyError('There is no "{}" in "{}"'.format(rel, self.path))
+
+    def read(self, rel):
+        return b"".join(self.iter_chunks(rel))
+
+    def newest(self, too_new=None):
+        '''
+        Get the newest file in the archive.
+
+        Keyword arguments:
+        too_new -- skip files with an mtime >= too_new if not None.
+
+        Returns:
+        a tuple (rel, mtime), or (None, None) if there is no such file.
+        '''
+        path = None
+        newest = None
+        for rel, entry in self.members().items():
+            mtime = entry[A_MTIME]
+            if (too_new is not None) and (mtime >= too_new):
+                continue
+            if (newest is None) or (mtime > newest):
+                newest = mtime
+                path = rel
+        return path, newest
+
+    def manifest(self):
+        '''
+        Get a manifest of the archive in the same format as scan_manifest
+        (in one pass, hashing each member as it is decompressed).
+        '''
+        manifest = {}
+        for rel, mode, size, mtime, chunks in self.walk():
+            sha = hashlib.sha1(b"blob %d\0" % size)
+            for chunk in chunks:
+                sha.update(chunk)
+            manifest[rel] = [mode, size, int(mtime * 1000000000),
+                             sha.hexdigest()]
+        return manifest
+
+
+def tree_manifest(path, old=None):
+    '''
+    Get the manifest of a directory or an archive (See scan_manifest and
+    ArchiveTree.manifest), so two of either can be compared with
+    diff_manifests.
+
+    Keyword arguments:
+    old -- A previous manifest of the same directory (so unchanged files
+        aren't hashed again). It isn't used for archives.
+    '''
+    if os.path.isdir(path):
+        return scan_manifest(path, [path], old=old)[0]
+    return ArchiveTree(path).manifest()
+
+
+def archive_id(path):
+    '''
+    Get the SHA-1 of an archive file's content (so copies of the same
+    archive in different versions are recognized).
+    '''
+    sha = hashlib.sha1()
+    with open(path, 'rb') as ins:
+        while True:
+            chunk = ins.read(BLOB_CHUNK_SIZE)
+            if not chunk:
+                break
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def stat_archive_id(path, index_dir):
+    '''
+    Get the archive_id of an archive without reading it if its size and
+    mtime are the same as last time. The id of each archive path is kept
+    in index_dir/ids/ in a file named by the SHA-1 of the absolute path.
+    '''
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = [stat.st_size, stat.st_mtime_ns]
+    ids_dir = os.path.join(index_dir, "ids")
+    id_path = os.path.join(
+        ids_dir,
+        hashlib.sha1(path.encode("utf-8", "surrogateescape")).hexdigest()
+        + ".json",
+    )
+    if os.path.isfile(id_path):
+        with open(id_path, 'r') as ins:
+            cached = json.load(ins)
+        if (cached.get('path') == path) and (cached.get('stat') == key):
+            return cached['id']
+    result = archive_id(path)
+    if not os.path.isdir(ids_dir):
+        os.makedirs(ids_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix="tmp-", dir=ids_dir)
+    with os.fdopen(fd, 'w') as outs:
+        json.dump({'path': path, 'stat': key, 'id': result}, outs)
+    os.replace(tmp_path, id_path)
+    return result
+
+
+def extract_tree(src_file, dst_dir):
+    '''
+    Write every file of an archive into dst_dir as-is, with its mode and
+    mtime (Members can't be written through a symlink in the archive).
+    '''
+    links = set()
+    for rel, mode, size, mtime, chunks in ArchiveTree(src_file).walk():
+        parts = rel.split("/")
+        for count in range(1, len(parts)):
+            if "/".join(parts[:count]) in links:
+                raise ValueError('"{}" in "{}" is under a symlink.'
+                                 ''.format(rel, src_file))
+        path = os.path.join(dst_dir, *parts)
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        if os.path.lexists(path):
+            os.remove(path)  # A later member with the same path wins.
+        if mode == "120000":
+            target = b"".join(chunks).decode("utf-8", "surrogateescape")
+            os.symlink(target, path)
+            links.add(rel)
+            continue
+        with open(path, 'wb') as outs:
+            for chunk in chunks:
+                outs.write(chunk)
+        if mode == "100755":
+            os.chmod(path, 0o755)
+        else:
+            os.chmod(path, 0o644)
+        os.utime(path, (mtime, mtime))
+
+
+def cache_archive(job):
+    '''
+    Extract an archive into the extraction cache unless it is already
+    there (This may run in a worker process).
+
+    Sequential arguments:
+    job -- a tuple (src_file, cache_dir, key) where key is the
+        archive_id of src_file.
+
+    Returns:
+    the cached directory, named key.
+    '''
+    src_file, cache_dir, key = job
+    cached = os.path.join(cache_dir, key)
+    if os.path.isdir(cached):
+        return cached
+    tmp = tempfile.mkdtemp(prefix="tmp-" + key, dir=cache_dir)
+    try:
+        extract_tree(src_file, tmp)
+    except BaseException:
+        shutil.rmtree(tmp)
+        raise
+    try:
+        os.rename(tmp, cached)
+    except OSError:
+        if not os.path.isdir(cached):
+            raise
+        # Another process finished the same archive first.
+        shutil.rmtree(tmp)
+    return cached
+
+
+def link_tree(src_dir, dst_dir):
+    '''
+    Recreate a directory tree using hard links to the files where
+    possible (otherwise copies). The files are shared with src_dir, so
+    a program that edits a file in place changes both.
+    '''
+    for parent, dirs, files in os.walk(src_dir):
+        rel = os.path.relpath(parent, src_dir)
+        dst_parent = dst_dir
+        if rel != ".":
+            dst_parent = os.path.join(dst_dir, rel)
+        if not os.path.isdir(dst_parent):
+            os.makedirs(dst_parent)
+        names = files + [name for name in dirs
+                         if os.path.islink(os.path.join(parent, name))]
+        for name in names:
+            src = os.path.join(parent, name)
+            dst = os.path.join(dst_parent, name)
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), dst)
+                continue
+            try:
+                os.link(src, dst)
+            except FileExistsError:
+                raise
+            except OSError:
+                # such as if dst_dir is on a different device
+                shutil.copy2(src, dst)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+'''
+Hash and compress blobs in several processes and write them to a git
+repository as loose objects, so that git fast-import only has to
+reference them (Otherwise fast-import compresses every blob on one core).
+
+Workers read each file in pieces (See iter_blob_chunks), so memory use
+doesn't depend on the size of the files: Small results are sent back to
+the writer, and results larger than POOL_INLINE_MAX are written by the
+worker to a temporary file in the objects directory. The writer (the
+process that owns the BlobPool) moves each object into place in the
+order the files were given.
+'''
+from __future__ import print_function
+import os
+import zlib
+import hashlib
+import tempfile
+import subprocess
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from anewcommit.manifest import (
+    iter_blob_chunks,
+)
+
+POOL_INLINE_MAX = 1024 * 1024
+# ^ Compressed blobs up to this size are returned from the worker
+#   (larger ones are written to a temporary file by the worker).
+
+LOOSE_COMPRESSION = 1
+# ^ the default core.looseCompression of git (Z_BEST_SPEED).
+
+
+def git_objects_dir(repo_dir, git="git"):
+    '''
+    Get the absolute path of the objects directory of a repository.
+    '''
+    out = subprocess.check_output(
+        [git, "rev-parse", "--git-path", "objects"],
+        cwd=repo_dir,
+    ).decode("utf-8").strip()
+    return os.path.abspath(os.path.join(repo_dir, out))
+
+
+def blob_size(path, mode):
+    if mode == "120000":
+        return len(os.readlink(path).encode("utf-8", "surrogateescape"))
+    return os.path.getsize(path)
+
+
+def compress_blob(job):
+    '''
+    Hash and compress one file as a git blob (This runs in a worker
+    process).
+
+    Sequential arguments:
+    job -- a tuple (path, mode, objects_dir, level).
+
+    Returns:
+    a tuple (sha, size, data, tmp_path) where either data is the
+    compressed object or tmp_path is a temporary file containing it.
+    '''
+    path, mode, objects_dir, level = job
+    size = blob_size(path, mode)
+    header = b"blob %d\0" % size
+    sha = hashlib.sha1(header)
+    zipper = zlib.compressobj(level)
+    parts = [zipper.compress(header)]
+    pending = len(parts[0])
+    outs = None
+    tmp_path = None
+    got = 0
+    try:
+        for chunk in iter_blob_chunks(path, mode):
+            got += len(chunk)
+            sha.update(chunk)
+            parts.append(zipper.compress(chunk))
+            pending += len(parts[-1])
+            if (outs is None) and (pending > POOL_INLINE_MAX):
+                fd, tmp_path = tempfile.mkstemp(prefix="tmp_obj_",
+                                                dir=objects_dir)
+                outs = os.fdopen(fd, 'wb')
+            if outs is not None:
+                outs.write(b"".join(parts))
+                parts = []
+        parts.append(zipper.flush())
+        if got != size:
+            raise RuntimeError('"{}" changed while it was read ({} bytes'
+                               ' instead of {})'.format(path, got, size))
+        if outs is not None:
+            outs.write(b"".join(parts))
+            outs.close()
+            outs = None
+            return sha.hexdigest(), size, None, tmp_path
+    except BaseException:
+        if outs is not None:
+            outs.close()
+        if tmp_path is not None:
+            os.remove(tmp_path)
+        raise
+    return sha.hexdigest(), size, b"".join(parts), None
+
+
+def write_loose_object(objects_dir, sha, data=None, tmp_path=None):
+    '''
+    Move a compressed object into place unless the object already
+    exists.
+
+    Returns:
+    True if the object was written, otherwise False.
+    '''
+    sub_dir = os.path.join(objects_dir, sha[:2])
+    path = os.path.join(sub_dir, sha[2:])
+    if os.path.exists(path):
+        if tmp_path is not None:
+            os.remove(tmp_path)
+        return False
+    if not os.path.isdir(sub_dir):
+        os.makedirs(sub_dir, exist_ok=True)
+    if tmp_path is None:
+        fd, tmp_path = tempfile.mkstemp(prefix="tmp_obj_", dir=objects_dir)
+        with os.fdopen(fd, 'wb') as outs:
+            outs.write(data)
+    os.chmod(tmp_path, 0o444)
+    os.replace(tmp_path, path)
+    return True
+
+
+class BlobPool:
+    '''
+    Write blobs to a repository using a pool of worker processes.
+
+    Public Attributes:
+    objects_dir -- The objects directory of the repository.
+    written -- The number of objects written (not counting objects that
+        already existed).
+    '''
+    def __init__(self, repo_dir, jobs=None, git="git",
+                 level=LOOSE_COMPRESSION, queue_size=None):
+        '''
+        Keyword arguments:
+        jobs -- The number of worker processes (None for one per CPU).
+        queue_size -- The number of files that may be in progress at
+            once (default: 2 per worker).
+        '''
+        self.objects_dir = git_objects_dir(repo_dir, git=git)
+        self.level = level
+        self.jobs = jobs
+        if self.jobs is None:
+            self.jobs = os.cpu_count() or 1
+        self.queue_size = queue_size
+        if self.queue_size is None:
+            self.queue_size = self.jobs * 2
+        self.written = 0
+        self._executor = ProcessPoolExecutor(max_workers=self.jobs)
+
+    def store(self, items):
+        '''
+        Hash, compress and write files as blobs.
+
+        Sequential arguments:
+        items -- an iterable of (key, path, mode) tuples.
+
+        Returns:
+        (yields) a tuple (key, sha, size) for each item in the same order
+        as items.
+        '''
+        in_flight = deque()
+        items = iter(items)
+        while True:
+            while len(in_flight) < self.queue_size:
+                try:
+                    key, path, mode = next(items)
+                except StopIteration:
+                    break
+                job = (path, mode, self.objects_dir, self.level)
+                in_flight.append(
+                    (key, self._executor.submit(compress_blob, job))
+                )
+            if len(in_flight) == 0:
+                return
+            key, future = in_flight.popleft()
+            sha, size, data, tmp_path = future.result()
+            if write_loose_object(self.objects_dir, sha, data=data,
+                                  tmp_path=tmp_path):
+                self.written += 1
+            yield key, sha, size
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+'''
+Process an anewcommit project without the GUI (such as on a server),
+using the same ANCProject methods as the GUI so the project file and
+results are the same.
+
+Progress and results are written to standard output as JSON, one
+object per line, where 'event' is "progress", "result", "done" or
+"error" (Log messages go to standard error).
+
+Examples:
+anewcommit-cli scan VERSIONS  # make VERSIONS/anewcommit.json
+anewcommit-cli --jobs 8 mark-dates --before 2022-01-01 VERSIONS
+anewcommit-cli add-statement --where-applicable VERSIONS \\
+    'use "Primary Site" as www'
+anewcommit-cli --jobs 4 build-cache VERSIONS
+anewcommit-cli --jobs 4 commit VERSIONS repo
+'''
+from __future__ import print_function
+import sys
+import os
+import json
+import time
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dateutil import tz
+
+from anewcommit import (
+    echo0,
+    set_verbosity,
+    ANCProject,
+    DATE_FMT,
+    VERSION_VERBS,
+)
+
+from anewcommit.gitexport import (
+    DEFAULT_BRANCH,
+    commit_project,
+)
+
+PROJECT_NAME = "anewcommit.json"
+
+
+def emit(event, command, **kwargs):
+    '''
+    Write one line of machine-readable output.
+    '''
+    kwargs['event'] = event
+    kwargs['command'] = command
+    sys.stdout.write(json.dumps(kwargs, sort_keys=True) + "\n")
+    sys.stdout.flush()
+
+
+def new_project():
+    '''
+    Make a project that saves the same way as in the GUI (so the GUI
+    can undo changes made here).
+    '''
+    project = ANCProject()
+    project.journaled = True
+    project.persist_undo = True
+    return project
+
+
+def load_project(path):
+    '''
+    Load a project from a project file, or from the anewcommit.json in
+    a directory.
+    '''
+    if os.path.isdir(path):
+        path = os.path.join(path, PROJECT_NAME)
+    if not os.path.isfile(path):
+        raise ValueError('There is no "{}"'.format(path))
+    project = new_project()
+    result, err = project.load(path)
+    if not result:
+        raise ValueError('"{}" could not be loaded: {}'.format(path, err))
+    if err is not None:
+        echo0(err)
+        project.save()  # Keep the repaired luids (as the GUI does).
+    for error in project.statement_errors:
+        echo0("Error: {}".format(error))
+    return project
+
+
+def check_versions(project, luids):
+    for luid in luids:
+        action = project.get_action(luid)
+        if action is None:
+            raise ValueError("There is no '{}' {}".format('luid', luid))
+        if action['verb'] not in VERSION_VERBS:
+            raise ValueError("{} is not a source (verb={})"
+                             "".format(luid, action['verb']))
+
+
+def do_scan(args):
+    project = new_project()
+    actions = project.add_versions_in(args.versions_dir)
+    project.flush()
+    for action in actions:
+        emit("result", args.command, luid=action['luid'],
+             name=action['name'], path=action['path'])
+    return {'path': project.path, 'versions': len(actions)}
+
+
+def do_mark_dates(args):
+    project = load_project(args.project)
+    too_new_dt = None
+    if args.before:
+        too_new_dt = datetime.strptime(args.before, DATE_FMT)
+        too_new_dt = too_new_dt.replace(tzinfo=tz.tzlocal())
+    luids = args.luid or None
+    if luids is not None:
+        check_versions(project, luids)
+
+    def progress(done, count, luid):
+        emit("progress", args.command, done=done, count=count, luid=luid)
+
+    results = project.mark_dates(too_new_dt=too_new_dt, luids=luids,
+                                 jobs=args.jobs, progress=progress)
+    project.flush()
+    for luid, newest_path, date_str in results:
+        emit("result", args.command, luid=luid, newest_path=newest_path,
+             date=date_str)
+    return {'versions': len(results)}
+
+
+def do_add_statement(args):
+    project = load_project(args.project)
+    luids = args.luid or None
+    if luids is not None:
+        check_versions(project, luids)
+    if args.where_applicable:
+        luids = project.find_applicable(args.statement, luids=luids)
+    elif luids is None:
+        luids = project.version_luids()
+    added = project.append_statement_many(luids, args.statement)
+    project.flush()
+    for luid in added:
+        emit("result", args.command, luid=luid)
+    return {'applicable': len(luids), 'added': len(added)}
+
+
+def do_build_cache(args):
+    project = load_project(args.project)
+    luids = args.luid
+    if not luids:
+        luids = [action['luid'] for action in project._actions
+                 if (action['verb'] in VERSION_VERBS)
+                 and (action.get('commit') is True)][-1:]
+        # ^ Each cache has every version up to its own, so the last one
+        #   has them all (Building one per version would sync the first
+        #   version once for each).
+    check_versions(project, luids)
+    project.get_cached_dir("commits")
+    # ^ Make it before the threads do.
+    count = len(luids)
+    done = 0
+
+    def quiet(index, steps):
+        pass  # Only whole versions are reported (They finish in any order).
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        # ^ Threads are enough since the copying is done by rsync.
+        futures = {}
+        for luid in luids:
+            future = executor.submit(project.generate_cache, luid,
+                                     progress=quiet)
+            futures[future] = luid
+        for future in as_completed(futures):
+            done += 1
+            emit("progress", args.command, done=done, count=count,
+                 luid=futures[future], path=future.result())
+    return {'versions': count}
+
+
+def do_commit(args):
+    project = load_project(args.project)
+    commits = commit_project(project, args.repo_dir, branch=args.branch,
+                             ident=args.ident,
+                             materialize=not args.no_materialize,
+                             jobs=args.jobs or os.cpu_count() or 1,
+                             pack=args.pack)
+    return {'commits': commits}
+
+
+def add_project_arg(parser):
+    parser.add_argument(
+        "project",
+        help="The project directory or its {}".format(PROJECT_NAME),
+    )
+
+
+def add_luid_arg(parser, help):
+    parser.add_argument("--luid", action="append", default=[], help=help)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog="anewcommit-cli",
+        description="Process an anewcommit project without the GUI.",
+    )
+    parser.add_argument("--jobs", type=int, default=None,
+                        help=("The maximum number of workers (default: one"
+                              " per CPU)."))
+    parser.add_argument("--verbose", action="store_true",
+                        help="Show more debug output.")
+    parser.add_argument("--debug", action="store_true",
+                        help="Show all debug output.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    sub = subparsers.add_parser(
+        "scan",
+        help=("Make a new project where each directory in versions_dir"
+              " is a version."),
+    )
+    sub.add_argument("versions_dir")
+    sub.set_defaults(func=do_scan)
+
+    sub = subparsers.add_parser(
+        "mark-dates",
+        help="Mark each version with the date of its newest file.",
+    )
+    add_project_arg(sub)
+    sub.add_argument("--before", default=None,
+                     help=("Ignore files from this date (YYYY-MM-DD, local"
+                           " time) on."))
+    add_luid_arg(sub, "Only mark this version (can be repeated).")
+    sub.set_defaults(func=do_mark_dates)
+
+    sub = subparsers.add_parser(
+        "add-statement",
+        help="Add a statement such as 'use \"Primary Site\" as www'.",
+    )
+    add_project_arg(sub)
+    sub.add_argument("statement")
+    sub.add_argument("--where-applicable", action="store_true",
+                     help=("Only add it to versions that contain the source"
+                           " of the statement."))
+    add_luid_arg(sub, "Only add it to this version (can be repeated).")
+    sub.set_defaults(func=do_add_statement)
+
+    sub = subparsers.add_parser(
+        "build-cache",
+        help=("Sync versions into _anewcommit_cache/commits (each up to"
+              " the version)."),
+    )
+    add_project_arg(sub)
+    add_luid_arg(sub, ("Build the cache of this version (can be repeated;"
+                       " default: the last committed version)."))
+    sub.set_defaults(func=do_build_cache)
+
+    sub = subparsers.add_parser(
+        "commit",
+        help="Commit every committed version to a git repository.",
+    )
+    add_project_arg(sub)
+    sub.add_argument("repo_dir")
+    sub.add_argument("--branch", default=DEFAULT_BRANCH)
+    sub.add_argument("--ident", default=None,
+                     help='The committer such as "Name <email>".')
+    sub.add_argument("--no-materialize", action="store_true",
+                     help=("Build each commit from the manifest of the"
+                           " version instead of copying it."))
+    sub.add_argument("--pack", action="store_true",
+                     help="Write new blobs to a delta-compressed pack.")
+    sub.set_defaults(func=do_commit)
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    if args.debug:
+        set_verbosity(2)
+    elif args.verbose:
+        set_verbosity(1)
+    start = time.time()
+    try:
+        summary = args.func(args)
+    except (ValueError, RuntimeError, OSError) as ex:
+        emit("error", args.command, message=str(ex),
+             seconds=round(time.time() - start, 3))
+        return 1
+    emit("done", args.command, seconds=round(time.time() - start, 3),
+         **summary)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
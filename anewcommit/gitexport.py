@@ -0,0 +1,908 @@
+#!/usr/bin/env python
+'''
+Commit the versions of an anewcommit project to a git repository by
+streaming them into a single "git fast-import" process.
+
+Only blobs that changed since the previous version are sent, and each
+commit only lists the paths that changed (so a history of hundreds of
+snapshots imports in one process instead of one checkout, add and commit
+per version).
+'''
+from __future__ import print_function
+import os
+import json
+import hashlib
+import shutil
+import tarfile
+import subprocess
+from datetime import datetime, timezone
+
+from anewcommit import (
+    echo0,
+    echo1,
+    VERSION_VERBS,
+)
+
+from anewcommit.blobpool import (
+    BlobPool,
+)
+
+from anewcommit.packwriter import (
+    DEFAULT_DEPTH,
+    PackWriter,
+)
+
+from anewcommit.manifest import (
+    BLOB_CHUNK_SIZE,
+    M_MTIME,
+    git_blob_id,
+    iter_blob_chunks,
+    manifest_tree,
+    walk_files,
+)
+
+INLINE_BLOB_MAX = 16 * 1024 * 1024
+# ^ Files up to this size are read once and kept in memory until sent
+#   (larger files are read once to hash and again to send).
+
+DEFAULT_BRANCH = "main"
+
+JOURNAL_NAME = "anewcommit-commits.jsonl"
+
+KEY_FIELDS = ['luid', 'verb', 'path', 'mode', 'name', 'date', 'statements',
+              'commit']
+# ^ Fields of an action that affect its commit (Others such as 'manifest'
+#   are derived from the version, which is assumed not to change).
+
+
+def read_blob(path, mode):
+    '''
+    Get the blob data for a file (or the target of a symlink) if the
+    file is small enough to keep in memory, otherwise None.
+
+    Returns:
+    a tuple (sha, size, data) where data is None if the file is larger
+    than INLINE_BLOB_MAX (use iter_blob_chunks to send it).
+    '''
+    if mode == "120000":
+        data = os.readlink(path).encode("utf-8", "surrogateescape")
+        return git_blob_id(data), len(data), data
+    size = os.path.getsize(path)
+    if size <= INLINE_BLOB_MAX:
+        with open(path, 'rb') as ins:
+            data = ins.read()
+        return git_blob_id(data), len(data), data
+    sha = hashlib.sha1(b"blob %d\0" % size)
+    with open(path, 'rb') as ins:
+        while True:
+            chunk = ins.read(BLOB_CHUNK_SIZE)
+            if not chunk:
+                break
+            sha.update(chunk)
+    return sha.hexdigest(), size, None
+
+
+def quote_path(path):
+    '''
+    Quote a path for a fast-import command if necessary (C-style quoting
+    is mandatory if the path starts with a double quote or contains LF).
+    '''
+    if ('"' not in path) and ("\n" not in path) and ("\\" not in path):
+        return path
+    return '"{}"'.format(
+        path.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    )
+
+
+def walk_tree(root):
+    '''
+    Get every file git can store under root.
+
+    Returns:
+    a dict where each key is a relative path using "/" and each value
+    is a tuple (mode, signature, abs_path) where signature is
+    (size, mtime_ns) so unchanged files can be detected without reading
+    them.
+    '''
+    results = {}
+    for rel, path, mode, st in walk_files(root):
+        results[rel] = (mode, (st.st_size, st.st_mtime_ns), path)
+    return results
+
+
+def git_ident(repo_dir, git="git"):
+    '''
+    Get the "Name <email>" part of the committer identity that git
+    would use in repo_dir.
+    '''
+    out = subprocess.check_output(
+        [git, "var", "GIT_COMMITTER_IDENT"],
+        cwd=repo_dir,
+    ).decode("utf-8").strip()
+    # ^ such as "Name <email> 1657152901 -0400"
+    return out[:out.rindex(">")+1]
+
+
+def ensure_repo(repo_dir, git="git"):
+    '''
+    Create a git repository at repo_dir unless it is already one.
+    '''
+    if os.path.exists(os.path.join(repo_dir, ".git")):
+        return False
+    if os.path.isfile(os.path.join(repo_dir, "HEAD")):
+        return False  # bare
+    subprocess.check_call([git, "init", "-q", repo_dir])
+    return True
+
+
+def ref_exists(repo_dir, ref, git="git"):
+    code = subprocess.call(
+        [git, "rev-parse", "--verify", "-q", ref],
+        cwd=repo_dir,
+        stdout=subprocess.DEVNULL,
+    )
+    return code == 0
+
+
+class FastImportStream:
+    '''
+    Write blobs and commits to a "git fast-import" process.
+
+    Blobs are referred to by their SHA-1 (See git_blob_id) rather than
+    marks, so a blob is never sent twice and objects that already exist
+    in the repository can be used without sending them. Commits get
+    marks so later commits can name their parent before the import is
+    finished.
+    '''
+    def __init__(self, repo_dir, git="git", force=False):
+        '''
+        Keyword arguments:
+        force -- Allow updating a branch to a commit that doesn't descend
+            from it (such as when rewriting history from an edited
+            action).
+        '''
+        self.repo_dir = repo_dir
+        self.git = git
+        self._next_mark = 1
+        self.known_blobs = set()
+        self._checker = None
+        cmd_parts = [git, "fast-import", "--quiet", "--done"]
+        if force:
+            cmd_parts.append("--force")
+        self._proc = subprocess.Popen(
+            cmd_parts,
+            cwd=repo_dir,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        # ^ stdout is where get-mark responses go.
+        self._outs = self._proc.stdin
+
+    def checkpoint(self):
+        '''
+        Make git write everything sent so far (objects and refs) to disk.
+        '''
+        self._write("checkpoint\n\n")
+        self._outs.flush()
+
+    def get_mark(self, mark):
+        '''
+        Get the object id (str) of a mark.
+        '''
+        self._write("get-mark :{}\n".format(mark))
+        self._outs.flush()
+        line = self._proc.stdout.readline().decode("utf-8").strip()
+        if len(line) != 40:
+            raise RuntimeError("get-mark :{} failed (got {})"
+                               "".format(mark, json.dumps(line)))
+        return line
+
+    def reset(self, ref):
+        '''
+        Start ref over so the next commit on it has no parent unless one
+        is given.
+        '''
+        self._write("reset {}\n\n".format(ref))
+
+    def has_blob(self, sha):
+        '''
+        Check whether a blob was sent already or is already in the
+        repository (so it doesn't need to be read or sent).
+        '''
+        if sha in self.known_blobs:
+            return True
+        if self._checker is None:
+            self._checker = subprocess.Popen(
+                [self.git, "cat-file", "--batch-check"],
+                cwd=self.repo_dir,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+        self._checker.stdin.write(sha.encode("ascii") + b"\n")
+        self._checker.stdin.flush()
+        line = self._checker.stdout.readline().decode("utf-8")
+        # ^ such as "<sha> blob 12" or "<sha> missing"
+        if line.split()[1:2] == ["blob"]:
+            self.known_blobs.add(sha)
+            return True
+        return False
+
+    def _write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8", "surrogateescape")
+        self._outs.write(data)
+
+    def blob(self, sha, size, chunks):
+        '''
+        Send a blob unless it was already sent.
+
+        Sequential arguments:
+        sha -- The SHA-1 of the blob (See git_blob_id).
+        size -- The exact number of bytes in the blob.
+        chunks -- An iterable of bytes which add up to size.
+
+        Returns:
+        True if sent, False if the blob was already known.
+        '''
+        if sha in self.known_blobs:
+            return False
+        self._write("blob\ndata {}\n".format(size))
+        written = 0
+        for chunk in chunks:
+            self._outs.write(chunk)
+            written += len(chunk)
+        if written != size:
+            raise RuntimeError(
+                "The blob {} was {} bytes but should have been {}"
+                " (Was the file changed during the import?)"
+                "".format(sha, written, size)
+            )
+        self._write("\n")
+        self.known_blobs.add(sha)
+        return True
+
+    def commit(self, ref, ident, when, message, changes, parent=None,
+               deleteall=False):
+        '''
+        Send a commit.
+
+        Sequential arguments:
+        ref -- The ref to update, such as "refs/heads/main".
+        ident -- The committer (and author) such as "Name <email>".
+        when -- A timezone-aware datetime.
+        message -- The commit message.
+        changes -- A list of changes where each is either
+            ('M', mode, sha, path) or ('D', path).
+
+        Keyword arguments:
+        parent -- The mark (int) or commit id (str) of the parent, or None
+            to continue from the last commit on ref (or start a new
+            history if there isn't one).
+        deleteall -- Start from an empty tree instead of the parent's
+            tree.
+
+        Returns:
+        the mark (int) of the new commit.
+        '''
+        mark = self._next_mark
+        self._next_mark += 1
+        timestamp = int(when.timestamp())
+        offset = when.utcoffset()
+        minutes = int(offset.total_seconds() // 60) if offset else 0
+        sign = "+" if minutes >= 0 else "-"
+        tz_s = "{}{:02d}{:02d}".format(sign, abs(minutes) // 60,
+                                       abs(minutes) % 60)
+        msg = message.encode("utf-8")
+        self._write("commit {}\nmark :{}\n".format(ref, mark))
+        self._write("author {} {} {}\n".format(ident, timestamp, tz_s))
+        self._write("committer {} {} {}\n".format(ident, timestamp, tz_s))
+        self._write("data {}\n".format(len(msg)))
+        self._write(msg + b"\n")
+        if isinstance(parent, int):
+            self._write("from :{}\n".format(parent))
+        elif parent is not None:
+            self._write("from {}\n".format(parent))
+        if deleteall:
+            self._write("deleteall\n")
+        for change in changes:
+            if change[0] == 'M':
+                self._write("M {} {} {}\n".format(change[1], change[2],
+                                                  quote_path(change[3])))
+            elif change[0] == 'D':
+                self._write("D {}\n".format(quote_path(change[1])))
+            else:
+                raise ValueError("Unknown change: {}".format(change))
+        self._write("\n")
+        return mark
+
+    def close(self):
+        '''
+        Finish the import and wait for git to write the objects and refs.
+        '''
+        if self._checker is not None:
+            self._checker.stdin.close()
+            self._checker.wait()
+            self._checker = None
+        self._write("done\n")
+        self._outs.close()
+        code = self._proc.wait()
+        self._proc.stdout.close()
+        if code != 0:
+            raise RuntimeError("git fast-import failed with code {}"
+                               "".format(code))
+        return code
+
+
+def action_datetime(action, tree_dt=None):
+    '''
+    Get the date to use for the commit of a version: the date marked by
+    "Mark maximum file date" if any, otherwise tree_dt (the newest
+    file), otherwise now.
+    '''
+    date_str = action.get('date')
+    if date_str is not None:
+        try:
+            return datetime.strptime(date_str, "%Y-%m-%d").replace(
+                tzinfo=timezone.utc
+            )
+        except ValueError:
+            # such as "(no date in range)"
+            pass
+    if tree_dt is not None:
+        return tree_dt
+    return datetime.now(timezone.utc)
+
+
+def action_message(action):
+    name = action.get('name')
+    if name is None:
+        name = os.path.split(action['path'])[1]
+    return name
+
+
+def action_cache_key(prev_key, action):
+    '''
+    Get a key that changes if the action or anything before it changes,
+    so a commit can be reused only if its whole history is the same.
+    '''
+    fields = dict((k, action.get(k)) for k in KEY_FIELDS)
+    sha = hashlib.sha1(prev_key.encode("utf-8"))
+    sha.update(json.dumps(fields, sort_keys=True).encode("utf-8"))
+    return sha.hexdigest()
+
+
+class CommitJournal:
+    '''
+    Keep an append-only record of commits so an interrupted commit run
+    can continue where it stopped.
+
+    Each line is a JSON object with the keys repo, ref, luid, commit and
+    key (See action_cache_key). Later lines for the same luid replace
+    earlier ones.
+    '''
+    def __init__(self, path, repo_dir, ref):
+        self.path = path
+        self.repo = os.path.realpath(repo_dir)
+        self.ref = ref
+
+    def load(self):
+        '''
+        Get the entries for this repo and ref as a dict by luid.
+        '''
+        results = {}
+        if not os.path.isfile(self.path):
+            return results
+        with open(self.path, 'r') as ins:
+            for line in ins:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may be partial after a crash.
+                    echo0('* ignored a bad line in "{}"'.format(self.path))
+                    continue
+                if (entry.get('repo') != self.repo
+                        or entry.get('ref') != self.ref):
+                    continue
+                results[entry['luid']] = entry
+        return results
+
+    def append(self, records):
+        '''
+        Append (luid, commit, key) records and make sure they are on disk.
+        '''
+        if len(records) == 0:
+            return
+        with open(self.path, 'a') as outs:
+            for luid, commit, key in records:
+                outs.write(json.dumps({
+                    'repo': self.repo,
+                    'ref': self.ref,
+                    'luid': luid,
+                    'commit': commit,
+                    'key': key,
+                }, sort_keys=True) + "\n")
+            outs.flush()
+            os.fsync(outs.fileno())
+
+
+class CommitEngine:
+    '''
+    Commit every committed version in project._actions in order using a
+    single fast-import process.
+
+    If materialize is True, each version is synced into one staging
+    directory (_anewcommit_cache/commits/_stage) with rsync (See
+    ANCProject.sync_version), then only paths whose size, mtime or mode
+    changed are hashed, and only blobs that are new are sent.
+
+    If materialize is False, nothing is copied: The tree of each commit
+    is built from the manifest of the version (See
+    ANCProject.update_manifest) and its "use" statements, and blob data
+    is streamed directly from the version's files (only if the blob isn't
+    already in the stream or repository). In this case the project's
+    .gitignore applies to the paths in the commit.
+
+    Either way, the 'delete_then_add' mode deletes any path that isn't
+    in the version, and the 'overlay' mode only adds or changes paths.
+
+    If the project has a project_dir, each commit is recorded in a
+    journal (See CommitJournal) as soon as git has written it, and a
+    later run skips every version whose commit is in the journal with
+    the same key (See action_cache_key). If an action was edited, the
+    commits from that action on are rewritten.
+
+    Public Attributes:
+    ref -- The branch ref to create.
+    ident -- The committer such as "Name <email>".
+    commits -- A (luid, mark) tuple for each commit sent by this run.
+    checkpoint_every -- Make git write the import and record it in the
+        journal after this many commits.
+    jobs -- If more than 1, new blobs are hashed and compressed by this
+        many worker processes and written as loose objects (See
+        BlobPool) instead of being sent through fast-import (which
+        compresses them on one core).
+    pack -- If True (requires materialize=False), write new blobs to a
+        pack before the commits, storing each file as a delta against
+        the same path's blob in the previous version (See PackWriter).
+    pack_depth -- The longest chain of deltas if pack is True.
+    '''
+    def __init__(self, project, repo_dir, branch=DEFAULT_BRANCH, ident=None,
+                 git="git", materialize=True, jobs=1, pack=False):
+        if pack and materialize:
+            raise ValueError("pack=True only works with materialize=False.")
+        self.project = project
+        self.pack = pack
+        self.pack_depth = DEFAULT_DEPTH
+        self.jobs = jobs
+        self.repo_dir = repo_dir
+        self.ref = "refs/heads/" + branch
+        self.git = git
+        self.ident = ident
+        self.materialize = materialize
+        self.commits = []
+        self.checkpoint_every = 10
+        self.journal = None
+        if project.project_dir is not None:
+            self.journal = CommitJournal(
+                os.path.join(project.project_dir, JOURNAL_NAME),
+                repo_dir,
+                self.ref,
+            )
+        self._pending = []
+        self._pool = None
+
+    def committed_indices(self):
+        '''
+        Get the indices of versions that should become commits.
+        '''
+        results = []
+        for index, action in enumerate(self.project._actions):
+            if action.get('commit') is not True:
+                continue
+            if action['verb'] not in VERSION_VERBS:
+                echo1("* skipping {} (luid={}): committing transitions"
+                      " is not implemented."
+                      "".format(action['verb'], action['luid']))
+                continue
+            results.append(index)
+        return results
+
+    def cache_keys(self, indices):
+        keys = []
+        key = json.dumps({
+            'materialize': self.materialize,
+            'ref': self.ref,
+        }, sort_keys=True)
+        for index in indices:
+            key = action_cache_key(key, self.project._actions[index])
+            keys.append(key)
+        return keys
+
+    def _commit_exists(self, commit):
+        code = subprocess.call(
+            [self.git, "cat-file", "-e", commit + "^{commit}"],
+            cwd=self.repo_dir,
+            stderr=subprocess.DEVNULL,
+        )
+        return code == 0
+
+    def find_start(self, indices, keys):
+        '''
+        Find where to continue a previous run.
+
+        Returns:
+        a tuple (start, parent) where start is the position in indices of
+        the first version to commit, and parent is the commit id of the
+        version before it (or None to start a new history).
+        '''
+        if self.journal is None:
+            return 0, None
+        entries = self.journal.load()
+        start = 0
+        parent = None
+        for pos, index in enumerate(indices):
+            entry = entries.get(self.project._actions[index]['luid'])
+            if (entry is None) or (entry.get('key') != keys[pos]):
+                break
+            if not self._commit_exists(entry['commit']):
+                break
+            start = pos + 1
+            parent = entry['commit']
+        return start, parent
+
+    def run(self):
+        '''
+        Import the whole history (or the part that isn't already
+        committed).
+
+        Returns:
+        the number of commits made.
+        '''
+        ensure_repo(self.repo_dir, git=self.git)
+        if self.ident is None:
+            self.ident = git_ident(self.repo_dir, git=self.git)
+        indices = self.committed_indices()
+        keys = self.cache_keys(indices)
+        start, parent = self.find_start(indices, keys)
+        if ref_exists(self.repo_dir, self.ref, git=self.git):
+            if (self.journal is None) or (len(self.journal.load()) == 0):
+                raise ValueError(
+                    '{} already exists in "{}". Choose a new branch.'
+                    ''.format(self.ref, self.repo_dir)
+                )
+        if start > 0:
+            echo0("* {} version(s) are already committed"
+                  "".format(start))
+        if start == len(indices):
+            if parent is not None:
+                subprocess.check_call(
+                    [self.git, "update-ref", self.ref, parent],
+                    cwd=self.repo_dir,
+                )
+            return 0
+        stream = FastImportStream(self.repo_dir, git=self.git, force=True)
+        if (self.jobs is None) or (self.jobs > 1):
+            self._pool = BlobPool(self.repo_dir, jobs=self.jobs, git=self.git)
+        try:
+            if parent is None:
+                stream.reset(self.ref)
+            if self.materialize:
+                stage_dir = os.path.join(
+                    self.project.get_cached_dir("commits"),
+                    "_stage",
+                )
+                self._run_staged(stream, stage_dir, indices, keys, start,
+                                 parent)
+            else:
+                self._run_manifests(stream, indices, keys, start, parent)
+            self._flush_journal(stream)
+        except BaseException:
+            try:
+                self._flush_journal(stream)
+            except Exception as ex:
+                echo0("* The journal wasn't updated: {}".format(ex))
+            raise
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+            stream.close()
+        return len(self.commits)
+
+    def _store_blobs(self, stream, items):
+        '''
+        Make sure each file is in the stream or repository as a blob.
+
+        Sequential arguments:
+        items -- a list of (key, path, mode) tuples.
+
+        Returns:
+        (yields) a tuple (key, sha) for each item in the same order.
+        '''
+        if self._pool is not None:
+            for key, sha, size in self._pool.store(items):
+                stream.known_blobs.add(sha)
+                yield key, sha
+            return
+        for key, path, mode in items:
+            sha, size, data = read_blob(path, mode)
+            if data is not None:
+                stream.blob(sha, size, [data])
+            else:
+                stream.blob(sha, size, iter_blob_chunks(path, mode))
+            yield key, sha
+
+    def _flush_journal(self, stream):
+        '''
+        Have git write the commits sent so far, then record them.
+        '''
+        if len(self._pending) == 0:
+            return
+        stream.checkpoint()
+        if self.journal is not None:
+            records = []
+            for luid, mark, key in self._pending:
+                records.append((luid, stream.get_mark(mark), key))
+            self.journal.append(records)
+        self._pending = []
+
+    def _tree_of(self, commit):
+        '''
+        Get the tree of an existing commit as a dict where each key is a
+        path and each value is (mode, sha).
+        '''
+        tree = {}
+        if commit is None:
+            return tree
+        out = subprocess.check_output(
+            [self.git, "ls-tree", "-r", "-z", commit],
+            cwd=self.repo_dir,
+        ).decode("utf-8", "surrogateescape")
+        for item in out.split("\0"):
+            if not item:
+                continue
+            meta, path = item.split("\t", 1)
+            mode, kind, sha = meta.split()
+            if kind == "blob":
+                tree[path] = (mode, sha)
+        return tree
+
+    def _commit(self, stream, action, key, changes, newest_ns, parent):
+        tree_dt = None
+        if newest_ns is not None:
+            tree_dt = datetime.fromtimestamp(newest_ns / 1e9,
+                                             tz=timezone.utc)
+        mark = stream.commit(
+            self.ref,
+            self.ident,
+            action_datetime(action, tree_dt=tree_dt),
+            action_message(action),
+            changes,
+            parent=parent,
+        )
+        self.commits.append((action['luid'], mark))
+        self._pending.append((action['luid'], mark, key))
+        if len(self._pending) >= self.checkpoint_every:
+            self._flush_journal(stream)
+        return mark
+
+    def _restore_stage(self, stage_dir, commit):
+        '''
+        Make the staging directory match an existing commit (so an
+        'overlay' version after it is applied to the right files).
+        '''
+        if os.path.isdir(stage_dir):
+            shutil.rmtree(stage_dir)
+        os.makedirs(stage_dir)
+        proc = subprocess.Popen(
+            [self.git, "archive", "--format=tar", commit],
+            cwd=self.repo_dir,
+            stdout=subprocess.PIPE,
+        )
+        with tarfile.open(fileobj=proc.stdout, mode='r|') as tf:
+            tf.extractall(stage_dir)
+        proc.stdout.close()
+        if proc.wait() != 0:
+            raise RuntimeError("git archive {} failed".format(commit))
+
+    def _run_staged(self, stream, stage_dir, indices, keys, start, parent):
+        tree = {}
+        # ^ tree[path] = (mode, sha, signature)
+        for path, (mode, sha) in self._tree_of(parent).items():
+            tree[path] = (mode, sha, None)
+        resync = True  # always resync the first time.
+        if parent is not None:
+            self._restore_stage(stage_dir, parent)
+            resync = False
+        count = len(indices)
+        for done in range(start, count):
+            action = self.project._actions[indices[done]]
+            resync = self.project.sync_version(action, stage_dir,
+                                               resync=resync)
+            files = walk_tree(stage_dir)
+            changes = []
+            newest_ns = None
+            new_tree = {}
+            items = []
+            for rel, (mode, sig, path) in files.items():
+                if (newest_ns is None) or (sig[1] > newest_ns):
+                    newest_ns = sig[1]
+                old = tree.get(rel)
+                if (old is not None) and (old[0] == mode) and (old[2] == sig):
+                    new_tree[rel] = old
+                    continue
+                items.append((rel, path, mode))
+            for rel, sha in self._store_blobs(stream, items):
+                mode, sig, path = files[rel]
+                old = tree.get(rel)
+                new_tree[rel] = (mode, sha, sig)
+                if (old is None) or (old[0] != mode) or (old[1] != sha):
+                    changes.append(('M', mode, sha, rel))
+            for rel in tree:
+                if rel not in new_tree:
+                    changes.append(('D', rel))
+            tree = new_tree
+            parent = self._commit(stream, action, keys[done], changes,
+                                  newest_ns, parent)
+            echo0("* committed {}/{} {} ({} change(s))"
+                  "".format(done+1, count, action_message(action),
+                            len(changes)))
+
+    def _manifest_trees(self, indices, start):
+        '''
+        Get the files of each version where they go in the commit.
+
+        Returns:
+        (yields) a tuple (done, action, manifest, version_tree) for each
+        version from indices[start] on (See manifest_tree), without
+        ignored paths.
+        '''
+        ignorer = IgnoreChecker(self.project, self.repo_dir, git=self.git)
+        for done in range(start, len(indices)):
+            action = self.project._actions[indices[done]]
+            manifest = self.project.update_manifest(action['luid'])
+            pairs = self.project.version_pairs(action['luid'])
+            version_tree = manifest_tree(manifest, action['path'], pairs)
+            for path in ignorer.ignored(version_tree.keys()):
+                del version_tree[path]
+            yield done, action, manifest, version_tree
+
+    def _pack_blobs(self, stream, trees):
+        '''
+        Write every blob that the commits need (and that the repository
+        doesn't have) to one pack, storing each as a delta against the
+        previous blob at the same path where that is smaller (See
+        PackWriter).
+
+        Sequential arguments:
+        trees -- a list of tuples from _manifest_trees.
+        '''
+        writer = PackWriter(self.repo_dir, git=self.git,
+                            max_depth=self.pack_depth)
+        previous = {}
+        # ^ previous[path] = (sha, file, mode) for the delta base
+        try:
+            for done, action, manifest, version_tree in trees:
+                for path, (mode, sha, rel) in version_tree.items():
+                    src_path = os.path.join(action['path'], rel)
+                    if (sha not in writer) and (not stream.has_blob(sha)):
+                        writer.add_file(sha, manifest[rel][1], src_path,
+                                        mode, base=previous.get(path))
+                    previous[path] = (sha, src_path, mode)
+        except BaseException:
+            writer.abort()
+            raise
+        pack_path = writer.close()
+        stream.known_blobs.update(writer.shas())
+        if pack_path is not None:
+            echo0("* packed {} blob(s) ({} as deltas) from {} bytes to {}"
+                  "".format(len(writer.shas()), writer.deltas,
+                            writer.raw_size, os.path.getsize(pack_path)))
+
+    def _run_manifests(self, stream, indices, keys, start, parent):
+        tree = self._tree_of(parent)
+        # ^ tree[path] = (mode, sha)
+        count = len(indices)
+        trees = self._manifest_trees(indices, start)
+        if self.pack:
+            trees = list(trees)
+            self._pack_blobs(stream, trees)
+        for done, action, manifest, version_tree in trees:
+            if action['mode'] == 'delete_then_add':
+                new_tree = {}
+            else:
+                new_tree = dict(tree)
+            changes = []
+            newest_ns = None
+            items = []
+            queued = set()
+            for path, (mode, sha, rel) in version_tree.items():
+                entry = manifest[rel]
+                if (newest_ns is None) or (entry[M_MTIME] > newest_ns):
+                    newest_ns = entry[M_MTIME]
+                new_tree[path] = (mode, sha)
+                if tree.get(path) == (mode, sha):
+                    continue
+                if (sha not in queued) and (not stream.has_blob(sha)):
+                    src_path = os.path.join(action['path'], rel)
+                    if self._pool is not None:
+                        items.append((sha, src_path, mode))
+                        queued.add(sha)
+                    else:
+                        stream.blob(sha, entry[1],
+                                    iter_blob_chunks(src_path, mode))
+                changes.append(('M', mode, sha, path))
+            for expected, sha in self._store_blobs(stream, items):
+                if sha != expected:
+                    raise RuntimeError(
+                        "A file in {} changed after the manifest was made."
+                        "".format(action['path'])
+                    )
+            for path in tree:
+                if path not in new_tree:
+                    changes.append(('D', path))
+            tree = new_tree
+            parent = self._commit(stream, action, keys[done], changes,
+                                  newest_ns, parent)
+            echo0("* committed {}/{} {} ({} change(s))"
+                  "".format(done+1, count, action_message(action),
+                            len(changes)))
+        if self.project.path or self.project.project_dir:
+            self.project.save()
+            # ^ Keep the manifests so unchanged files aren't hashed again.
+
+
+class IgnoreChecker:
+    '''
+    Decide which paths in a commit are ignored by the project's
+    .gitignore using "git check-ignore" (so the rules are exactly git's).
+    '''
+    def __init__(self, project, repo_dir, git="git"):
+        self.repo_dir = repo_dir
+        self.git = git
+        self.gitignore_path = None
+        if project.project_dir is not None:
+            gitignore_path = project.get_gitignore_path()
+            if os.path.isfile(gitignore_path):
+                self.gitignore_path = os.path.abspath(gitignore_path)
+
+    def ignored(self, paths):
+        '''
+        Get the list of paths that are ignored.
+        '''
+        if self.gitignore_path is None:
+            return []
+        data = "\0".join(paths).encode("utf-8", "surrogateescape")
+        if len(data) == 0:
+            return []
+        proc = subprocess.Popen(
+            [self.git, "-c", "core.excludesFile=" + self.gitignore_path,
+             "check-ignore", "--no-index", "-z", "--stdin"],
+            cwd=self.repo_dir,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        out, _ = proc.communicate(data + b"\0")
+        if proc.returncode not in (0, 1):
+            # 1 means nothing is ignored.
+            raise RuntimeError("git check-ignore failed with code {}"
+                               "".format(proc.returncode))
+        return [path for path in
+                out.decode("utf-8", "surrogateescape").split("\0") if path]
+
+
+def commit_project(project, repo_dir, branch=DEFAULT_BRANCH, ident=None,
+                   materialize=True, jobs=1, pack=False):
+    '''
+    Commit every committed version in the project to a new branch in
+    repo_dir (See CommitEngine).
+
+    Returns:
+    the number of commits made.
+    '''
+    engine = CommitEngine(project, repo_dir, branch=branch, ident=ident,
+                          materialize=materialize, jobs=jobs, pack=pack)
+    return engine.run()
@@ -86,12 +86,13 @@ from anewcommit import (
     profile,
     substep_to_str,
     s2or3,
-    newest_file_dt_in,
     parse_statement,
+    normalize_destination,
     statement_to_caption,
     open_file,
     split_root,
     split_subs,
+    index_mapper,
 )
 
 echos = []
@@ -479,9 +480,11 @@ class MainFrame(SFContainer):
     _project -- This is the currently loaded ANCProject instance.
     _frame_of_luid -- _frame_of_luid[luid] is the row, in the form of a
         frame, that represents the action (verb can be "get_version" or
-        a transition verb) uniquely identified by a luid.
-    _vars_of_luid -- _vars_of_luid[luid][key] is the widget of
-        the action for the action uniquely identified by luid.
+        a transition verb) uniquely identified by a luid. Only rows in
+        or near the view exist (See SFContainer.set_row_count).
+    _vars_of_luid -- _vars_of_luid[luid][key] is the Tk variable of
+        the action for the action uniquely identified by luid (only
+        for rows in _frame_of_luid).
     '''
     def __init__(self, parent, settings=None):
         all_settings = copy.deepcopy(ANCProject.default_settings)
@@ -526,7 +529,6 @@ class MainFrame(SFContainer):
         self.menu = tk.Menu(self.parent)
         self.parent.config(menu=self.menu)
         self.next_id = 0
-        self._items = []
         self.selection_color = "black"
         self.bg_color = None
         self.prefill_date = None
@@ -551,6 +553,10 @@ class MainFrame(SFContainer):
                                    command=self.ask_statement_all_applicable)
         self.batchMenu.add_command(label="Mark maximum file date...",
                                   command=self.ask_mark_all_max_date_before)
+        self.batchMenu.add_command(label="Sort versions by date",
+                                   command=self.sort_versions_by_date)
+        self.batchMenu.add_command(label="Show versions out of date order",
+                                   command=self.show_dates_out_of_order)
         self.menu.add_cascade(label="Batch", menu=self.batchMenu)
 
         self.editMenu = tk.Menu(self.menu, tearoff=0)
@@ -642,7 +648,9 @@ class MainFrame(SFContainer):
             # Cancel button was pressed (or blank became None above)
             return
         try:
-            self.mark_if_has_folder(statement, selected_i=selected_i)
+            with self._project.batch():
+                # ^ Write the project once, not once per version.
+                self.mark_if_has_folder(statement, selected_i=selected_i)
         except ValueError as ex:
             messagebox.showerror("Error", str(ex))
             raise ex
@@ -656,6 +664,30 @@ class MainFrame(SFContainer):
     def ask_mark_all_max_date_before(self):
         self.ask_mark_max_date_before(do_all=True)
 
+    def sort_versions_by_date(self):
+        if self._project is None:
+            return
+        if self._project.sort_versions_by_date() is None:
+            messagebox.showinfo("Info", "The versions are already in order.")
+        # ^ Otherwise the rows are refreshed by _on_project_changed.
+        self.update_undo()
+
+    def show_dates_out_of_order(self):
+        if self._project is None:
+            return
+        lines = []
+        for index, newer_index in self._project.dates_out_of_order():
+            action = self._project._actions[index]
+            newer_action = self._project._actions[newer_index]
+            lines.append('"{}" ({}) is after "{}" ({})'.format(
+                action.get('name'), action.get('date'),
+                newer_action.get('name'), newer_action.get('date'),
+            ))
+        if len(lines) == 0:
+            messagebox.showinfo("Info", "The dated versions are in order.")
+            return
+        messagebox.showinfo("Versions out of date order", "\n".join(lines))
+
     def ask_mark_max_date_before(self, do_all=False):
         selected_i = None
         result_path = None
@@ -710,96 +742,33 @@ class MainFrame(SFContainer):
         if too_new_date_str is not None:
             too_new_dt = datetime.strptime(too_new_date_str, self.date_fmt)
             too_new_dt = too_new_dt.replace(tzinfo=tz.tzlocal())
-        try:
-            ranges = self._project.get_ranges()
-        except Exception as ex:
-            messagebox.showerror("Error", str(ex))
-            raise ex
-        if selected_i is not None:
-            r = [selected_i]
-            ranges = [r]
-        echo0("Processing {} version(s)".format(len(ranges)))
-        count = 0
-        done = 0
-        min_index = len(self._project._actions)
+        luids = None
         if selected_i is not None:
-            r = [selected_i]
-            ranges = [r]
             echo0("selected_i={}".format(selected_i))
+            version_i, _ = self._project.get_affected(selected_i)
+            if selected_i != version_i:
+                messagebox.showerror(
+                    "Error",
+                    "This operation only works on a source.",
+                )
+                return
+            luids = [self._project._actions[version_i]['luid']]
         elif self._selected_luid is not None:
             echo0("WARNING: self._selected_luid but no selected_i")
-        for r in ranges:
-            version_i, _ = self._project.get_affected(r[0])
-            if selected_i is not None:
-                if selected_i != version_i:
-                    messagebox.showerror(
-                        "Error",
-                        "This operation only works on a source.",
-                    )
-                    return
-            echo0("Processing version index {} in {}"
-                  "".format(version_i, _))
-            action = self._project._actions[version_i]
-            parent = action['path']
-            sources = []
-            statements = action.get('statements')
-            if statements is not None:
-                echo1("len(statements)={}".format(len(statements)))
-                for statement in statements:
-                    command = parse_statement(statement)
-                    if 'destination' not in command:
-                        continue
-                    source = command.get('source')
-                    if source is None:
-                        continue
-                        # There is no source, so the whole thing is the source
-                        # (there shouldn't be any other "use" statements in
-                        # this case).
-                    sources.append(os.path.join(parent, source))
-                    echo1("source={}".format(source))
-            if len(sources) == 0:
-                # If there are no specified subprojects in the source,
-                #   use the entire source:
-                sources = [parent]
-            echo1("len(sources)={}".format(len(sources)))
-
-            newest_path = None
-            newest_dt = None
-            for source in sources:
-                this_path, this_dt = newest_file_dt_in(
-                    source,
-                    too_new_dt=too_new_dt,
-                )
-                if this_dt is None:
-                    continue
-                if (newest_dt is None) or (this_dt > newest_dt):
-                    newest_dt = this_dt
-                    newest_path = this_path
-            if newest_dt is not None:
-                date_str = newest_dt.strftime(self.date_fmt)
-                if len(date_str.strip()) == 0:
-                    date_str = "(bad date)"
-            else:
-                date_str = "(no date in range)"
-
-            if action.get('date') != date_str:
-                if version_i < min_index:
-                    min_index = version_i
-            action['date'] = date_str
-            action['newest_path'] = newest_path
-            result_path = newest_path
-            result_date = date_str
-            done += 1
-
-        if min_index < len(self._project._actions):
-            self._project.save()
-            self._reload_at(min_index, "mark date")
-
-        if (count > 0) and  (done < count):
-            messagebox.showinfo(
-                "Info",
-                "{}/{} already marked".format(count-done, count),
+        try:
+            results = self._project.mark_dates(
+                too_new_dt=too_new_dt,
+                luids=luids,
+                date_fmt=self.date_fmt,
             )
+            # ^ The rows are refreshed once by _on_project_changed.
+        except RuntimeError as ex:
+            messagebox.showerror("Error", str(ex))
+            raise ex
+        echo0("Processed {} version(s)".format(len(results)))
+        if len(results) > 0:
+            _, result_path, result_date = results[-1]
+        self.update_undo()
         return result_path, result_date
 
     def mark_if_has_folder(self, statement, selected_i=None):
@@ -814,9 +783,6 @@ class MainFrame(SFContainer):
             messagebox.showerror("Error", str(ex))
             return
 
-        ranges = self._project.get_ranges()
-        count = 0
-        done = 0
         relPath = command.get('source')
         if relPath is not None:
             if relPath.strip() == "":
@@ -832,44 +798,23 @@ class MainFrame(SFContainer):
         # so don't check for a folder, just use it as the
         # given destination.
 
+        luids = None
         if selected_i is not None:
-            r = [selected_i]
-            ranges = [r]
             echo1("selected_i={}".format(selected_i))
+            version_i, _ = self._project.get_affected(selected_i)
+            if selected_i != version_i:
+                messagebox.showerror(
+                    "Error",
+                    "This operation only works on a source.",
+                )
+                return
+            luids = [self._project._actions[version_i]['luid']]
         elif self._selected_luid is not None:
             echo0("WARNING: self._selected_luid but no selected_i")
-
-        for r in ranges:
-            version_i, _ = self._project.get_affected(r[0])
-            if selected_i is not None:
-                if selected_i != version_i:
-                    messagebox.showerror(
-                        "Error",
-                        "This operation only works on a source.",
-                    )
-                    return
-            action = self._project._actions[version_i]
-            parent = action['path']
-            subPath = None
-            if relPath is not None:
-                subPath = os.path.join(parent, relPath)
-                if not os.path.isdir(subPath):
-                    continue
-            luid = action['luid']
-            count += 1
-            if not self._project.append_statement_where(luid, statement):
-                continue
-            done += 1
-            widget = ttk.Label(
-                self._items[version_i],
-                text=statement_to_caption(command),
-            )
-            widget.pack(side=tk.LEFT)
-            widget.bind(
-                "<Button>",
-                lambda e, l=luid, st=statement: self.on_click_sub(e, l, st),
-            )
-            # ^ also done in _append_row
+        luids = self._project.find_applicable(statement, luids=luids)
+        count = len(luids)
+        done = len(self._project.append_statement_many(luids, statement))
+        # ^ The rows are refreshed once by _on_project_changed.
 
         if (count > 0) and  (done < count):
             messagebox.showinfo(
@@ -914,14 +859,13 @@ class MainFrame(SFContainer):
         self.on_click_row(luid)
 
     def on_right_click_sub(self, luid, statement):
-        min_index = self._find('luid', luid)
         yes = messagebox.askyesno(
             "clicked directory",
             'Unmark {}?'.format(statement),
         )
         if yes:
             self._project.remove_statement_where(luid, statement)
-            self._reload_at(min_index, "remove sub")
+            self._patch_luid(luid, ['statements'])
         self.on_click_row(luid)
 
     def on_click_sub(self, event, luid, statement):
@@ -985,7 +929,7 @@ class MainFrame(SFContainer):
         if to_source is not None:
             cmp_src_lists[I_TO] = split_subs(to_source)
         cmp_dst_lists = [None, None]
-        to_dst = cmp_cmds[I_TO]['destination']
+        to_dst = normalize_destination(cmp_cmds[I_TO]['destination'])
         cmp_dst_lists[I_TO] = split_subs(to_dst)
         cmp_roots = [None, None]
         cmp_roots[I_TO] = cmp_dst_lists[I_TO][0]
@@ -998,21 +942,21 @@ class MainFrame(SFContainer):
         partial_count = 0
         SMALL_IDX = -1
         BIG_IDX = -1
-        for try_i in reversed(range(0, to_i)):
+        try_indices = self._project.destination_indices(to_dst, before=to_i,
+                                                        root=True)
+        # ^ Only earlier actions with the same destination root can match.
+        for try_i in reversed(try_indices):
             try_action = self._project._actions[try_i]
-            try_statements = try_action.get('statements')
-            if try_statements is None:
-                continue
-            for try_statement in try_statements:
-                try_command = None
-                try:
-                    try_command = parse_statement(try_statement)
-                except ValueError as ex:
-                    echo0("'{}' failed since: {}".format(try_statement, ex))
+            for try_statement, try_command, error in \
+                    self._project.get_commands(try_action['luid']):
+                if error is not None:
+                    echo0("'{}' failed since: {}".format(try_statement,
+                                                         error))
                     continue
                 from_dst = try_command.get('destination')
                 if from_dst is None:
                     continue
+                from_dst = normalize_destination(from_dst)
 
                 cmp_dst_lists[I_FROM] = split_subs(from_dst)
                 # from_dst_sub
@@ -1156,28 +1100,25 @@ class MainFrame(SFContainer):
             )
 
     def select_luid(self, luid):
-        min_index = -1
-        new_frame = None
+        if luid == self._selected_luid:
+            # The row is already selected, so don't refresh.
+            return
         if luid is not None:
-            min_index = self._find('luid', luid)
-            if luid == self._selected_luid:
-                # The row is already selected, so don't refresh.
-                return
-            elif min_index > -1:
-                new_frame = self._items[min_index]
-            else:
+            if self._find('luid', luid) < 0:
                 raise IndexError("The new _selected_luid {} wasn't found."
-                                 "".format(self._selected_luid))
+                                 "".format(luid))
         # else allow deselecting (only if luid is None)
         old_frame = None
-        # old_luid = self._selected_luid
         if self._selected_luid is not None:
-            old_frame_i = self._find('luid', self._selected_luid)
-            if old_frame_i > -1:
-                old_frame = self._items[old_frame_i]
+            old_frame = self._frame_of_luid.get(self._selected_luid)
+            # ^ None if the row isn't in or near the view (bind_row sets
+            #   the color of a row when it gets widgets).
+        self._selected_luid = luid
+        new_frame = None
+        if luid is not None:
+            new_frame = self._frame_of_luid.get(luid)
 
         if new_frame is not None:
-            self._selected_luid = luid
             if self.bg_color is None:
                 self.bg_color = new_frame.cget("background")  # tk
                 # self.bg_color = self.style.lookup("MainFrame.TFrame",
@@ -1191,7 +1132,12 @@ class MainFrame(SFContainer):
             # self.style.configure(to_style_key(old_luid),
             #                      background=self.bg_color)
 
-    def on_var_changed(self, luid, key, var):
+    def on_var_changed(self, luid, key, var, coalesce=False):
+        '''
+        Keyword arguments:
+        coalesce -- The value is text typed into the field, so repeated
+            changes to it are one undo step (See ANCProject.set_field).
+        '''
         echo1("on_var_changed: {}'s {} = {}"
               "".format(luid, key, json.dumps(var.get())))
         dat_i = self._project._find_where('luid', luid)
@@ -1214,8 +1160,7 @@ class MainFrame(SFContainer):
                               type(new_v).__name__, json.dumps(new_v))
                 )
         if key in action:
-            action[key] = new_v
-            # TODO: Add an undo step but not for every character typed.
+            self._project.set_field(luid, key, new_v, coalesce=coalesce)
         else:
             raise ValueError(
                 "on_var_changed doesn't account for the unknown key"
@@ -1224,7 +1169,7 @@ class MainFrame(SFContainer):
                           json.dumps(key), json.dumps(var.get()))
             )
             # return False
-        return self._project.save()
+        return True
 
     def on_mc_remove(self):
         if self._selected_luid is None:
@@ -1235,7 +1180,7 @@ class MainFrame(SFContainer):
 
     def on_mc_insert(self):
         if self._selected_luid is None:
-            if len(self._items) == 0:
+            if (self._project is None) or (len(self._project._actions) == 0):
                 messagebox.showerror("Error", "First add at least one version.")
             else:
                 messagebox.showerror("Error", "You must select a row first.")
@@ -1403,8 +1348,8 @@ class MainFrame(SFContainer):
         exist in self._project._actions at the same index so
         that the GUI and backend data match.
 
-        The custom ".data" attribute of the row widget is set to
-        "action".
+        Only rows in or near the view have widgets (See make_row and
+        bind_row), so this only changes the row count.
 
         Sequential arguments:
         action -- If the action is a version
@@ -1417,35 +1362,62 @@ class MainFrame(SFContainer):
             contain the keys as returned by the anewcommit.new_*
             functions other than new_version.
         '''
+        row = len(self._project._actions) - 1
+        if self._project._actions[row] is not action:
+            raise RuntimeError(
+                "The visual data and backend project are out of sync:"
+                " (The action {} is not the last action)"
+                "".format(action.get('luid'))
+            )
+        echo1("* adding row at {}".format(row))
+        self._patch_rows([["insert", row, action]])
+
+    def _template_of(self, action):
+        if action.get('verb') is None:
+            raise ValueError("The verb is None")
+        elif action.get('verb') in anewcommit.TRANSITION_VERBS:
+            return transition_template
+        elif action.get('verb') in anewcommit.VERSION_VERBS:
+            return version_template
+        raise ValueError(
+            "The verb must be: {}"
+            "".format(anewcommit.TRANSITION_VERBS
+                      + anewcommit.VERSION_VERBS)
+        )
+
+    def row_kind(self, index):
+        '''
+        Rows can share widgets if they have the same template and the
+        same fields (A missing field is shown as a blank label), or
+        None if the action is invalid.
+        '''
+        action = self._project._actions[index]
+        try:
+            template = self._template_of(action)
+        except ValueError:
+            return None  # See make_row.
+        return (
+            action['verb'] in anewcommit.VERSION_VERBS,
+            tuple(key in action for key in template['field_order']),
+        )
+
+    def make_row(self, kind, index):
+        '''
+        Make the widgets for a row. The row is bound to an action by
+        bind_row, and is reused for other actions of the same kind as
+        the view scrolls (so the variable traces use row.luid rather
+        than a luid from when the row was made).
+
+        The custom ".data" attribute of the row widget is the action it
+        shows (set by bind_row).
+        '''
         # version action keys: path, mode, verb, commit
         # - where verb is in anewcommit.VERSION_VERBS
         # - where mode is in anewcommit.MODES
         # transition action keys: verb, commit
         # - where verb is in anewcommit.TRANSITION_VERBS
-        luid = action['luid']
-        this_template = None
-        options = {}
-        path = None
-        name = None
-        row = len(self._items)
-        if action.get('verb') is None:
-            raise ValueError("The verb is None")
-        elif action.get('verb') in anewcommit.TRANSITION_VERBS:
-            this_template = transition_template
-            options['verb'] = anewcommit.TRANSITION_VERBS
-            echo1("- transition: {}".format(action))
-        elif action.get('verb') in anewcommit.VERSION_VERBS:
-            this_template = version_template
-            options['mode'] = anewcommit.MODES
-            echo1("- version: {}".format(action))
-        else:
-            raise ValueError(
-                "The verb must be: {}"
-                "".format(anewcommit.TRANSITION_VERBS
-                          + anewcommit.VERSION_VERBS)
-            )
-        echo1("* adding row at {}".format(row))
-        frame = tk.Frame(self.scrollable_frame)
+        action = self._project._actions[index]
+        frame = tk.Frame(self.canvas)
         # ^ Using ttk.Frame for the row yields:
         #   'TclError: unknown option "-background"'
         #   so making a style for each luid would be necessary
@@ -1454,19 +1426,26 @@ class MainFrame(SFContainer):
         # style_key = to_style_key(luid)
         # self.style.configure(style_key, background='gray')
         # frame = ttk.Frame(self.scrollable_frame, style=style_key)
-
-        frame.bind("<Button-1>", lambda e, l=luid: self.on_click_row(l))
+        frame.data = None
+        frame.luid = None
+        frame.binding = False
+        # ^ True while bind_row sets the variables (so the traces don't
+        #   write the values back to the project).
+        frame.statement_widgets = []
+
+        frame.bind("<Button-1>", lambda e, r=frame: self.on_click_row(r.luid))
         if self.bg_color is None:
             self.bg_color = frame.cget("background")  # tk
             # self.bg_color = self.style.lookup("MainFrame.TFrame",
             #                                   "background")  # ttk
-        if luid == self._selected_luid:
-            frame.configure(background=self.selection_color)  # tk
-            # self.style.configure(style_key, background=self.selection_color)
-            # ^ ttk
-        frame.data = action
-        self._frame_of_luid[luid] = frame
-        self._vars_of_luid[luid] = {}
+        frame.error_label = None
+        if kind is None:
+            # load_project already showed the error.
+            frame.vs = {}
+            frame.error_label = ttk.Label(frame)
+            frame.error_label.pack(side=tk.LEFT)
+            return frame
+        this_template = self._template_of(action)
 
         results = dict_to_widgets(
             action,
@@ -1474,66 +1453,39 @@ class MainFrame(SFContainer):
             template=this_template,
             warning_on_blank=get_verbosity(),
         )
+        frame.vs = results['vs']
         for k, var in results['vs'].items():
-            # self._key_of_name[var._name] = k
-            # self._luid_of_name[var._name] = luid
-            # self._var_of_name[var._name] = var
-            # var.trace_add('write', lambda *args: self.on_var_changed(luid, k, results['vs'][k]))
-            # ^ always has same k due to late binding
-            #   (See <https://stackoverflow.com/questions/3431676/
-            #   creating-functions-in-a-loop>)
-            #   So force early binding:
-            if sys.version_info.major > 2:
-                # def on_this_var_changed(*args): #, luid=luid, k=k):
-                def on_this_var_changed(tkVarID, param, event, luid=luid, k=k):
-                    # ^ params force early binding (they come from
-                    #   the outer scope, not the call)
-                    # echo2("on_this_var_changed({},...)".format(args))
-                    echo2("on_this_var_changed({},{},{},luid={},k={})"
-                          "".format(tkVarID, param, event, luid, k))
-                    try:
-                        self.on_var_changed(luid, k, results['vs'][k])
-                    except TypeError as ex:
-                        messagebox.showerror("var_changed TypeError",
-                                             str(ex))
-                        # NOTE: type(ex).__name__ is always "Error"
-                        raise ex
-                    except ValueError as ex:
-                        messagebox.showerror("var_changed ValueError",
-                                             str(ex))
-                        # NOTE: type(ex).__name__ is always "Error"
-                        raise ex
-            else:
-                # def on_this_var_changed(*args, luid=luid, k=k):
-                # ^ invalid syntax on Python 2 (See
-                #   <https://stackoverflow.com/a/22436114/4541104>.
-                #   Only Python 3 can put explicit keywords after `*args`).
-                def on_this_var_changed(tkVarID, param, event, luid=luid, k=k):
-                    '''
-                    Keyword argument defaults force early binding (they
-                    come from the outer scope, not the call).
-
-                    Sequential arguments:
-                    tkVarID -- a string such as PY_VAR23
-                    param -- unknown meaning, usually ''
-                    event -- an event name (such as 'w' in Python2)
-
-                    Keyword arguments:
-                    luid -- Specify the luid of the version to affect.
-                    k -- Specify the key of the value associated with
-                        the Tk var.
-                    '''
-                    # echo2("on_this_var_changed({},...)".format(args))
-                    echo2("on_this_var_changed({},{},{},luid={},k={})"
-                          "".format(tkVarID, param, event, luid, k))
-                    try:
-                        self.on_var_changed(luid, k, results['vs'][k])
-                    except TypeError as ex:
-                        messagebox.showerror("var_changed TypeError", str(ex))
-                        raise ex
-                    except ValueError as ex:
-                        messagebox.showerror("var_changed ValueError", str(ex))
-                        raise ex
+            # Force early binding of k (and use the row, since the luid
+            # changes whenever the row is bound to another action):
+            def on_this_var_changed(tkVarID, param, event, row=frame, k=k):
+                '''
+                Keyword argument defaults force early binding (they
+                come from the outer scope, not the call).
+
+                Sequential arguments:
+                tkVarID -- a string such as PY_VAR23
+                param -- unknown meaning, usually ''
+                event -- an event name (such as 'w' in Python2)
+
+                Keyword arguments:
+                row -- Specify the row (its luid is the action to affect).
+                k -- Specify the key of the value associated with
+                    the Tk var.
+                '''
+                if row.binding:
+                    return
+                echo2("on_this_var_changed({},{},{},luid={},k={})"
+                      "".format(tkVarID, param, event, row.luid, k))
+                try:
+                    self.on_var_changed(row.luid, k, row.vs[k],
+                                        coalesce=(k in row.text_keys))
+                except TypeError as ex:
+                    messagebox.showerror("var_changed TypeError", str(ex))
+                    # NOTE: type(ex).__name__ is always "Error"
+                    raise ex
+                except ValueError as ex:
+                    messagebox.showerror("var_changed ValueError", str(ex))
+                    raise ex
             if sys.version_info.major >= 3:
                 var.trace_add('write', on_this_var_changed)
             else:
@@ -1542,34 +1494,75 @@ class MainFrame(SFContainer):
             # ^ In Python 2 it was trace('wu', ...)
         echo2("  - dict_to_widgets got {} widgets."
               "".format(len(results['widgets'])))
+        frame.text_keys = set()
         for name, widget in results['widgets'].items():
-            widget.bind("<Button-1>", lambda e, l=luid: self.on_click_row(l))
+            widget.bind("<Button-1>",
+                        lambda e, r=frame: self.on_click_row(r.luid))
             widget.pack(side=tk.LEFT)
-            var = results['vs'][name]
-            self._vars_of_luid[luid][name] = var
+            if isinstance(widget, ttk.Entry):
+                frame.text_keys.add(name)
+        return frame
 
+    def bind_row(self, row, index):
+        '''
+        Show the action at index in a row from make_row.
+        '''
+        action = self._project._actions[index]
+        luid = action['luid']
+        row.data = action
+        row.luid = luid
+        row.binding = True
+        try:
+            for k, var in row.vs.items():
+                v = action.get(k)
+                if v is None:
+                    if isinstance(var, tk.BooleanVar):
+                        v = False
+                    else:
+                        v = ""
+                var.set(s2or3(v))
+        finally:
+            row.binding = False
+        if row.error_label is not None:
+            row.error_label.configure(
+                text="(invalid action: verb={})".format(action.get('verb'))
+            )
+        self._frame_of_luid[luid] = row
+        self._vars_of_luid[luid] = row.vs
+        if luid == self._selected_luid:
+            row.configure(background=self.selection_color)  # tk
+            # self.style.configure(style_key, background=self.selection_color)
+            # ^ ttk
+        else:
+            row.configure(background=self.bg_color)
+
+        for widget in row.statement_widgets:
+            widget.destroy()
+        del row.statement_widgets[:]
         statements = action.get('statements')
         if statements is not None:
             for _st in statements:
                 cmd = parse_statement(_st)
                 text = statement_to_caption(cmd)
-                widget = ttk.Label(frame, text=text)
+                widget = ttk.Label(row, text=text)
                 if cmd.get('command') is not None:
                     widget.bind(
                         "<Button>",
                         lambda e, l=luid, st=_st: self.on_click_sub(e, l, st),
                     )
-                    # ^ also done in mark_if_has_folder
                 else:
                     pass
                     # There is nothing to do. If invalid,
                     # parse_statement already raised an Exception.
                 widget.pack(side=tk.LEFT)
+                row.statement_widgets.append(widget)
 
-        frame.pack(fill=tk.X)
-        # ^ must match the pack call in insert so layout is consistent
-        # ^ expand=True: makes the row taller so rows fill the window
-        self._items.append(frame)  # self.row_count += 1
+    def unbind_row(self, row):
+        if self._frame_of_luid.get(row.luid) is row:
+            del self._frame_of_luid[row.luid]
+            del self._vars_of_luid[row.luid]
+        row.data = None
+        row.luid = None
 
     def update_undo(self):
         if self._project.has_undo():
@@ -1610,12 +1603,13 @@ class MainFrame(SFContainer):
         if redo:
             do_s = "redo"
         echo1("_undo_step_i: {}".format(self._project._undo_step_i))
-        echo1("_undo_steps:")
-        for step in self._project._undo_steps:
-            echo1("-")
-            for ss in step:
-                name = substep_to_str(ss)
-                echo1("  - {}".format(name))
+        if get_verbosity() > 0:
+            echo1("_undo_steps:")
+            for step in self._project._undo_steps:
+                echo1("-")
+                for ss in step:
+                    name = substep_to_str(ss)
+                    echo1("  - {}".format(name))
         results = None
         err = None
         echo1("* calling _project.undo")
@@ -1628,19 +1622,16 @@ class MainFrame(SFContainer):
             indices = results['added'] + results['removed']
             indices += results['swapped']
             indices += results['swapped_luids']
+            indices += results['changed']
             if len(indices) < 1:
                 if err is not None:
                     messagebox.showwarning("Warning (no rows affected)", err)
                 else:
                     messagebox.showwarning("Warning", "No rows were affected.")
                 return
-            min_index = len(self._items) - 1
-            for index in indices:
-                if index < min_index:
-                    min_index = index
-            # start_index = min_index - offset
-
-            result, err = self._reload_at(min_index, do_s)
+            echo2("  * patching rows after {}".format(do_s))
+            self._patch_rows(results['entries'])
+            self.update_undo()
         if err is not None:
             messagebox.showerror(title, err)
 
@@ -1658,30 +1649,77 @@ class MainFrame(SFContainer):
         if min_index < 0:
             err = "The index {} is bad in _reload_at".format(min_index)
         else:
-            old_len = len(self._items)
-            # self.dump2()
-            echo1("  len: {}".format(old_len))
-            for index in reversed(range(min_index, old_len)):
-                self._remove(index)
-            # self.dump2()
-
-            for index in range(min_index, len(self._project._actions)):
-                echo2("  * re-adding [{}] after {}".format(index, do_s))
-                self._append_row(self._project._actions[index])
+            echo1("  len: {}".format(len(self._project._actions)))
+            echo2("  * re-binding rows from [{}] after {}"
+                  "".format(min_index, do_s))
+            self.set_row_count(len(self._project._actions))
+            self.refresh_rows(min_index)
+            # ^ Only rows in or near the view have widgets to refresh.
 
         if err is not None:
             return None, err
         self.update_undo()
         return None, None
 
+    def _patch_rows(self, entries):
+        '''
+        Update the rows after changes to the project, without showing
+        every row again: Rows keep their widgets when their actions
+        move, and only rows of actions with a changed field are bound
+        again (so the work depends on how many rows changed and are in
+        or near the view, not on where the change is).
+
+        Sequential arguments:
+        entries -- The changes in the form of journal entries (See
+            projectjournal) in the order they were made.
+        '''
+        mappers = []
+        set_luids = {}
+        for entry in entries:
+            if entry[0] == "set":
+                set_luids.setdefault(entry[1], set()).add(entry[2])
+                continue
+            try:
+                mappers.append(index_mapper(entry))
+            except ValueError as ex:
+                echo0("* reloading all rows since {}".format(ex))
+                self._reload_at(0, "patch")
+                return
+
+        def new_index_of(index):
+            for mapper in mappers:
+                index = mapper(index)
+                if index is None:
+                    break
+            return index
+
+        if len(mappers) > 0:
+            self.move_rows(new_index_of, count=len(self._project._actions))
+        for luid, keys in set_luids.items():
+            self._patch_luid(luid, keys)
+
+    def _patch_luid(self, luid, keys):
+        '''
+        Bind the row of the action again (if it has widgets) after the
+        given fields of the action changed.
+        '''
+        row = self._frame_of_luid.get(luid)
+        if row is None:
+            return  # It will be bound when it comes into view.
+        if ('statements' not in keys) and not any(k in row.vs for k in keys):
+            return  # None of the fields are shown (such as newest_path).
+        index = self._project._find_where('luid', luid)
+        if self.row_kind(index) != row.kind:
+            self.refresh_rows(index, index+1)
+        else:
+            self.bind_row(row, index)
+
     def _clear(self):
         '''
         Remove all rows. This action is private since the items must also be
         removed from the backend data.
         '''
-        for i in range(len(self._items)):
-            self._items[i].pack_forget()
-        del self._items[:]
+        self.set_row_count(0)
 
     def path_of_index(self, index):
         if index < len(self._project._actions):
@@ -1694,70 +1732,43 @@ class MainFrame(SFContainer):
         Remove a row at the given index. This action is private since the item
         should also be removed from the backend list.
         '''
-        self._items[index].pack_forget()
-        del self._items[index]
+        self._patch_rows([["remove", index]])
 
     def remove_where(self, luid):
         index = self._project._find_where('luid', luid)
-        i = self._find('luid', luid)
-        echo1("* removing [{}] luid {} at {}".format(i, luid, index))
-        if i != index:
-            raise RuntimeError(
-                "The visual data and backend project are out of sync:"
-                " (actions[{}]['luid']={}, _items[{}].data['luid']={})"
-                "".format(index, luid, i, luid)
-            )
+        echo1("* removing luid {} at {}".format(luid, index))
+        if index < 0:
+            raise ValueError("There is no luid {} in actions.".format(luid))
         self._project.remove(index)
         self.update_undo()
-        self._remove(i)
+        self._remove(index)
 
     def _insert(self, index, action):
         '''
-        Generate a new panel and insert it at the given index. This
-        method is private since the action must already exist at the
-        same index in the self._project._actions list so that both
-        lists match.
+        Show a new row at the given index. This method is private since
+        the action must already exist at the same index in the
+        self._project._actions list so that both lists match.
 
         Sequential arguments:
         index -- Insert the item here in the list view.
         action -- Insert this action dictionary.
         '''
-        more_items = []
-        count = 0
-        for i in range(index, len(self._items)):
-            count += 1
-            self._items[i].pack_forget()
-            more_items.append(self._items[i])
-        # self._items = self._items[:index]
-        old_len = len(self._items)
-        for i in reversed(range(index, old_len)):
-            self._remove(i)
-        self._append_row(action)
-        # (Don't modify other entries since removed rows will be re-added
-        # immediately below)
-        # luid = action['luid']
-        # echo1("* appended row {} luid {}".format(index, luid))
-        for i in range(len(more_items)):
-            item = more_items[i]
-            path = item.data.get('path')
-            row = len(self._items)
-            item.pack(fill=tk.X)
-            # echo1("* dequeued luid {}".format(more_items[i].data['luid']))
-            self._items.append(item)
+        if self._project._actions[index] is not action:
+            raise RuntimeError(
+                "The visual data and backend project are out of sync:"
+                " (The action {} is not at {})"
+                "".format(action.get('luid'), index)
+            )
+        self._patch_rows([["insert", index, action]])
 
     def swap(self, index, other_index):
         # luid = self._items[index]['luid']
         # other_luid = self._items[other_index]['luid']
         # self._project.swap(luid, other_luid)
         self._project.swap(index, other_index)
-        min_index = index
-        if other_index < min_index:
-            min_index = other_index
-        title = "Swap Rows Error"
-        result, err = self._reload_at(min_index, "swap")
-        if err is not None:
-            err = "Swapping at {} and {}\n\n".format(index, other_index) + err
-            messagebox.showerror(title, err)
+        self.update_undo()
+        self._patch_rows([["swap", index, other_index]])
+        # ^ Only the two rows move (and neither is bound again).
 
     def move_1(self, luid, direction):
         if direction == -1:
@@ -1788,19 +1799,16 @@ class MainFrame(SFContainer):
             messagebox.showerror("Error", "id {} doesn't exist.".format(luid))
             return
         other_index = index + 1
-        if other_index >= len(self._items):
+        if other_index >= len(self._project._actions):
             echo0("Can't move last element down.")
             return
         # other_luid = self._project._actions[other_index]['luid']
         self.swap(index, other_index)
 
     def _find(self, name, value):
-        for i in range(len(self._items)):
-            item = self._items[i]
-            # if item.data.get(name) == value:
-            if item.data[name] == value:
-                return i
-        return -1
+        if self._project is None:
+            return -1
+        return self._project._find_where(name, value)
 
     def insert_where(self, luid):
         '''
@@ -1813,18 +1821,7 @@ class MainFrame(SFContainer):
                    "".format(luid))
             messagebox.showerror("Error", msg)
             raise ValueError(msg)
-        item_i = self._find('luid', luid)
-        if item_i < 0:
-            msg = ("There is no luid {} in items."
-                   "".format(luid))
-            messagebox.showerror("Error", msg)
-            raise ValueError(msg)
-        if item_i != index:
-            msg = ("The data and project are out of sync:"
-                   " (actions[{}]['luid']={}, _items[{}].data['luid']={})"
-                   "".format(index, luid, item_i, luid))
-            messagebox.showerror("Error", msg)
-            raise RuntimeError(msg)
+        item_i = index
         action = None
         # next_action = self._project.get_action(luid)
         next_action = self._project._actions[index]
@@ -1911,10 +1908,16 @@ class MainFrame(SFContainer):
             self.last_path = os.path.dirname(path)
         self._init_title_row()
         self._clear()
-        self._project = ANCProject()
+        self._project = self._new_project()
         result, err = self._project.load(path)
         if result:
             self.update_undo()
+            if len(self._project.statement_errors) > 0:
+                messagebox.showerror(
+                    "Error",
+                    "Some statements are invalid:\n{}"
+                    "".format("\n".join(self._project.statement_errors))
+                )
             if err is not None:
                 # result is ok, but the file must have been repaired if msg
                 # is not None.
@@ -1927,11 +1930,13 @@ class MainFrame(SFContainer):
                 )
             for action in self._project._actions:
                 try:
-                    self._append_row(action)
+                    self._template_of(action)
                 except (ValueError, TypeError) as ex:
                     msg = str(ex)
                     echo0("action: {}".format(action))
                     messagebox.showerror("Error", msg)
+            self.set_row_count(len(self._project._actions))
+            # ^ Only rows in or near the view get widgets.
             self.dump1()
             return True
         else:
@@ -1950,11 +1955,13 @@ class MainFrame(SFContainer):
         '''
         global _GUI_DUMP
         global _BACKEND_DUMP
-        echos[level]("DUMP len: {}".format(len(self._items)))
+        shown = self.shown_rows()
+        echos[level]("DUMP len: {} ({} shown)"
+                     "".format(self._row_count, len(shown)))
         _GUI_DUMP = []
-        for i in range(len(self._items)):
-            path = self._items[i].data.get('path')
-            _GUI_DUMP.append(self._items[i].data.get('luid'))
+        for i, row in shown:
+            path = row.data.get('path')
+            _GUI_DUMP.append(row.data.get('luid'))
             name = path
             if path is not None:
                 name = os.path.split(path)[1]
@@ -1996,30 +2003,42 @@ class MainFrame(SFContainer):
         if os.path.isdir(path):
             self.last_path = path
         if self._project is None:
-            self._project = ANCProject()
-        else:
-            self._project.clear()
-            self.update_undo()
-        self._project.project_dir = path
-        count = 0
+            self._project = self._new_project()
         self._init_title_row()
-        failPaths = []
-        for sub in os.listdir(path):
-            subPath = os.path.join(path, sub)
-            if not os.path.isdir(subPath):
-                continue
-            result = self.append_source(subPath, do_save=False)
-            if not result:
-                failPaths.append(subPath)
-                break
-            count += 1
-        self._project.save()
-        echo1("Added {}".format(count))
-        for failPath in failPaths:
-            echo1('* failed to add {}'.format(failPath))
+        try:
+            actions = self._project.add_versions_in(path)
+            # ^ The rows are refreshed once by _on_project_changed.
+        except (ValueError, TypeError) as ex:
+            messagebox.showerror("Error", str(ex))
+            actions = []
+        self.update_undo()
+        echo1("Added {}".format(len(actions)))
         self.dump1()
 
+    def _new_project(self):
+        project = ANCProject()
+        project.save_scheduler = self._schedule_save
+        project.journaled = True
+        project.persist_undo = True
+        project.add_listener(self._on_project_changed, with_entries=True)
+        return project
+
+    def _on_project_changed(self, min_index, entries):
+        '''
+        Update the rows after a bulk change to the project.
+        '''
+        self._patch_rows(entries)
+
+    def _schedule_save(self, seconds, callback):
+        '''
+        Run the project's deferred save on the tkinter main loop so it
+        never overlaps a change.
+        '''
+        self.parent.after(int(seconds * 1000), callback)
+
     def exitProgram(self):
+        if self._project is not None:
+            self._project.flush()
         root.destroy()
 
 
@@ -2093,6 +2112,7 @@ def main():
         echo0("* current theme: {}".format(style.theme_use()))
 
     app = MainFrame(root, settings=settings)
+    root.protocol("WM_DELETE_WINDOW", app.exitProgram)
     if versions_path is not None:
         try_project = os.path.join(versions_path, "anewcommit.json")
         loaded = False
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+'''
+List the files of a version (a "manifest") along with their git blob
+ids, so that commits can be built without copying the version anywhere.
+
+A manifest is a dict where each key is a path relative to the version
+(action['path']) using "/", and each value is a list
+[mode, size, mtime_ns, sha] where mode is a git tree mode such as
+"100644" and sha is the git blob id. A manifest only covers the sources
+of the version (See version_pairs in the anewcommit module).
+'''
+from __future__ import print_function
+import os
+import stat
+import hashlib
+
+BLOB_CHUNK_SIZE = 1024 * 1024
+# ^ Read and stream files in pieces this large.
+
+M_MODE = 0
+M_SIZE = 1
+M_MTIME = 2
+M_SHA = 3
+
+
+def git_mode(st_mode):
+    '''
+    Get the git tree mode (as a str) for the st_mode of an lstat result,
+    or None if git can't store the type of file.
+    '''
+    if stat.S_ISLNK(st_mode):
+        return "120000"
+    if stat.S_ISREG(st_mode):
+        if st_mode & stat.S_IXUSR:
+            return "100755"
+        return "100644"
+    return None
+
+
+def git_blob_id(data):
+    '''
+    Get the SHA-1 that git would assign to a blob with the given bytes.
+    '''
+    sha = hashlib.sha1(b"blob %d\0" % len(data))
+    sha.update(data)
+    return sha.hexdigest()
+
+
+def iter_blob_chunks(path, mode):
+    '''
+    Read the blob data for a file (or the target of a symlink) in pieces.
+    '''
+    if mode == "120000":
+        yield os.readlink(path).encode("utf-8", "surrogateescape")
+        return
+    with open(path, 'rb') as ins:
+        while True:
+            chunk = ins.read(BLOB_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def hash_file(path, mode, size):
+    '''
+    Get the git blob id of a file without keeping it in memory.
+
+    Sequential arguments:
+    size -- The size of the blob (For a symlink, the length of the
+        target, not the lstat size).
+    '''
+    sha = hashlib.sha1(b"blob %d\0" % size)
+    for chunk in iter_blob_chunks(path, mode):
+        sha.update(chunk)
+    return sha.hexdigest()
+
+
+def walk_files(root):
+    '''
+    Yield a tuple (rel, path, mode, st) for every file under root that git
+    can store, where rel is relative to root and uses "/".
+    '''
+    for parent, dirs, files in os.walk(root):
+        if ".git" in dirs:
+            dirs.remove(".git")
+        rel_parent = os.path.relpath(parent, root)
+        names = files + [d for d in dirs
+                         if os.path.islink(os.path.join(parent, d))]
+        for name in names:
+            path = os.path.join(parent, name)
+            st = os.lstat(path)
+            mode = git_mode(st.st_mode)
+            if mode is None:
+                continue
+            rel = name
+            if rel_parent != ".":
+                rel = os.path.join(rel_parent, name)
+            if os.path.sep != "/":
+                rel = rel.replace(os.path.sep, "/")
+            yield rel, path, mode, st
+
+
+def _entry_size(path, mode, st):
+    if mode == "120000":
+        return len(os.readlink(path).encode("utf-8", "surrogateescape"))
+    return st.st_size
+
+
+def scan_manifest(version_path, sources, old=None):
+    '''
+    Get the manifest of a version, only hashing files that are new or
+    whose mode, size or mtime differ from the old manifest.
+
+    Sequential arguments:
+    version_path -- The version's directory (action['path']).
+    sources -- The absolute source directories to scan (See
+        version_pairs). Each must be version_path or under it.
+
+    Keyword arguments:
+    old -- A previous manifest of the same version.
+
+    Returns:
+    a tuple (manifest, hashed_count).
+    '''
+    if old is None:
+        old = {}
+    manifest = {}
+    hashed = 0
+    roots = []
+    for src in sorted(set(sources)):
+        # Skip sources inside other sources (They are already scanned).
+        if any(src.startswith(root + os.path.sep) for root in roots):
+            continue
+        roots.append(src)
+    for src in roots:
+        if not os.path.isdir(src):
+            continue
+        prefix = os.path.relpath(src, version_path)
+        if prefix.startswith(".."):
+            raise ValueError('"{}" is not in "{}"'
+                             ''.format(src, version_path))
+        if os.path.sep != "/":
+            prefix = prefix.replace(os.path.sep, "/")
+        for rel, path, mode, st in walk_files(src):
+            if prefix != ".":
+                rel = prefix + "/" + rel
+            size = _entry_size(path, mode, st)
+            prev = old.get(rel)
+            if ((prev is not None) and (prev[M_MODE] == mode)
+                    and (prev[M_SIZE] == size)
+                    and (prev[M_MTIME] == st.st_mtime_ns)
+                    and (prev[M_SHA] is not None)):
+                manifest[rel] = prev
+                continue
+            manifest[rel] = [mode, size, st.st_mtime_ns,
+                             hash_file(path, mode, size)]
+            hashed += 1
+    return manifest, hashed
+
+
+def manifest_tree(manifest, version_path, pairs):
+    '''
+    Place the files of a manifest at their destinations.
+
+    Sequential arguments:
+    manifest -- The manifest of the version (See scan_manifest).
+    version_path -- The version's directory (action['path']).
+    pairs -- (source, destination) tuples (See version_pairs).
+
+    Returns:
+    a dict where each key is a path in the commit and each value is a
+    tuple (mode, sha, rel) where rel is the key in the manifest.
+    '''
+    tree = {}
+    dst_roots = set()
+    for src, dst in pairs:
+        if dst != "":
+            dst_roots.add(dst.replace(os.path.sep, "/").split("/")[0])
+    for src, dst in pairs:
+        prefix = os.path.relpath(src, version_path)
+        if os.path.sep != "/":
+            prefix = prefix.replace(os.path.sep, "/")
+        if prefix == ".":
+            prefix = ""
+        else:
+            prefix += "/"
+        dst_prefix = dst.replace(os.path.sep, "/")
+        if dst_prefix != "":
+            dst_prefix += "/"
+        for rel, entry in manifest.items():
+            if not rel.startswith(prefix):
+                continue
+            sub = rel[len(prefix):]
+            if (dst_prefix == "") and (sub.split("/")[0] in dst_roots):
+                # Other sources are placed there (like in sync_version).
+                continue
+            tree[dst_prefix + sub] = (
+                entry[M_MODE], entry[M_SHA], rel
+            )
+    return tree
+
+
+def diff_manifests(old, new):
+    '''
+    Compare two manifests (of directories or archives) without reading
+    any files.
+
+    Returns:
+    a tuple (added, removed, changed) of sorted lists of paths, where
+    changed paths have a different blob id or mode.
+    '''
+    added = sorted(rel for rel in new if rel not in old)
+    removed = sorted(rel for rel in old if rel not in new)
+    changed = sorted(
+        rel for rel, entry in new.items()
+        if (rel in old)
+        and ((old[rel][M_SHA] != entry[M_SHA])
+             or (old[rel][M_MODE] != entry[M_MODE]))
+    )
+    return added, removed, changed
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+'''
+Write blobs directly to a git packfile, storing each file as a delta
+against the previous blob at the same path when that is smaller.
+
+Consecutive snapshots usually differ by small edits to large files (such
+as SQL dumps or bundled JavaScript), so a delta is usually a small
+fraction of the file. The pack is written with an index (version 2) into
+the objects/pack directory of the repository, where fast-import (and
+every other git command) can find the objects by id.
+
+Only blobs are packed. Trees and commits are still made by fast-import.
+'''
+from __future__ import print_function
+import os
+import zlib
+import struct
+import hashlib
+import tempfile
+
+from anewcommit.blobpool import (
+    git_objects_dir,
+)
+
+from anewcommit.manifest import (
+    iter_blob_chunks,
+)
+
+OBJ_BLOB = 3
+OBJ_OFS_DELTA = 6
+
+DEFAULT_DEPTH = 50
+# ^ the maximum length of a delta chain (same as pack.depth in git).
+
+DELTA_MAX_SIZE = 64 * 1024 * 1024
+# ^ Files larger than this are stored whole (A delta needs both the
+#   file and its base in memory).
+
+DELTA_BLOCK = 16
+# ^ Only matches at least this long become copy instructions.
+
+PACK_COMPRESSION = zlib.Z_DEFAULT_COMPRESSION
+
+
+def delta_size_bytes(size):
+    '''
+    Encode a size for the header of a delta (little-endian base 128).
+    '''
+    out = bytearray()
+    while True:
+        byte = size & 0x7f
+        size >>= 7
+        if size:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _append_insert(out, data):
+    for start in range(0, len(data), 0x7f):
+        piece = data[start:start+0x7f]
+        out.append(len(piece))
+        out += piece
+
+
+def _append_copy(out, offset, size):
+    while size > 0:
+        count = min(size, 0xffffff)
+        cmd = 0x80
+        args = bytearray()
+        for shift in range(4):
+            byte = (offset >> (8 * shift)) & 0xff
+            if byte:
+                cmd |= 1 << shift
+                args.append(byte)
+        for shift in range(3):
+            byte = (count >> (8 * shift)) & 0xff
+            if byte:
+                cmd |= 0x10 << shift
+                args.append(byte)
+        out.append(cmd)
+        out += args
+        offset += count
+        size -= count
+
+
+def _match_length(src, src_at, dst, dst_at, limit):
+    '''
+    Get how many bytes match at src[src_at:] and dst[dst_at:] (up to
+    limit) comparing large pieces first.
+    '''
+    length = 0
+    for step in (4096, 256, 16, 1):
+        while ((length + step <= limit)
+                and (src[src_at+length:src_at+length+step]
+                     == dst[dst_at+length:dst_at+length+step])):
+            length += step
+    return length
+
+
+def make_delta(src, dst, max_size=None):
+    '''
+    Make a git delta that turns src into dst.
+
+    Sequential arguments:
+    src -- The base (bytes).
+    dst -- The target (bytes).
+
+    Keyword arguments:
+    max_size -- Give up and return None once the delta would be larger
+        than this.
+
+    Returns:
+    the delta (bytes), or None if it would be larger than max_size.
+    '''
+    index = {}
+    for at in range(0, len(src) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        index.setdefault(src[at:at+DELTA_BLOCK], at)
+    out = bytearray(delta_size_bytes(len(src)) + delta_size_bytes(len(dst)))
+    literal_start = 0
+    at = 0
+    end = len(dst)
+    while at + DELTA_BLOCK <= end:
+        if (max_size is not None) and (len(out) + at - literal_start
+                                       > max_size):
+            return None
+        src_at = index.get(dst[at:at+DELTA_BLOCK])
+        if src_at is None:
+            at += 1
+            continue
+        # Extend the match backward into the pending literal bytes:
+        while ((at > literal_start) and (src_at > 0)
+                and (src[src_at-1] == dst[at-1])):
+            at -= 1
+            src_at -= 1
+        length = _match_length(src, src_at, dst, at,
+                               min(len(src) - src_at, end - at))
+        _append_insert(out, dst[literal_start:at])
+        _append_copy(out, src_at, length)
+        at += length
+        literal_start = at
+    _append_insert(out, dst[literal_start:])
+    if (max_size is not None) and (len(out) > max_size):
+        return None
+    return bytes(out)
+
+
+def object_header(type_id, size):
+    '''
+    Encode the type and (uncompressed) size of an object in a pack.
+    '''
+    out = bytearray()
+    byte = (type_id << 4) | (size & 0x0f)
+    size >>= 4
+    while size:
+        out.append(byte | 0x80)
+        byte = size & 0x7f
+        size >>= 7
+    out.append(byte)
+    return bytes(out)
+
+
+def ofs_delta_offset(distance):
+    '''
+    Encode how far back the base of an OFS_DELTA object is.
+    '''
+    out = bytearray([distance & 0x7f])
+    distance >>= 7
+    while distance:
+        distance -= 1
+        out.insert(0, 0x80 | (distance & 0x7f))
+        distance >>= 7
+    return bytes(out)
+
+
+def read_blob_data(path, mode):
+    return b"".join(iter_blob_chunks(path, mode))
+
+
+class PackWriter:
+    '''
+    Write blobs to one new pack in a repository.
+
+    Public Attributes:
+    max_depth -- The longest allowed chain of deltas.
+    deltas -- The number of blobs stored as deltas.
+    raw_size -- The total size of the blobs added.
+    '''
+    def __init__(self, repo_dir, git="git", max_depth=DEFAULT_DEPTH):
+        self.pack_dir = os.path.join(git_objects_dir(repo_dir, git=git),
+                                     "pack")
+        if not os.path.isdir(self.pack_dir):
+            os.makedirs(self.pack_dir)
+        self.max_depth = max_depth
+        self.deltas = 0
+        self.raw_size = 0
+        self._entries = {}
+        # ^ _entries[sha] = (offset, crc32, depth)
+        fd, self._tmp_path = tempfile.mkstemp(prefix="tmp_pack_",
+                                              dir=self.pack_dir)
+        self._outs = os.fdopen(fd, 'w+b')
+        self._outs.write(b"PACK" + struct.pack(">II", 2, 0))
+        self._offset = 12
+
+    def __contains__(self, sha):
+        return sha in self._entries
+
+    def shas(self):
+        '''
+        Get the ids of the blobs in the pack.
+        '''
+        return list(self._entries.keys())
+
+    def _write_object(self, sha, header, chunks, depth):
+        offset = self._offset
+        crc = zlib.crc32(header)
+        self._outs.write(header)
+        size = len(header)
+        zipper = zlib.compressobj(PACK_COMPRESSION)
+        for chunk in chunks:
+            piece = zipper.compress(chunk)
+            if piece:
+                crc = zlib.crc32(piece, crc)
+                self._outs.write(piece)
+                size += len(piece)
+        piece = zipper.flush()
+        crc = zlib.crc32(piece, crc)
+        self._outs.write(piece)
+        size += len(piece)
+        self._offset += size
+        self._entries[sha] = (offset, crc & 0xffffffff, depth)
+
+    def add_file(self, sha, size, path, mode, base=None):
+        '''
+        Add a file (or the target of a symlink) as a blob.
+
+        Sequential arguments:
+        sha -- The blob id of the file (from its manifest).
+        size -- The size of the blob.
+
+        Keyword arguments:
+        base -- The (sha, path, mode) of the previous blob at the same
+            path in the commit, used as the base of a delta if it is in
+            this pack and the chain isn't too long.
+
+        Returns:
+        True if stored as a delta, otherwise False.
+        '''
+        if sha in self._entries:
+            return False
+        self.raw_size += size
+        base_entry = None
+        if (base is not None) and (size <= DELTA_MAX_SIZE):
+            base_entry = self._entries.get(base[0])
+        if (base_entry is not None) and (base_entry[2] < self.max_depth):
+            data = read_blob_data(path, mode)
+            src = read_blob_data(base[1], base[2])
+            if len(data) != size:
+                raise RuntimeError('"{}" changed after it was listed'
+                                   ''.format(path))
+            delta = None
+            if hashlib.sha1(b"blob %d\0" % len(src) + src).hexdigest() \
+                    == base[0]:
+                delta = make_delta(src, data, max_size=size // 2)
+            if delta is not None:
+                self._check_sha(sha, path, data)
+                header = (object_header(OBJ_OFS_DELTA, len(delta))
+                          + ofs_delta_offset(self._offset - base_entry[0]))
+                self._write_object(sha, header, [delta], base_entry[2] + 1)
+                self.deltas += 1
+                return True
+            self._check_sha(sha, path, data)
+            self._write_object(sha, object_header(OBJ_BLOB, size), [data],
+                               0)
+            return False
+        self._write_object(
+            sha,
+            object_header(OBJ_BLOB, size),
+            self._checked_chunks(sha, size, path, mode),
+            0,
+        )
+        return False
+
+    def _check_sha(self, sha, path, data):
+        got = hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+        if got != sha:
+            raise RuntimeError('"{}" changed after it was listed'
+                               ''.format(path))
+
+    def _checked_chunks(self, sha, size, path, mode):
+        hasher = hashlib.sha1(b"blob %d\0" % size)
+        for chunk in iter_blob_chunks(path, mode):
+            hasher.update(chunk)
+            yield chunk
+        if hasher.hexdigest() != sha:
+            raise RuntimeError('"{}" changed after it was listed'
+                               ''.format(path))
+
+    def _index_data(self, pack_sha):
+        '''
+        Generate a version 2 pack index.
+        '''
+        shas = sorted(bytes.fromhex(sha) for sha in self._entries)
+        fanout = [0] * 256
+        for sha in shas:
+            fanout[sha[0]] += 1
+        total = 0
+        for first in range(256):
+            total += fanout[first]
+            fanout[first] = total
+        parts = [b"\377tOc", struct.pack(">I", 2),
+                 struct.pack(">256I", *fanout)]
+        parts += shas
+        entries = [self._entries[sha.hex()] for sha in shas]
+        parts += [struct.pack(">I", entry[1]) for entry in entries]
+        large = []
+        for entry in entries:
+            if entry[0] < 0x80000000:
+                parts.append(struct.pack(">I", entry[0]))
+            else:
+                parts.append(struct.pack(">I", 0x80000000 | len(large)))
+                large.append(struct.pack(">Q", entry[0]))
+        parts += large
+        parts.append(pack_sha)
+        data = b"".join(parts)
+        return data + hashlib.sha1(data).digest()
+
+    def abort(self):
+        if self._outs is not None:
+            self._outs.close()
+            self._outs = None
+            os.remove(self._tmp_path)
+
+    def close(self):
+        '''
+        Finish the pack and move it (and its index) into place.
+
+        Returns:
+        the path of the pack, or None if no blobs were added.
+        '''
+        if len(self._entries) == 0:
+            self.abort()
+            return None
+        outs = self._outs
+        outs.seek(8)
+        outs.write(struct.pack(">I", len(self._entries)))
+        outs.flush()
+        outs.seek(0)
+        hasher = hashlib.sha1()
+        while True:
+            chunk = outs.read(1024 * 1024)
+            if not chunk:
+                break
+            hasher.update(chunk)
+        pack_sha = hasher.digest()
+        outs.write(pack_sha)
+        outs.flush()
+        os.fsync(outs.fileno())
+        outs.close()
+        self._outs = None
+        name = "pack-" + pack_sha.hex()
+        pack_path = os.path.join(self.pack_dir, name + ".pack")
+        idx_path = os.path.join(self.pack_dir, name + ".idx")
+        fd, tmp_idx = tempfile.mkstemp(prefix="tmp_idx_", dir=self.pack_dir)
+        with os.fdopen(fd, 'wb') as idx_outs:
+            idx_outs.write(self._index_data(pack_sha))
+        os.chmod(self._tmp_path, 0o444)
+        os.chmod(tmp_idx, 0o444)
+        os.replace(self._tmp_path, pack_path)
+        os.replace(tmp_idx, idx_path)
+        # ^ The index goes last since git looks for packs by index.
+        return pack_path
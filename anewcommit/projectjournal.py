@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+'''
+Keep changes to a project file (anewcommit.json) in an append-only
+journal, so saving a change writes only that change.
+
+The first line of a journal is ["begin", journal_id], where journal_id
+is the value of JOURNAL_ID in the snapshot (the project file) that the
+journal applies to. Each later line is one change in the form of a list:
+["insert", index, action]
+["remove", index]
+["swap", index, other_index]
+["insert_many", [[index, action], ...]] (See insert_pairs)
+["remove_many", [index, ...]]
+["move_range", start, stop, to] (See move_range)
+["reorder", order] (See reorder)
+["set", luid, key, value]
+["clear"]
+A journal whose journal_id doesn't match the snapshot is ignored, since
+that only happens if the snapshot was written but the program stopped
+before the journal was reset (so the snapshot already has the changes).
+'''
+from __future__ import print_function
+
+import os
+import json
+from bisect import bisect_left, bisect_right
+
+from .find_hierosoft import hierosoft
+
+from hierosoft.logging import (
+    echo0,
+)
+
+JOURNAL_SUFFIX = "-journal.jsonl"
+JOURNAL_ID = 'journal_id'
+
+
+def journal_path(project_path):
+    '''
+    Get the journal path for a project file, such as
+    "anewcommit-journal.jsonl" for "anewcommit.json".
+    '''
+    return os.path.splitext(project_path)[0] + JOURNAL_SUFFIX
+
+
+class ProjectJournal:
+    '''
+    Read and append the journal for one project file.
+
+    Public Properties:
+    path -- The journal file.
+    count -- The number of changes in the journal (excluding the
+        header).
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._journal_id = None  # the id in the header on disk
+
+    def load(self, journal_id):
+        '''
+        Get the list of changes for the snapshot with the given
+        journal_id, or an empty list if the journal belongs to another
+        snapshot (or doesn't exist).
+        '''
+        self.count = 0
+        self._journal_id = None
+        entries = []
+        if (journal_id is None) or not os.path.isfile(self.path):
+            return entries
+        with open(self.path, 'r') as ins:
+            for line in ins:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may be partial after a crash.
+                    echo0('* ignored a bad line in "{}"'.format(self.path))
+                    break
+                if self._journal_id is None:
+                    if entry != ["begin", journal_id]:
+                        echo0('* ignored "{}" since it is older than the'
+                              ' project file'.format(self.path))
+                        return []
+                    self._journal_id = journal_id
+                    continue
+                entries.append(entry)
+        self.count = len(entries)
+        return entries
+
+    def append(self, journal_id, lines):
+        '''
+        Append changes (each already encoded as a JSON line without the
+        newline) and make sure they are on disk.
+        '''
+        if len(lines) == 0:
+            return
+        mode = 'a'
+        if self._journal_id != journal_id:
+            mode = 'w'  # Replace a journal for an older snapshot.
+            self.count = 0
+        with open(self.path, mode) as outs:
+            if mode == 'w':
+                outs.write(json.dumps(["begin", journal_id]) + "\n")
+            for line in lines:
+                outs.write(line + "\n")
+            outs.flush()
+            os.fsync(outs.fileno())
+        self._journal_id = journal_id
+        self.count += len(lines)
+
+    def discard(self):
+        '''
+        Remove the journal (after its changes are in a new snapshot).
+        '''
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self._journal_id = None
+        self.count = 0
+
+
+def insert_pairs(actions, pairs):
+    '''
+    Insert actions in one pass.
+
+    Sequential arguments:
+    actions -- The list to change in place.
+    pairs -- A list of [index, action] pairs sorted by index, where each
+        index is the index the action will have afterward.
+    '''
+    result = []
+    src_i = 0
+    for index, action in pairs:
+        take = index - len(result)
+        if (take < 0) or (src_i + take > len(actions)):
+            raise IndexError("The index {} is out of order or beyond the"
+                             " end of the list.".format(index))
+        result.extend(actions[src_i:src_i+take])
+        src_i += take
+        result.append(action)
+    result.extend(actions[src_i:])
+    actions[:] = result
+
+
+def remove_indices(actions, indices):
+    '''
+    Remove actions in one pass.
+
+    Sequential arguments:
+    actions -- The list to change in place.
+    indices -- A sorted list of indices to remove (without repeats).
+
+    Returns:
+    a list of [index, action] pairs that insert_pairs can put back.
+    '''
+    pairs = [[index, actions[index]] for index in indices]
+    remove = set(indices)
+    actions[:] = [actions[index] for index in range(len(actions))
+                  if index not in remove]
+    return pairs
+
+
+def move_range(actions, start, stop, to):
+    '''
+    Move actions[start:stop] so the first of them is at index "to"
+    afterward (move_range(actions, to, to+stop-start, start) undoes it).
+    '''
+    count = stop - start
+    if ((start < 0) or (stop > len(actions)) or (count < 0) or (to < 0)
+            or (to + count > len(actions))):
+        raise IndexError("The range {}:{} can't move to {} in a list of {}"
+                         "".format(start, stop, to, len(actions)))
+    block = actions[start:stop]
+    rest = actions[:start] + actions[stop:]
+    actions[:] = rest[:to] + block + rest[to:]
+
+
+def reorder(actions, order):
+    '''
+    Put actions in a new order, where order is a list of the current
+    indices in the new order (reorder(actions, inverse_order(order))
+    undoes it).
+    '''
+    if sorted(order) != list(range(len(actions))):
+        raise IndexError("The order {} isn't a reordering of {} actions"
+                         "".format(order, len(actions)))
+    actions[:] = [actions[index] for index in order]
+
+
+def inverse_order(order):
+    '''
+    Get the order that undoes reorder(actions, order).
+    '''
+    inverse = [None] * len(order)
+    for new_index, index in enumerate(order):
+        inverse[index] = new_index
+    return inverse
+
+
+def index_mapper(entry):
+    '''
+    Get a function that gets the index that an action has after the
+    change in entry from the index it had before, or None if the
+    action was removed (so a view can move what it shows for each
+    action instead of showing everything again).
+    '''
+    op = entry[0]
+    if op == "insert":
+        at = entry[1]
+        return lambda index: index if index < at else index + 1
+    elif op == "remove":
+        at = entry[1]
+
+        def new_index(index):
+            if index == at:
+                return None
+            return index if index < at else index - 1
+        return new_index
+    elif op == "swap":
+        swapped = {entry[1]: entry[2], entry[2]: entry[1]}
+        return lambda index: swapped.get(index, index)
+    elif op == "insert_many":
+        # The inserted actions can only be before an action that
+        # was at index if (their index - how many are before them)
+        # is <= index:
+        limits = [pair[0] - count for count, pair in enumerate(entry[1])]
+        return lambda index: index + bisect_right(limits, index)
+    elif op == "remove_many":
+        removed = entry[1]
+        removed_set = set(removed)
+
+        def new_index(index):
+            if index in removed_set:
+                return None
+            return index - bisect_left(removed, index)
+        return new_index
+    elif op == "move_range":
+        start, stop, to = entry[1], entry[2], entry[3]
+        count = stop - start
+
+        def new_index(index):
+            if start <= index < stop:
+                return to + index - start
+            if index >= stop:
+                index -= count
+            return index if index < to else index + count
+        return new_index
+    elif op == "reorder":
+        return inverse_order(entry[1]).__getitem__
+    elif op == "set":
+        return lambda index: index
+    elif op == "clear":
+        return lambda index: None
+    raise ValueError("unknown op {}".format(op))
+
+
+def replay(actions, entries):
+    '''
+    Apply journal entries to a list of action dictionaries in place.
+
+    Returns:
+    the number of entries applied (Replay stops at the first entry that
+    doesn't apply, and the rest are skipped with a message).
+    '''
+    by_luid = {}
+    for action in actions:
+        by_luid[action.get('luid')] = action
+    done = 0
+    for entry in entries:
+        try:
+            op = entry[0]
+            if op == "insert":
+                actions.insert(entry[1], entry[2])
+                by_luid[entry[2].get('luid')] = entry[2]
+            elif op == "remove":
+                action = actions.pop(entry[1])
+                by_luid.pop(action.get('luid'), None)
+            elif op == "swap":
+                index, other_index = entry[1], entry[2]
+                actions[index], actions[other_index] = \
+                    actions[other_index], actions[index]
+            elif op == "insert_many":
+                insert_pairs(actions, entry[1])
+                for index, action in entry[1]:
+                    by_luid[action.get('luid')] = action
+            elif op == "remove_many":
+                for index, action in remove_indices(actions, entry[1]):
+                    by_luid.pop(action.get('luid'), None)
+            elif op == "move_range":
+                move_range(actions, entry[1], entry[2], entry[3])
+            elif op == "reorder":
+                reorder(actions, entry[1])
+            elif op == "set":
+                by_luid[entry[1]][entry[2]] = entry[3]
+            elif op == "clear":
+                del actions[:]
+                by_luid = {}
+            else:
+                raise ValueError("unknown op {}".format(op))
+        except (IndexError, KeyError, TypeError, ValueError) as ex:
+            echo0("* skipped {} journal change(s) starting with {}: {}"
+                  "".format(len(entries) - done, entry, ex))
+            break
+        done += 1
+    return done
@@ -10,6 +10,9 @@ Oct 10, 2022
 > scrollbar to the application window.
 
 -Jose Salvatierra
+
+For a long list, use virtual rows instead (See SFContainer.set_row_count)
+so that only rows in or near the view have widgets.
 '''
 from __future__ import print_function
 import sys
@@ -80,23 +83,232 @@ class SFContainer(ttk.Frame):
 
         # ttk.Frame.__init__(self, container, *args, **kwargs)
         canvas = tk.Canvas(self)
-        scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=canvas.yview)
+        self.canvas = canvas
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL,
+                                       command=canvas.yview)
         self.scrollable_frame = ttk.Frame(canvas)
+        # ^ Widgets added to scrollable_frame scroll as usual (such as a
+        #   title row). Virtual rows (See set_row_count) go below it.
+
+        self.row_height = 24
+        # ^ The height of every virtual row (It only grows, since it
+        #   becomes the height of the tallest row made so far).
+        self.row_margin = 10
+        # ^ How many rows above and below the view also have widgets.
+        self._row_count = 0
+        self._shown = {}  # the virtual row at each index that has one
+        self._free = {}  # unused virtual rows for each kind of row
+        self._update_id = None
+        self._updating = False
 
         self.scrollable_frame.bind(
             "<Configure>",
-            lambda e: canvas.configure(
-                scrollregion=canvas.bbox("all")
-            )
+            lambda e: self._layout_rows(),
         )
+        canvas.bind("<Configure>", self._on_canvas_configure)
 
         canvas.create_window((0, 0), window=self.scrollable_frame,
                              anchor=tk.NW)
 
-        canvas.configure(yscrollcommand=scrollbar.set)
+        canvas.configure(yscrollcommand=self._on_yscroll)
 
         canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=tk.YES)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+    def row_kind(self, index):
+        '''
+        Get a hashable value that is the same for every row that can
+        reuse the same widgets (optional: By default all rows are one
+        kind). A subclass that uses virtual rows should override
+        make_row and bind_row.
+        '''
+        return None
+
+    def make_row(self, kind, index):
+        '''
+        Make a new row (usually a frame with self.canvas as its parent)
+        of the given kind. The widgets should not be packed since the
+        row is placed on the canvas. The row is bound (See bind_row)
+        right afterward, so index is only for getting an example of the
+        data. By default, the row is an empty frame.
+        '''
+        return ttk.Frame(self.canvas)
+
+    def bind_row(self, row, index):
+        '''
+        Show the data at index in a row from make_row (that may have
+        shown other data before).
+        '''
+        pass
+
+    def unbind_row(self, row):
+        '''
+        Forget the data in a row that is no longer shown (optional).
+        '''
+        pass
+
+    def set_row_count(self, count):
+        '''
+        Set how many virtual rows there are. Rows that already have
+        widgets are not bound again (See refresh_rows).
+        '''
+        self._row_count = count
+        for index in [i for i in self._shown if i >= count]:
+            self._hide_row(index)
+        self._update_scrollregion()
+        self._update_rows()
+
+    def refresh_rows(self, start=0, stop=None):
+        '''
+        Bind the rows from start to stop (exclusive, or to the end if
+        None) again after the data changed. Only rows in or near the
+        view have widgets, so this is fast no matter how many rows
+        there are.
+        '''
+        if stop is None:
+            stop = self._row_count
+        for index in [i for i in self._shown if start <= i < stop]:
+            self._hide_row(index)
+        self._update_rows()
+
+    def move_rows(self, new_index_of, count=None):
+        '''
+        Move the rows that have widgets to new indices without binding
+        them again (such as after rows were inserted, removed or
+        reordered). Rows that come into view are bound as usual.
+
+        Sequential arguments:
+        new_index_of -- A function that gets the new index of a row
+            from its old index, or None if the row was removed.
+
+        Keyword arguments:
+        count -- Set the new number of rows (None to keep it).
+        '''
+        if count is not None:
+            self._row_count = count
+        shown = self._shown
+        self._shown = {}
+        for index, row in shown.items():
+            new_index = new_index_of(index)
+            if (new_index is None) or (new_index >= self._row_count):
+                self._release_row(row)
+                continue
+            self._shown[new_index] = row
+            if new_index != index:
+                self.canvas.coords(row.window, 0, self._row_y(new_index))
+        self._update_scrollregion()
+        self._update_rows()
+
+    def row_at(self, index):
+        '''
+        Get the row at index, or None if it has no widgets.
+        '''
+        return self._shown.get(index)
+
+    def shown_rows(self):
+        '''
+        Get a sorted list of (index, row) for the rows that have widgets.
+        '''
+        return sorted(self._shown.items(), key=lambda pair: pair[0])
+
+    def _header_height(self):
+        return self.scrollable_frame.winfo_reqheight()
+
+    def _row_y(self, index):
+        return self._header_height() + index * self.row_height
+
+    def _update_scrollregion(self):
+        width = self.canvas.winfo_width()
+        height = self._row_y(self._row_count)
+        self.canvas.configure(scrollregion=(0, 0, width, height))
+
+    def _visible_range(self):
+        top = self.canvas.canvasy(0) - self._header_height()
+        bottom = top + self.canvas.winfo_height()
+        start = int(top // self.row_height) - self.row_margin
+        stop = int(bottom // self.row_height) + 1 + self.row_margin
+        return max(start, 0), min(stop, self._row_count)
+
+    def _on_yscroll(self, first, last):
+        self.scrollbar.set(first, last)
+        if self._update_id is None:
+            self._update_id = self.after_idle(self._update_rows)
+            # ^ The view can change several times before the next redraw.
+
+    def _on_canvas_configure(self, event):
+        for index, row in self._shown.items():
+            self.canvas.itemconfigure(row.window, width=event.width)
+        self._update_scrollregion()
+        self._update_rows()
+
+    def _update_rows(self):
+        '''
+        Give widgets to the rows in and near the view, and take them
+        from the rest.
+        '''
+        if self._update_id is not None:
+            self.after_cancel(self._update_id)
+            self._update_id = None
+        if self._updating:
+            return
+            # ^ Measuring a new row runs idle tasks (See _show_row).
+        self._updating = True
+        old_height = self.row_height
+        try:
+            start, stop = self._visible_range()
+            for index in [i for i in self._shown
+                          if not (start <= i < stop)]:
+                self._hide_row(index)
+            for index in range(start, stop):
+                if index not in self._shown:
+                    self._show_row(index)
+        finally:
+            self._updating = False
+        if self.row_height != old_height:
+            self._layout_rows()  # A taller kind of row was made.
+
+    def _show_row(self, index):
+        kind = self.row_kind(index)
+        free = self._free.get(kind)
+        if free:
+            row = free.pop()
+        else:
+            row = self.make_row(kind, index)
+            row.kind = kind
+            row.window = self.canvas.create_window(
+                (0, 0), window=row, anchor=tk.NW,
+                width=self.canvas.winfo_width(), height=self.row_height,
+            )
+            row.update_idletasks()
+            if row.winfo_reqheight() > self.row_height:
+                self.row_height = row.winfo_reqheight()
+        self.bind_row(row, index)
+        self.canvas.coords(row.window, 0, self._row_y(index))
+        self.canvas.itemconfigure(row.window, state=tk.NORMAL,
+                                  width=self.canvas.winfo_width())
+        self._shown[index] = row
+
+    def _hide_row(self, index):
+        self._release_row(self._shown.pop(index))
+
+    def _release_row(self, row):
+        self.canvas.itemconfigure(row.window, state=tk.HIDDEN)
+        self.unbind_row(row)
+        self._free.setdefault(row.kind, []).append(row)
+
+    def _layout_rows(self):
+        '''
+        Place the rows again after the height of the header or of the
+        rows changed.
+        '''
+        for rows in [self._shown.values()] + list(self._free.values()):
+            for row in rows:
+                self.canvas.itemconfigure(row.window,
+                                          height=self.row_height)
+        for index, row in self._shown.items():
+            self.canvas.coords(row.window, 0, self._row_y(index))
+        self._update_scrollregion()
+        self._update_rows()
 
     '''
     The scrollable_frame must become the parent of all sub-widgets, but
@@ -0,0 +1,523 @@
+#!/usr/bin/env python
+'''
+Export subprojects of the versions in an anewcommit project to their own
+repositories, as configured by conf.d/<project>/subsnaps/**.json (See
+"subproject configuration" in readme.md).
+
+Each entry is resolved against every version first, then every
+subproject is imported by a separate worker process with its own
+"git fast-import" stream, so exporting all of them takes about as long
+as exporting the largest one.
+'''
+from __future__ import print_function
+import os
+import re
+import json
+import time
+import hashlib
+import tempfile
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from anewcommit import (
+    echo0,
+    echo1,
+    VERSION_VERBS,
+)
+
+from anewcommit.archivetree import (
+    ArchiveTree,
+    archive_id,
+    stat_archive_id,
+    strip_archive_ext,
+    strip_single_root,
+)
+
+from anewcommit.manifest import (
+    BLOB_CHUNK_SIZE,
+    hash_file,
+    iter_blob_chunks,
+    walk_files,
+)
+
+from anewcommit.gitexport import (
+    DEFAULT_BRANCH,
+    INLINE_BLOB_MAX,
+    FastImportStream,
+    action_datetime,
+    ensure_repo,
+    git_ident,
+    ref_exists,
+)
+
+_version_suffix_re = re.compile(r'[-_](?:(?:git|svn)[-_])?[0-9][0-9A-Za-z.]*$')
+_vcs_suffix_re = re.compile(r'[-_](?:git|svn)$')
+_variable_re = re.compile(r'<([A-Za-z0-9_]+)>')
+
+
+def compile_template(value):
+    '''
+    Split a str such as "luajit-git-<upstream_commit>.tar.bz2" into a
+    tuple of parts where odd-numbered parts are field names, such as
+    ("luajit-git-", "upstream_commit", ".tar.bz2").
+    '''
+    return tuple(_variable_re.split(value))
+
+
+class EntryTemplate:
+    '''
+    Resolve "<field>" placeholders in the str values of a subsnaps entry,
+    where each value is parsed once when the entry is loaded.
+
+    A field may use a field that uses another (2 passes), such as if
+    "archive" uses "<tarball>" and "tarball" uses "<upstream_commit>".
+    Unknown fields are left as-is (such as "<missing>").
+    '''
+    PASSES = 2
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.templates = {}
+        for key, value in entry.items():
+            if isinstance(value, str) and ("<" in value):
+                self.templates[key] = compile_template(value)
+
+    def _render(self, key, passes, done):
+        memo_key = (key, passes)
+        if memo_key in done:
+            return done[memo_key]
+        parts = self.templates[key]
+        pieces = []
+        for number, part in enumerate(parts):
+            if number % 2 == 0:
+                pieces.append(part)
+            elif part not in self.entry:
+                pieces.append("<{}>".format(part))
+            elif (passes > 1) and (part in self.templates):
+                pieces.append(self._render(part, passes - 1, done))
+            else:
+                pieces.append(str(self.entry[part]))
+        done[memo_key] = "".join(pieces)
+        return done[memo_key]
+
+    def resolve(self):
+        '''
+        Get a copy of the entry with the placeholders replaced.
+        '''
+        result = dict(self.entry)
+        done = {}
+        for key in self.templates:
+            result[key] = self._render(key, self.PASSES, done)
+        return result
+
+
+def interpolate(entry):
+    '''
+    Replace "<field>" in each str value of entry with the value of the
+    field (See EntryTemplate).
+    '''
+    return EntryTemplate(entry).resolve()
+
+
+def subproject_name(entry):
+    '''
+    Get a name for the repository of a subproject that stays the same
+    when the version in the archive name changes, such as "luajit" for
+    "luajit-git-61464b0a5.tar.bz2" (unless entry has a "name").
+    '''
+    if entry.get('name'):
+        return entry['name']
+    raw = entry.get('_raw_archive') or entry.get('archive') or entry['sub']
+    stem = strip_archive_ext(os.path.basename(raw))
+    if "<" in stem:
+        stem = stem[:stem.index("<")].rstrip("-_.")
+        stem = _vcs_suffix_re.sub("", stem)
+    else:
+        stem = _version_suffix_re.sub("", stem)
+    return stem
+
+
+def load_subsnap_entries(conf_dir):
+    '''
+    Load every entry of every conf_dir/subsnaps/**.json file.
+
+    Each entry gets the following additional keys:
+    _conf_path -- the json file.
+    _conf_name -- the name of the json file without ".json", which is
+        also a directory that the archive or sub may be in (See
+        resolve_entry).
+    _rel_dir -- the directory of the json file relative to subsnaps
+        using "/" ("" if directly in subsnaps), which is where the
+        archive or sub must be in a version (at any depth).
+    _raw_archive -- the archive before interpolating "<field>"s.
+    '''
+    subsnaps_dir = os.path.join(conf_dir, "subsnaps")
+    entries = []
+    for parent, dirs, files in os.walk(subsnaps_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.lower().endswith(".json"):
+                continue
+            path = os.path.join(parent, name)
+            with open(path, 'r') as ins:
+                data = json.load(ins)
+            if not isinstance(data, list):
+                raise ValueError('"{}" must contain a list.'.format(path))
+            rel_dir = os.path.relpath(parent, subsnaps_dir)
+            if rel_dir == ".":
+                rel_dir = ""
+            rel_dir = rel_dir.replace(os.path.sep, "/")
+            for raw in data:
+                if (raw.get('archive') is None) and (raw.get('sub') is None):
+                    raise ValueError('An entry in "{}" has no "archive"'
+                                     ' (or "sub").'.format(path))
+                entry = interpolate(raw)
+                entry['_conf_path'] = path
+                entry['_conf_name'] = name[:-len(".json")]
+                entry['_rel_dir'] = rel_dir
+                entry['_raw_archive'] = raw.get('archive')
+                entries.append(entry)
+    return entries
+
+
+def is_ignored(entry):
+    '''
+    Check whether the entry's own archive (or sub) is in its
+    "ignore_subs", meaning no subproject should be generated.
+    '''
+    ignore_subs = entry.get('ignore_subs')
+    if ignore_subs is None:
+        return False
+    if isinstance(ignore_subs, str):
+        ignore_subs = [ignore_subs]
+    target = entry.get('archive') or entry.get('sub')
+    return target in ignore_subs
+
+
+class SnapshotIndex:
+    '''
+    List where each file and directory name occurs in a version (in one
+    walk), so every subsnaps entry can be found with one lookup instead
+    of a walk per entry.
+
+    Public Attributes:
+    files -- a dict where each key is a file name and each value is a
+        list of the relative directories (using "/", "" for the top)
+        that contain a file with that name (in walk order).
+    dirs -- the same for directories.
+    '''
+    def __init__(self, version_path):
+        self.version_path = version_path
+        self.files = {}
+        self.dirs = {}
+        for parent, dirs, files in os.walk(version_path):
+            dirs.sort()
+            if ".git" in dirs:
+                dirs.remove(".git")
+            rel_parent = os.path.relpath(parent, version_path)
+            rel_parent = rel_parent.replace(os.path.sep, "/")
+            if rel_parent == ".":
+                rel_parent = ""
+            for name in dirs:
+                self.dirs.setdefault(name, []).append(rel_parent)
+            for name in files:
+                self.files.setdefault(name, []).append(rel_parent)
+
+    def find(self, target, want_dir, rel_dir, names):
+        '''
+        Find target at "[.../]<rel_dir>/[<name>/]<target>" where name is
+        any of names.
+
+        Returns:
+        the full path, or None.
+        '''
+        found = self.dirs if want_dir else self.files
+        ends = ["/" + rel_dir + "/" + name for name in names if name]
+        for rel_parent in found.get(target, ()):
+            parents = "/" + rel_parent
+            if ((rel_dir == "") or parents.endswith("/" + rel_dir)
+                    or any(parents.endswith(end) for end in ends)):
+                if rel_parent == "":
+                    return os.path.join(self.version_path, target)
+                return os.path.join(self.version_path, *(
+                    rel_parent.split("/") + [target]
+                ))
+        return None
+
+
+def resolve_entry(entry, version_path, index=None):
+    '''
+    Find the archive (or sub directory) of an entry in a version, at
+    "<version_path>/[.../]<_rel_dir>/[<subproject>/]<archive>", where
+    subproject is the name of the entry's json file (See
+    load_subsnap_entries) or of its repository (See subproject_name).
+
+    Keyword arguments:
+    index -- The SnapshotIndex of version_path (Reuse one for every
+        entry, otherwise the version is walked for each).
+
+    Returns:
+    the path, or None if the version doesn't contain it.
+    '''
+    if index is None:
+        index = SnapshotIndex(version_path)
+    target = entry.get('archive') or entry.get('sub')
+    want_dir = entry.get('archive') is None
+    return index.find(target, want_dir, entry['_rel_dir'],
+                      [entry.get('_conf_name'), subproject_name(entry)])
+
+
+def send_member(stream, size, chunks):
+    '''
+    Send an archive member as a blob unless the stream already has it.
+    The blob id must be known before the data is sent, so members larger
+    than INLINE_BLOB_MAX are spooled to a temporary file while hashing.
+
+    Returns:
+    the blob id.
+    '''
+    sha = hashlib.sha1(b"blob %d\0" % size)
+    if size <= INLINE_BLOB_MAX:
+        data = b"".join(chunks)
+        sha.update(data)
+        sha = sha.hexdigest()
+        if not stream.has_blob(sha):
+            stream.blob(sha, size, [data])
+        return sha
+    with tempfile.TemporaryFile() as spool:
+        for chunk in chunks:
+            sha.update(chunk)
+            spool.write(chunk)
+        sha = sha.hexdigest()
+        if not stream.has_blob(sha):
+            spool.seek(0)
+            stream.blob(sha, size,
+                        iter(lambda: spool.read(BLOB_CHUNK_SIZE), b""))
+    return sha
+
+
+def read_subproject_tree(path, stream, cache, index_dir=None):
+    '''
+    Get the tree of a subproject root (archive or directory), sending
+    blobs that the stream doesn't have yet.
+
+    Sequential arguments:
+    cache -- A dict that keeps the trees of archives by content hash, so
+        an archive that is in many versions is only decompressed once.
+
+    Keyword arguments:
+    index_dir -- The archive index directory (See archiveindex), where
+        the content hash of each archive is kept so an unchanged archive
+        isn't read just to hash it (See stat_archive_id).
+
+    Returns:
+    a tuple (tree, newest_mtime) where tree[path] = (mode, sha).
+    '''
+    tree = {}
+    newest = None
+    if os.path.isdir(path):
+        for rel, file_path, mode, st in walk_files(path):
+            size = st.st_size
+            if mode == "120000":
+                size = len(os.readlink(file_path).encode("utf-8",
+                                                         "surrogateescape"))
+            if (newest is None) or (st.st_mtime > newest):
+                newest = st.st_mtime
+            sha = hash_file(file_path, mode, size)
+            if not stream.has_blob(sha):
+                stream.blob(sha, size, iter_blob_chunks(file_path, mode))
+            tree[rel] = (mode, sha)
+        return tree, newest
+    if index_dir is not None:
+        key = stat_archive_id(path, index_dir)
+    else:
+        key = archive_id(path)
+    if key in cache:
+        return cache[key]
+    archive_tree = ArchiveTree(path, index_dir=index_dir)
+    for rel, mode, size, mtime, chunks in archive_tree.walk():
+        if (newest is None) or (mtime > newest):
+            newest = mtime
+        tree[rel] = (mode, send_member(stream, size, chunks))
+    tree = strip_single_root(tree)
+    cache[key] = (tree, newest)
+    return tree, newest
+
+
+def subproject_message(entry, version):
+    target = entry.get('archive') or entry.get('sub')
+    lines = ["{} from {}".format(target, version['name']), ""]
+    for key in ['upstream_repo', 'upstream_version', 'upstream_commit',
+                'upstream_version_dt']:
+        if entry.get(key):
+            lines.append("{}: {}".format(key, entry[key]))
+    return "\n".join(lines).strip() + "\n"
+
+
+def export_subproject(job):
+    '''
+    Import one subproject's history into its own repository (This runs
+    in a worker process, so job must only contain picklable values).
+
+    Sequential arguments:
+    job -- A dict with the keys: name, repo_dir, branch, ident, entry,
+        index_dir (See read_subproject_tree), and versions (a list of
+        dicts with the keys luid, name, date and root, where root is the
+        resolved subproject path or None).
+
+    Returns:
+    a dict with the keys: name, commits, seconds.
+    '''
+    start = time.time()
+    repo_dir = job['repo_dir']
+    ensure_repo(repo_dir)
+    ref = "refs/heads/" + job['branch']
+    if ref_exists(repo_dir, ref):
+        raise ValueError('{} already exists in "{}". Choose a new branch.'
+                         ''.format(ref, repo_dir))
+    ident = job['ident']
+    if ident is None:
+        ident = git_ident(repo_dir)
+    entry = job['entry']
+    stream = FastImportStream(repo_dir)
+    cache = {}
+    tree = {}
+    parent = None
+    commits = 0
+    try:
+        for version in job['versions']:
+            root = version['root']
+            if root is None:
+                if parent is not None:
+                    echo0("* [{}] is not in {}"
+                          "".format(job['name'], version['name']))
+                continue
+            new_tree, newest = read_subproject_tree(
+                root, stream, cache, index_dir=job.get('index_dir'),
+            )
+            changes = []
+            for path, value in new_tree.items():
+                if tree.get(path) != value:
+                    changes.append(('M', value[0], value[1], path))
+            for path in tree:
+                if path not in new_tree:
+                    changes.append(('D', path))
+            tree = new_tree
+            if (parent is not None) and (len(changes) == 0):
+                echo1("* [{}] is unchanged in {}"
+                      "".format(job['name'], version['name']))
+                continue
+            tree_dt = None
+            if newest is not None:
+                tree_dt = datetime.fromtimestamp(newest, tz=timezone.utc)
+            when = tree_dt
+            if when is None:
+                when = action_datetime(version)
+            parent = stream.commit(ref, ident, when,
+                                   subproject_message(entry, version),
+                                   changes, parent=parent)
+            commits += 1
+    finally:
+        stream.close()
+    return {
+        'name': job['name'],
+        'commits': commits,
+        'seconds': time.time() - start,
+    }
+
+
+def plan_subprojects(project, conf_dir, out_dir, branch=DEFAULT_BRANCH,
+                     ident=None):
+    '''
+    Resolve every subsnaps entry against every committed version.
+
+    Returns:
+    a list of jobs for export_subproject (one per subproject that occurs
+    in at least one version).
+    '''
+    versions = [action for action in project._actions
+                if (action['verb'] in VERSION_VERBS)
+                and (action.get('commit') is True)]
+    index_dir = project.get_archive_index_dir()
+    jobs = []
+    used_names = set()
+    indexes = {}
+    # ^ Each version is walked once for all entries (See SnapshotIndex).
+    for entry in load_subsnap_entries(conf_dir):
+        if is_ignored(entry):
+            echo1("* ignoring {} (in ignore_subs)"
+                  "".format(entry.get('archive') or entry.get('sub')))
+            continue
+        name = subproject_name(entry)
+        unique_name = name
+        number = 1
+        while unique_name in used_names:
+            number += 1
+            unique_name = "{}-{}".format(name, number)
+        used_names.add(unique_name)
+        job_versions = []
+        found = 0
+        for action in versions:
+            index = indexes.get(action['path'])
+            if index is None:
+                index = SnapshotIndex(action['path'])
+                indexes[action['path']] = index
+            root = resolve_entry(entry, action['path'], index=index)
+            if root is not None:
+                found += 1
+            job_versions.append({
+                'luid': action['luid'],
+                'name': action.get('name') or
+                os.path.split(action['path'])[1],
+                'date': action.get('date'),
+                'root': root,
+            })
+        if found == 0:
+            echo0("* {} is not in any version".format(unique_name))
+            continue
+        jobs.append({
+            'name': unique_name,
+            'repo_dir': os.path.join(out_dir, unique_name),
+            'branch': branch,
+            'ident': ident,
+            'entry': entry,
+            'index_dir': index_dir,
+            'versions': job_versions,
+        })
+    return jobs
+
+
+def export_subprojects(project, conf_dir, out_dir, jobs=None,
+                       branch=DEFAULT_BRANCH, ident=None):
+    '''
+    Export every subproject to its own repository in out_dir, using one
+    worker process per subproject (up to jobs at once).
+
+    Sequential arguments:
+    conf_dir -- The configuration such as "conf.d/linux-minetest-kit".
+    out_dir -- Each subproject becomes a repository in a subdirectory of
+        this directory.
+
+    Keyword arguments:
+    jobs -- The maximum number of worker processes (None for the number
+        of CPUs).
+
+    Returns:
+    a list of results (See export_subproject).
+    '''
+    plan = plan_subprojects(project, conf_dir, out_dir, branch=branch,
+                            ident=ident)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    results = []
+    if len(plan) == 0:
+        return results
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(export_subproject, job) for job in plan]
+        for future in as_completed(futures):
+            result = future.result()
+            echo0("* exported {} ({} commit(s), {}s)"
+                  "".format(result['name'], result['commits'],
+                            round(result['seconds'], 1)))
+            results.append(result)
+    return results
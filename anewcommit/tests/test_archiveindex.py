@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import io
+import bz2
+import gzip
+import random
+import shutil
+import tarfile
+import tempfile
+import subprocess
+from unittest import mock
+
+from anewcommit import archiveindex
+from anewcommit import archivetree
+from anewcommit.archiveindex import (
+    build_index,
+)
+from anewcommit.archivetree import (
+    ArchiveTree,
+)
+
+
+def make_files(count=12, size=60000):
+    rand = random.Random(0)
+    files = {}
+    for number in range(count):
+        # hex text compresses a little, so this spans several bz2 blocks:
+        data = rand.getrandbits(size * 4).to_bytes(size // 2, 'big').hex()
+        files["pkg/file{:02}.txt".format(number)] = data.encode("utf-8")
+    return files
+
+
+def tar_bytes(files):
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode='w') as tf:
+        for number, (name, data) in enumerate(sorted(files.items())):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = 1600000000 + number
+            tf.addfile(info, io.BytesIO(data))
+    return out.getvalue()
+
+
+class TestArchiveIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.index_dir = os.path.join(self.tmp, "index")
+        self.files = make_files()
+        self.tar = tar_bytes(self.files)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as outs:
+            outs.write(data)
+        return path
+
+    def check(self, path, min_pieces):
+        index = build_index(path)
+        self.assertGreaterEqual(len(index['pieces']), min_pieces)
+        tree = ArchiveTree(path, index_dir=self.index_dir)
+        self.assertEqual(sorted(tree.members()), sorted(self.files))
+        self.assertEqual(tree.newest()[1], 1600000000 + len(self.files) - 1)
+        real_iter_piece = archiveindex.iter_piece
+        decoded = []
+
+        def counting_iter_piece(data, piece):
+            decoded.append(piece)
+            return real_iter_piece(data, piece)
+
+        last = sorted(self.files)[-1]
+        with mock.patch.object(archiveindex, 'iter_piece',
+                               counting_iter_piece):
+            self.assertEqual(tree.read(last), self.files[last])
+        if min_pieces > 1:
+            # Only the end of the archive was decompressed:
+            self.assertLess(len(decoded), len(index['pieces']))
+        for name, data in self.files.items():
+            self.assertEqual(tree.read(name), data)
+        # A new tree uses the sidecar instead of reading the archive (The
+        # id of an archive that has the same size and mtime is kept):
+        with mock.patch.object(archiveindex, 'build_index',
+                               side_effect=AssertionError("rebuilt")), \
+                mock.patch.object(archivetree, 'archive_id',
+                                  side_effect=AssertionError("hashed")):
+            tree = ArchiveTree(path, index_dir=self.index_dir)
+            self.assertEqual(sorted(tree.members()), sorted(self.files))
+
+    def test_tar(self):
+        self.check(self.write("a.tar", self.tar), 1)
+
+    def test_bz2(self):
+        self.check(self.write("a.tar.bz2", bz2.compress(self.tar, 1)), 3)
+
+    def test_gz(self):
+        half = len(self.tar) // 2
+        data = gzip.compress(self.tar[:half]) + gzip.compress(self.tar[half:])
+        self.check(self.write("a.tar.gz", data), 2)
+        self.check(self.write("b.tar.gz", gzip.compress(self.tar)), 1)
+
+    @unittest.skipIf(shutil.which("xz") is None, "xz is not installed")
+    def test_xz(self):
+        path = self.write("a.tar", self.tar)
+        subprocess.check_call(["xz", "-1", "--block-size=200000", path])
+        self.check(path + ".xz", 3)
+
+    def test_hard_link(self):
+        out = io.BytesIO()
+        with tarfile.open(fileobj=out, mode='w') as tf:
+            info = tarfile.TarInfo("./p/b")
+            info.size = 5
+            tf.addfile(info, io.BytesIO(b"data\n"))
+            info = tarfile.TarInfo("p/a")
+            info.type = tarfile.LNKTYPE
+            info.linkname = "p/b"
+            info.mtime = 1600000000
+            tf.addfile(info)
+        path = self.write("linked.tar.gz", gzip.compress(out.getvalue()))
+        tree = ArchiveTree(path, index_dir=self.index_dir)
+        self.assertEqual(sorted(tree.members()), ["p/a", "p/b"])
+        self.assertEqual(tree.members()["p/a"], ("100644", 5, 1600000000))
+        self.assertEqual(tree.read("p/a"), b"data\n")
+
+    def test_stat_archive_id(self):
+        path = self.write("a.tar", self.tar)
+        key = archivetree.archive_id(path)
+        self.assertEqual(archivetree.stat_archive_id(path, self.index_dir),
+                         key)
+        self.write("a.tar", self.tar + b"\0" * 512)
+        # ^ a different size, so it is hashed again
+        self.assertNotEqual(
+            archivetree.stat_archive_id(path, self.index_dir), key
+        )
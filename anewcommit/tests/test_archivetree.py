@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import io
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from datetime import datetime, timezone
+
+from anewcommit import (
+    ANCProject,
+    DATE_FMT,
+    extract,
+    extract_many,
+    newest_file_dt_in,
+)
+from anewcommit.archivetree import (
+    ArchiveTree,
+    is_archive,
+    tree_manifest,
+)
+from anewcommit.manifest import (
+    diff_manifests,
+    git_blob_id,
+)
+
+FILES = {
+    "proj/README": b"readme\n",
+    "proj/src/main.c": b"int main() { return 0; }\n",
+}
+MTIMES = {
+    "proj/README": 1600000000,
+    "proj/src/main.c": 1600086400,
+}
+
+
+def write_tar(path, mode):
+    with tarfile.open(path, mode) as tf:
+        for name, data in FILES.items():
+            info = tarfile.TarInfo("./" + name)
+            info.size = len(data)
+            info.mtime = MTIMES[name]
+            tf.addfile(info, io.BytesIO(data))
+
+
+def write_zip(path):
+    with zipfile.ZipFile(path, 'w') as zf:
+        for name, data in FILES.items():
+            zf.writestr(name, data)
+
+
+class TestArchiveTree(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.archives = []
+        for ext, mode in [(".tar.gz", 'w:gz'), (".tar.bz2", 'w:bz2'),
+                          (".tar.xz", 'w:xz')]:
+            path = os.path.join(self.tmp, "proj" + ext)
+            write_tar(path, mode)
+            self.archives.append(path)
+        path = os.path.join(self.tmp, "proj.zip")
+        write_zip(path)
+        self.archives.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_members(self):
+        for path in self.archives:
+            self.assertTrue(is_archive(path))
+            tree = ArchiveTree(path)
+            self.assertEqual(sorted(tree.members().keys()), sorted(FILES))
+            self.assertEqual(tree.single_root(), "proj")
+            self.assertEqual(tree.read("proj/src/main.c"),
+                             FILES["proj/src/main.c"])
+            self.assertRaises(KeyError, tree.read, "proj/missing")
+            manifest = tree.manifest()
+            self.assertEqual(manifest["proj/README"][3],
+                             git_blob_id(FILES["proj/README"]))
+
+    def test_newest(self):
+        tree = ArchiveTree(self.archives[0])
+        self.assertEqual(tree.newest(), ("proj/src/main.c", 1600086400))
+        self.assertEqual(tree.newest(too_new=1600086400),
+                         ("proj/README", 1600000000))
+        too_new_dt = datetime.fromtimestamp(1600086400, tz=timezone.utc)
+        path, dt = newest_file_dt_in(self.tmp, too_new_dt=too_new_dt,
+                                     archives=True)
+        self.assertEqual(dt.timestamp(), 1600000000)
+        self.assertTrue(path.endswith("/proj/README"))
+
+    def test_mark_dates(self):
+        versions = os.path.join(self.tmp, "versions")
+        os.makedirs(os.path.join(versions, "v1"))
+        shutil.copy(self.archives[1], os.path.join(versions, "v1"))
+        project = ANCProject()
+        project.add_versions_in(versions)
+        luid, newest_path, date_str = project.mark_dates()[0]
+        newest_dt = datetime.fromtimestamp(MTIMES["proj/src/main.c"],
+                                           tz=timezone.utc)
+        self.assertEqual(date_str, newest_dt.strftime(DATE_FMT))
+        self.assertEqual(newest_path, os.path.join(
+            versions, "v1", "proj.tar.bz2", "proj/src/main.c"
+        ))
+        # The member index is kept for the next scan:
+        ids_dir = os.path.join(versions, "_anewcommit_cache",
+                               "archive-index", "ids")
+        self.assertEqual(len(os.listdir(ids_dir)), 1)
+
+    def test_diff_manifests(self):
+        old = tree_manifest(self.archives[1])
+        extracted = os.path.join(self.tmp, "extracted")
+        for name, data in FILES.items():
+            path = os.path.join(extracted, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as outs:
+                outs.write(data)
+        with open(os.path.join(extracted, "proj", "README"), 'wb') as outs:
+            outs.write(b"changed\n")
+        with open(os.path.join(extracted, "proj", "NEWS"), 'wb') as outs:
+            outs.write(b"news\n")
+        os.remove(os.path.join(extracted, "proj", "src", "main.c"))
+        new = tree_manifest(extracted)
+        self.assertEqual(diff_manifests(old, new),
+                         (["proj/NEWS"], ["proj/src/main.c"],
+                          ["proj/README"]))
+
+    def test_extract(self):
+        out = os.path.join(self.tmp, "out")
+        cache = os.path.join(self.tmp, "cache")
+        self.assertEqual(extract(self.archives[1], out, cache_dir=cache),
+                         os.path.join(out, "proj"))
+        with open(os.path.join(out, "proj", "src", "main.c"), 'rb') as ins:
+            self.assertEqual(ins.read(), FILES["proj/src/main.c"])
+        self.assertEqual(
+            os.path.getmtime(os.path.join(out, "proj", "README")),
+            MTIMES["proj/README"],
+        )
+        as_is = os.path.join(self.tmp, "as_is")
+        self.assertEqual(extract(self.archives[1], as_is, auto_sub=False,
+                                 cache_dir=cache), as_is)
+        self.assertTrue(os.path.isfile(os.path.join(as_is, "proj",
+                                                    "README")))
+        self.assertRaises(FileExistsError, extract, self.archives[1], as_is,
+                          auto_sub=False, cache_dir=cache)
+        # A copy of the same archive is extracted once and hard-linked:
+        copy = os.path.join(self.tmp, "copy.tar.bz2")
+        shutil.copy(self.archives[1], copy)
+        flat = os.path.join(self.tmp, "flat.tar")
+        with tarfile.open(flat, 'w') as tf:
+            for name in ["a.txt", "b.txt"]:
+                info = tarfile.TarInfo(name)
+                tf.addfile(info, io.BytesIO(b""))
+        results = extract_many([
+            (copy, out, True, "renamed"),
+            (flat, out, True, None),
+            (self.archives[0], out, True, "other"),
+        ], jobs=2, cache_dir=cache)
+        self.assertEqual(results, [os.path.join(out, "renamed"),
+                                   os.path.join(out, "flat"),
+                                   os.path.join(out, "other")])
+        self.assertEqual(sorted(os.listdir(results[1])), ["a.txt", "b.txt"])
+        self.assertEqual(
+            os.stat(os.path.join(out, "proj", "README")).st_ino,
+            os.stat(os.path.join(out, "renamed", "README")).st_ino,
+        )
+        self.assertEqual(len(os.listdir(cache)), 3)
+        self.assertRaises(ValueError, extract, copy, out,
+                          auto_sub_name="renamed", cache_dir=cache)
+        # One file at the top isn't a root directory:
+        single = os.path.join(self.tmp, "single.tar")
+        with tarfile.open(single, 'w') as tf:
+            info = tarfile.TarInfo("only.txt")
+            tf.addfile(info, io.BytesIO(b""))
+        self.assertIsNone(ArchiveTree(single).single_root())
+        result = extract(single, out, cache_dir=cache)
+        self.assertEqual(result, os.path.join(out, "single"))
+        self.assertEqual(os.listdir(result), ["only.txt"])
+
+    def test_hard_link(self):
+        path = os.path.join(self.tmp, "linked.tar.gz")
+        with tarfile.open(path, 'w:gz') as tf:
+            info = tarfile.TarInfo("p/b")
+            info.size = 5
+            info.mode = 0o755
+            tf.addfile(info, io.BytesIO(b"data\n"))
+            for name, target in [("p/a", "p/b"), ("p/c", "p/a")]:
+                info = tarfile.TarInfo(name)
+                info.type = tarfile.LNKTYPE
+                info.linkname = target
+                tf.addfile(info)
+        members = ArchiveTree(path).members()
+        self.assertEqual(sorted(members), ["p/a", "p/b", "p/c"])
+        self.assertEqual(members["p/a"][:2], ("100755", 5))
+        tree = ArchiveTree(path)
+        self.assertEqual(tree.read("p/a"), b"data\n")
+        manifest = tree.manifest()
+        self.assertEqual(manifest["p/c"], manifest["p/b"])
+        self.assertEqual(tree.members(), members)
+        out = os.path.join(self.tmp, "out")
+        extract(path, out, cache_dir=os.path.join(self.tmp, "cache"))
+        for name in ["a", "b", "c"]:
+            with open(os.path.join(out, "p", name), 'rb') as ins:
+                self.assertEqual(ins.read(), b"data\n")
+
+    def test_extract_through_symlink(self):
+        path = os.path.join(self.tmp, "evil.tar")
+        with tarfile.open(path, 'w') as tf:
+            info = tarfile.TarInfo("link")
+            info.type = tarfile.SYMTYPE
+            info.linkname = self.tmp
+            tf.addfile(info)
+            info = tarfile.TarInfo("link/escaped.txt")
+            tf.addfile(info, io.BytesIO(b""))
+        self.assertRaises(ValueError, extract, path,
+                          os.path.join(self.tmp, "out"))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp,
+                                                     "escaped.txt")))
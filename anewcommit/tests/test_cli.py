@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import sys
+import os
+import io
+import json
+import shutil
+import tempfile
+from datetime import datetime, timezone
+from unittest import mock
+
+from anewcommit import (
+    ANCProject,
+)
+from anewcommit import cli
+
+
+class TestCLI(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.versions = os.path.join(self.tmp, "versions")
+        days = [3, 1, 2]
+        for number, day in enumerate(days):
+            sub = os.path.join(self.versions, "v{}".format(number))
+            os.makedirs(os.path.join(sub, "Primary Site"))
+            if number == 1:
+                shutil.rmtree(os.path.join(sub, "Primary Site"))
+            path = os.path.join(sub, "index.html")
+            with open(path, 'w') as outs:
+                outs.write("version {}\n".format(number))
+            mtime = 1600000000 + day * 86400
+            os.utime(path, (mtime, mtime))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_cli(self, *args):
+        out = io.StringIO()
+        with mock.patch.object(sys, 'stdout', out):
+            code = cli.main(list(args))
+        events = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(code, 0, msg=events)
+        self.assertEqual(events[-1]['event'], "done")
+        return events
+
+    def load(self):
+        project = ANCProject()
+        self.assertTrue(project.load(os.path.join(self.versions,
+                                                  "anewcommit.json"))[0])
+        return project
+
+    def test_batch(self):
+        events = self.run_cli("scan", self.versions)
+        self.assertEqual(events[-1]['versions'], 3)
+        events = self.run_cli("add-statement", "--where-applicable",
+                              self.versions, 'use "Primary Site" as www')
+        self.assertEqual(events[-1]['added'], 2)
+        project = self.load()
+        marked = [action['name'] for action in project._actions
+                  if action.get('statements')]
+        self.assertEqual(sorted(marked), ["v0", "v2"])
+
+        events = self.run_cli("--jobs", "1", "mark-dates", self.versions)
+        serial = [event for event in events if event['event'] == "result"]
+        self.assertEqual(len(serial), 3)
+        names = {action['luid']: action['name']
+                 for action in self.load()._actions}
+        dates = {names[event['luid']]: event['date'] for event in serial}
+        # Only "Primary Site" is searched where there is a "use" statement:
+        expected = datetime.fromtimestamp(1600000000 + 86400,
+                                          tz=timezone.utc)
+        self.assertEqual(dates, {
+            "v0": "(no date in range)",
+            "v1": expected.strftime("%Y-%m-%d"),
+            "v2": "(no date in range)",
+        })
+        events = self.run_cli("--jobs", "2", "mark-dates", self.versions)
+        parallel = [event for event in events if event['event'] == "result"]
+        self.assertEqual(parallel, serial)
+        progress = [event for event in events if event['event'] == "progress"]
+        self.assertEqual(sorted(event['done'] for event in progress),
+                         [1, 2, 3])
+        project = self.load()
+        for event in serial:
+            action = project.get_action(event['luid'])
+            self.assertEqual(action['date'], event['date'])
+            self.assertEqual(action['newest_path'], event['newest_path'])
+
+    @unittest.skipIf(shutil.which("rsync") is None, "rsync is not installed")
+    def test_build_cache(self):
+        self.run_cli("scan", self.versions)
+        self.run_cli("add-statement", "--where-applicable", self.versions,
+                     'use "Primary Site" as www')
+        luids = [action['luid'] for action in self.load()._actions]
+        events = self.run_cli("build-cache", self.versions)
+        progress = [event for event in events if event['event'] == "progress"]
+        self.assertEqual([event['luid'] for event in progress], luids[-1:])
+        self.assertTrue(os.path.isdir(progress[0]['path']))
+        events = self.run_cli("build-cache", "--luid", luids[0],
+                              "--luid", luids[1], self.versions)
+        self.assertEqual(events[-1]['versions'], 2)
+
+    def test_error(self):
+        out = io.StringIO()
+        with mock.patch.object(sys, 'stdout', out):
+            code = cli.main(["mark-dates", self.versions])
+        self.assertEqual(code, 1)
+        self.assertEqual(json.loads(out.getvalue())['event'], "error")
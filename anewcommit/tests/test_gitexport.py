@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import shutil
+import subprocess
+import tempfile
+
+from anewcommit import (
+    ANCProject,
+)
+from anewcommit.gitexport import (
+    JOURNAL_NAME,
+    commit_project,
+    git_blob_id,
+)
+
+
+def write_file(path, text):
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    with open(path, 'w') as outs:
+        outs.write(text)
+
+
+def git_out(repo_dir, *args):
+    return subprocess.check_output(
+        ["git"] + list(args),
+        cwd=repo_dir,
+    ).decode("utf-8")
+
+
+@unittest.skipIf(shutil.which("git") is None, "git is not installed")
+class TestGitExport(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        os.environ['GIT_COMMITTER_NAME'] = "Tester"
+        os.environ['GIT_COMMITTER_EMAIL'] = "tester@example.com"
+        self.versions = os.path.join(self.tmp, "versions")
+        write_file(os.path.join(self.versions, "1", "a.txt"), "a1\n")
+        write_file(os.path.join(self.versions, "1", "b.txt"), "b1\n")
+        write_file(os.path.join(self.versions, "2", "a.txt"), "a2\n")
+        write_file(os.path.join(self.versions, "3", "c", "c.txt"), "c3\n")
+        for name in ["1", "2", "3"]:
+            # Make each snapshot's dates distinct as in real snapshots:
+            mtime = 1600000000 + int(name) * 86400
+            for parent, dirs, files in os.walk(os.path.join(self.versions,
+                                                            name)):
+                for sub in files:
+                    os.utime(os.path.join(parent, sub), (mtime, mtime))
+        self.repo = os.path.join(self.tmp, "repo")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_project(self, modes):
+        project = ANCProject()
+        project.project_dir = self.versions
+        for name, mode in zip(["1", "2", "3"], modes):
+            project.add_version(os.path.join(self.versions, name),
+                                mode=mode, do_save=False)
+        return project
+
+    def test_git_blob_id(self):
+        # same as `printf 'a1\n' | git hash-object --stdin`
+        self.assertEqual(git_blob_id(b"a1\n"),
+                         "da0f8ed91a8f2f0f067b3bdf26265d5ca48cf82c")
+
+    @unittest.skipIf(shutil.which("rsync") is None, "rsync is not installed")
+    def test_commit_modes(self):
+        project = self.make_project(['delete_then_add', 'overlay',
+                                     'delete_then_add'])
+        self.assertEqual(commit_project(project, self.repo), 3)
+        log = git_out(self.repo, "log", "--format=%s", "main").split()
+        self.assertEqual(log, ["3", "2", "1"])
+        # overlay keeps b.txt from version 1:
+        files = git_out(self.repo, "ls-tree", "-r", "--name-only", "main~1")
+        self.assertEqual(files.split(), ["a.txt", "b.txt"])
+        self.assertEqual(git_out(self.repo, "show", "main~1:a.txt"), "a2\n")
+        # delete_then_add removes everything not in version 3:
+        files = git_out(self.repo, "ls-tree", "-r", "--name-only", "main")
+        self.assertEqual(files.split(), ["c/c.txt"])
+
+    def test_commit_manifests(self):
+        write_file(os.path.join(self.versions, "3", "www", "index.html"),
+                   "<html/>\n")
+        project = self.make_project(['delete_then_add', 'overlay',
+                                     'delete_then_add'])
+        project.append_statement_where(project._actions[2]['luid'],
+                                       'use www as site')
+        project.append_statement_where(project._actions[2]['luid'],
+                                       'use c as site/c')
+        self.assertEqual(commit_project(project, self.repo,
+                                        materialize=False), 3)
+        files = git_out(self.repo, "ls-tree", "-r", "--name-only", "main~1")
+        self.assertEqual(files.split(), ["a.txt", "b.txt"])
+        self.assertEqual(git_out(self.repo, "show", "main~1:a.txt"), "a2\n")
+        files = git_out(self.repo, "ls-tree", "-r", "--name-only", "main")
+        self.assertEqual(files.split(), ["site/c/c.txt", "site/index.html"])
+        self.assertFalse(os.path.isdir(os.path.join(
+            self.versions, "_anewcommit_cache", "commits"
+        )))
+        manifest = project._actions[0]['manifest']
+        self.assertEqual(manifest['a.txt'][3], git_blob_id(b"a1\n"))
+
+    def test_resume(self):
+        project = self.make_project(['delete_then_add', 'overlay',
+                                     'delete_then_add'])
+        self.assertEqual(commit_project(project, self.repo,
+                                        materialize=False), 3)
+        first = git_out(self.repo, "rev-parse", "main~2").strip()
+        # Nothing changed, so nothing is committed again:
+        self.assertEqual(commit_project(project, self.repo,
+                                        materialize=False), 0)
+        # Editing an action rewrites only it and the commits after it:
+        project._actions[1]['name'] = "two"
+        self.assertEqual(commit_project(project, self.repo,
+                                        materialize=False), 2)
+        log = git_out(self.repo, "log", "--format=%s", "main").split()
+        self.assertEqual(log, ["3", "two", "1"])
+        self.assertEqual(git_out(self.repo, "rev-parse", "main~2").strip(),
+                         first)
+        # Simulate an interruption after the first commit was recorded:
+        journal_path = os.path.join(self.versions, JOURNAL_NAME)
+        with open(journal_path, 'r') as ins:
+            lines = ins.readlines()
+        with open(journal_path, 'w') as outs:
+            outs.writelines(lines[:1])
+        self.assertEqual(commit_project(project, self.repo,
+                                        materialize=False), 2)
+        files = git_out(self.repo, "ls-tree", "-r", "--name-only", "main~1")
+        self.assertEqual(files.split(), ["a.txt", "b.txt"])
+        self.assertEqual(git_out(self.repo, "rev-parse", "main~2").strip(),
+                         first)
+
+    def test_commit_jobs(self):
+        # larger than POOL_INLINE_MAX even after compression:
+        big = os.urandom(3 * 1024 * 1024)
+        with open(os.path.join(self.versions, "2", "big.bin"), 'wb') as outs:
+            outs.write(big)
+        for materialize in [True, False]:
+            if materialize and (shutil.which("rsync") is None):
+                continue
+            repo = os.path.join(self.tmp, "repo{}".format(materialize))
+            project = self.make_project(['delete_then_add', 'overlay',
+                                         'delete_then_add'])
+            self.assertEqual(commit_project(project, repo,
+                                            materialize=materialize,
+                                            jobs=2), 3)
+            files = git_out(repo, "ls-tree", "-r", "--name-only", "main~1")
+            self.assertEqual(files.split(), ["a.txt", "b.txt", "big.bin"])
+            self.assertEqual(git_out(repo, "show", "main~1:a.txt"), "a2\n")
+            data = subprocess.check_output(["git", "show", "main~1:big.bin"],
+                                           cwd=repo)
+            self.assertEqual(data, big)
+            subprocess.check_call(["git", "fsck", "--strict", "--no-progress"],
+                                  cwd=repo)
+
+    def test_commit_pack(self):
+        lines = ["INSERT INTO t VALUES ({}, 'row {}');\n".format(i, i)
+                 for i in range(2000)]
+        dumps = {}
+        for name in ["1", "2", "3"]:
+            if name == "2":
+                lines[1000] = "INSERT INTO t VALUES (1000, 'edited');\n"
+            elif name == "3":
+                lines.append("INSERT INTO t VALUES (2000, 'new');\n")
+            dumps[name] = "".join(lines)
+            path = os.path.join(self.versions, name, "dump.sql")
+            write_file(path, dumps[name])
+            os.utime(path, (1600000000 + int(name), 1600000000 + int(name)))
+        project = self.make_project(['delete_then_add', 'overlay',
+                                     'delete_then_add'])
+        self.assertEqual(commit_project(project, self.repo,
+                                        materialize=False, pack=True), 3)
+        for rev, name in [("main~2", "1"), ("main~1", "2"), ("main", "3")]:
+            self.assertEqual(git_out(self.repo, "show", rev + ":dump.sql"),
+                             dumps[name])
+        self.assertEqual(git_out(self.repo, "show", "main~1:a.txt"), "a2\n")
+        subprocess.check_call(["git", "fsck", "--strict", "--no-progress"],
+                              cwd=self.repo)
+        pack_dir = os.path.join(self.repo, ".git", "objects", "pack")
+        idx = [sub for sub in os.listdir(pack_dir) if sub.endswith(".idx")]
+        self.assertEqual(len(idx), 1)
+        out = git_out(self.repo, "verify-pack", "-v",
+                      os.path.join(pack_dir, idx[0]))
+        self.assertIn("chain length = 2: 1 object", out)
+        self.assertRaises(ValueError, commit_project, project, self.repo,
+                          pack=True)
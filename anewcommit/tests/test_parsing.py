@@ -9,6 +9,7 @@ Created on Wed Jul  6 17:35:01 2022
 import unittest
 import sys
 import os
+from unittest import mock
 
 import anewcommit
 from anewcommit import (
@@ -60,6 +61,29 @@ class TestParsing(unittest.TestCase):
         else:
             echo0("parse_statement succeeded in blocking foo.")
 
+    def test_parse_statement_cache(self):
+        statement = 'use "Cached Site" as main'
+        with mock.patch.object(anewcommit, 'split_statement',
+                               wraps=split_statement) as split:
+            first = parse_statement(statement)
+            first['destination'] = "changed"  # It is the caller's copy.
+            self.assertEqual(parse_statement(statement)['destination'],
+                             "main")
+            self.assertEqual(split.call_count, 1)
+            self.assertRaises(ValueError, parse_statement, 'foo main')
+            self.assertRaises(ValueError, parse_statement, 'foo main')
+            self.assertEqual(split.call_count, 3)  # Errors aren't cached.
+            # Only the least recently used statement is forgotten:
+            with mock.patch.object(anewcommit, 'PARSED_STATEMENTS_MAX', 2):
+                parse_statement('use "Other Site" as other')
+                parse_statement(statement)
+                parse_statement('use "Third Site" as third')
+                count = split.call_count
+                parse_statement(statement)
+                self.assertEqual(split.call_count, count)
+                parse_statement('use "Other Site" as other')
+                self.assertEqual(split.call_count, count + 1)
+
     def test_split_root(self):
         self.assertEqual(split_root("abc/def/ghi"), ["abc", "def/ghi"])
         self.assertEqual(split_root("/abc/def/ghi"), ["/abc", "def/ghi"])
@@ -3,6 +3,11 @@
 import unittest
 import sys
 import os
+import shutil
+import tempfile
+import threading
+import asyncio
+from unittest import mock
 
 import anewcommit
 from anewcommit import (
@@ -11,10 +16,12 @@ from anewcommit import (
     ANCProject,
     DEFAULT_VERSION_VERB,
 )
+from anewcommit.projectjournal import index_mapper
 
 myDir = os.path.dirname(os.path.abspath(__file__))
 test_data = os.path.join(myDir, "data")
 
+
 class TestProject(unittest.TestCase):
     def testRanges(self):
         project = ANCProject()
@@ -61,4 +68,577 @@ class TestProject(unittest.TestCase):
         self.assertEqual(ranges[2], [2, 3, 4])
         self.assertEqual(ranges[3], [5])
         self.assertEqual(ranges[4], [6])
+        self.assertEqual(project.get_affected(3), (3, [2, 3, 4]))
+        self.assertEqual(project.get_affected(2), (3, [2, 3, 4]))
+        self.assertEqual(project.get_affected(4), (3, [2, 3, 4]))
+        self.assertEqual(project.get_affected(6), (6, [6]))
+        # The ranges are cached until something changes them:
+        self.assertIs(project.get_ranges()[0], ranges[0])
+        project.auto_save = False
+        project.insert(1, {'luid': "8", 'verb': "post_process"})
+        self.assertEqual(project.get_affected(1), (0, [0, 1]))
+        self.assertEqual(project.get_affected(3), (4, [3, 4, 5]))
+        project.set_field("8", 'verb', "pre_process")
+        self.assertEqual(project.get_affected(1), (2, [1, 2]))
+        project.set_field("6", 'path', "6")
+        self.assertEqual(project.find_path("6"), [6])
+        project.check_indices()
+
+    def test_luid_index(self):
+        project = ANCProject()
+        project.auto_save = False
+        for number in range(6):
+            project.add_version(os.path.join("versions", str(number % 3)),
+                                do_save=False)
+        luids = [action['luid'] for action in project._actions]
+        project.check_indices()
+        self.assertEqual(project._find_where('luid', luids[4]), 4)
+        self.assertEqual(project.find_path(os.path.join("versions", "1")),
+                         [1, 4])
+        action = project._actions[2]
+        project.remove(0)
+        project.check_indices()
+        self.assertEqual(project._find_where('luid', luids[0]), -1)
+        self.assertEqual(project._find_where('luid', luids[4]), 3)
+        project.insert(1, {'luid': "x", 'verb': "pre_process"})
+        project.swap(0, 4)
+        project.check_indices()
+        self.assertEqual(project._find_where('luid', "x"), 1)
+        self.assertEqual(project._find_where('luid', luids[1]), 4)
+        self.assertIs(project.get_action(luids[2]), action)
+        self.assertEqual(project.find_path(os.path.join("versions", "1")),
+                         [0, 4])
+        project.undo()
+        project.undo()
+        project.check_indices()
+        self.assertEqual(project._find_where('luid', "x"), -1)
+        # Replacing the list directly is detected on the next lookup:
+        project._actions = list(reversed(project._actions))
+        self.assertEqual(project._find_where('luid', luids[5]), 0)
+        project.check_indices()
+        project.clear()
+        self.assertEqual(project._find_where('luid', luids[5]), -1)
+        project.check_indices()
+
+    def test_coalesced_save(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            project = ANCProject()
+            project.project_dir = tmp
+            with mock.patch.object(project, 'save',
+                                   wraps=project.save) as save:
+                with project.batch():
+                    for number in range(1000):
+                        project.add_version(str(number))
+                    self.assertTrue(project.is_dirty())
+                self.assertEqual(save.call_count, 1)
+            self.assertFalse(project.is_dirty())
+            loaded = ANCProject()
+            self.assertTrue(loaded.load(project.path)[0])
+            self.assertEqual(len(loaded._actions), 1000)
+
+            scheduled = []
+            project.save_scheduler = (
+                lambda seconds, callback: scheduled.append(callback)
+            )
+            with mock.patch.object(project, 'save',
+                                   wraps=project.save) as save:
+                project.remove(0)
+                project.remove(0)
+                project.append_statement_where(project._actions[0]['luid'],
+                                               "use as www")
+                self.assertEqual(len(scheduled), 1)
+                self.assertEqual(save.call_count, 0)
+                scheduled.pop()()
+                self.assertEqual(save.call_count, 1)
+                self.assertFalse(project.flush())
+                self.assertEqual(save.call_count, 1)
+            loaded = ANCProject()
+            loaded.load(project.path)
+            self.assertEqual(len(loaded._actions), 998)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_journal(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            project = ANCProject()
+            project.project_dir = tmp
+            project.journaled = True
+            for number in range(4):
+                project.add_version(str(number))
+            path = project.path
+            journal = os.path.join(tmp, "anewcommit-journal.jsonl")
+            with open(path, 'r') as ins:
+                snapshot = ins.read()
+            self.assertTrue(os.path.isfile(journal))
+            luids = [action['luid'] for action in project._actions]
+            project.swap(0, 3)
+            project.remove(1)
+            project.append_statement_where(luids[2], "use as www")
+            project.set_field(luids[0], 'name', "first")
+            # Changes are appended, so the snapshot isn't rewritten:
+            with open(path, 'r') as ins:
+                self.assertEqual(ins.read(), snapshot)
+            with open(journal, 'a') as outs:
+                outs.write('["remove", ')  # as if the program crashed
+            loaded = ANCProject()
+            self.assertTrue(loaded.load(path)[0])
+            self.assertEqual(loaded._actions, project._actions)
+            # Compaction writes a snapshot and discards the journal:
+            project.journal_max = project._get_journal().count + 1
+            project.set_field(luids[0], 'name', "1")
+            self.assertTrue(os.path.isfile(journal))
+            with open(journal, 'r') as ins:
+                stale = ins.read()
+            project.set_field(luids[0], 'name', "one")
+            self.assertFalse(os.path.isfile(journal))
+            # A journal older than the snapshot isn't replayed again:
+            with open(journal, 'w') as outs:
+                outs.write(stale)
+            loaded = ANCProject()
+            loaded.load(path)
+            self.assertEqual(loaded._actions, project._actions)
+            self.assertEqual(loaded._actions[2]['name'], "one")
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_side_data(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            project = ANCProject()
+            project.project_dir = tmp
+            with project.batch():
+                for number in range(3):
+                    project.add_version(str(number))
+                luid = project._actions[1]['luid']
+                manifest = {"a.txt": [33188, 2, 0, "0" * 40]}
+                project.set_field(luid, 'manifest', manifest)
+            with open(project.path, 'r') as ins:
+                self.assertNotIn('manifest', ins.read())
+            side_path = os.path.join(tmp, "anewcommit-data",
+                                     "{}.json".format(luid))
+            self.assertTrue(os.path.isfile(side_path))
+            self.assertIs(project.get_field(luid, 'manifest'), manifest)
+
+            loaded = ANCProject()
+            loaded.load(project.path)
+            action = loaded._actions[1]
+            self.assertNotIn('manifest', action)
+            self.assertEqual(loaded.get_field(action['luid'], 'manifest'),
+                             manifest)
+            # A side file is only rewritten after the value is replaced:
+            os.remove(side_path)
+            loaded.save()
+            self.assertFalse(os.path.isfile(side_path))
+            changed = {"b.txt": [33188, 2, 0, "1" * 40]}
+            loaded.set_field(action['luid'], 'manifest', changed)
+            loaded.save()
+            loaded2 = ANCProject()
+            loaded2.load(project.path)
+            self.assertEqual(
+                loaded2.get_field(loaded2._actions[1]['luid'], 'manifest'),
+                changed,
+            )
+            # The side file of a removed action is kept while undo can
+            # insert it again:
+            loaded2.remove(1)
+            loaded2.save()
+            self.assertTrue(os.path.isfile(side_path))
+            loaded2.clear_undo()
+            loaded2.save()
+            self.assertFalse(os.path.isfile(side_path))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_undo_store(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            project = ANCProject()
+            project.project_dir = tmp
+            project.journaled = True
+            project.persist_undo = True
+            for number in range(3):
+                project.add_version(str(number))
+            luid = project._actions[0]['luid']
+            for name in ["a", "ab", "abc"]:
+                project.set_field(luid, 'name', name, coalesce=True)
+            self.assertEqual(len(project._undo_steps), 4)
+            # Typing into one field is one step:
+            project.undo()
+            self.assertEqual(project._actions[0]['name'], "0")
+            project.undo(redo=True)
+            self.assertEqual(project._actions[0]['name'], "abc")
+            # Other changes to a field are separate steps:
+            project.set_field(luid, 'commit', False)
+            project.set_field(luid, 'commit', True)
+            project.undo()
+            self.assertIs(project._actions[0]['commit'], False)
+            project.undo()
+            self.assertIs(project._actions[0]['commit'], True)
+            project.undo(redo=True)
+            project.undo(redo=True)
+            project.undo()
+            project.undo()
+            project.undo()
+            project.flush()
+
+            # Undo works after a restart:
+            loaded = ANCProject()
+            loaded.persist_undo = True
+            loaded.load(project.path)
+            self.assertEqual(loaded._undo_step_i, project._undo_step_i)
+            self.assertTrue(loaded.has_redo())
+            loaded.undo(redo=True)
+            self.assertEqual(loaded._actions[0]['name'], "abc")
+            loaded.undo()
+            loaded.undo()
+            self.assertEqual(len(loaded._actions), 2)
+            # Steps for another version of the project are discarded:
+            other = ANCProject()  # doesn't keep the undo file current
+            other.load(project.path)
+            other.save()
+            loaded = ANCProject()
+            loaded.persist_undo = True
+            loaded.load(project.path)
+            self.assertFalse(loaded.has_undo())
+
+            # The oldest steps are forgotten when over the budget:
+            project.undo_max_bytes = 100
+            for number in range(20):
+                project.add_version(str(number + 10))
+            self.assertLessEqual(project._undo_steps.total, 100)
+            self.assertLess(len(project._undo_steps), 20)
+            undoable = project._undo_step_i + 1
+            count = len(project._actions)
+            while project.has_undo():
+                project.undo()
+            self.assertEqual(len(project._actions), count - undoable)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_bulk(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            project = ANCProject()
+            project.project_dir = tmp
+            project.journaled = True
+            changes = []
+            project.add_listener(changes.append)
+            project.add_version("0")
+            with mock.patch.object(project, 'save',
+                                   wraps=project.save) as save:
+                project.insert_many(0, [anewcommit.new_version(str(n))
+                                        for n in range(1, 6)])
+                self.assertEqual(save.call_count, 0)  # It was journaled.
+            paths = [action['path'] for action in project._actions]
+            self.assertEqual(paths, ["1", "2", "3", "4", "5", "0"])
+            self.assertEqual(changes, [0])
+            project.remove_many([4, 1, 2])
+            project.move_range(0, 2, 1)
+            paths = [action['path'] for action in project._actions]
+            self.assertEqual(paths, ["0", "1", "4"])
+            luids = [action['luid'] for action in project._actions]
+            self.assertEqual(project.append_statement_many(luids[:2],
+                                                           "use as www"),
+                             luids[:2])
+            self.assertEqual(project.append_statement_many(luids,
+                                                           "use as www"),
+                             luids[2:])
+            self.assertEqual(changes, [0, 1, 0, 0, 2])
+            project.check_indices()
+            loaded = ANCProject()
+            loaded.load(project.path)
+            self.assertEqual(loaded._actions, project._actions)
+            # Each bulk change is one undo step:
+            project.undo()
+            project.undo()
+            self.assertIsNone(project._actions[0].get('statements'))
+            project.undo()
+            project.undo()
+            paths = [action['path'] for action in project._actions]
+            self.assertEqual(paths, ["1", "2", "3", "4", "5", "0"])
+            project.undo()
+            self.assertEqual(len(project._actions), 1)
+            project.check_indices()
+            self.assertEqual(len(changes), 5)  # Undo doesn't notify.
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_index_mapper(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            project = ANCProject()
+            project.project_dir = tmp
+            calls = []
+            project.add_listener(
+                lambda min_index, entries: calls.append(entries),
+                with_entries=True,
+            )
+            project.insert_many(0, [anewcommit.new_version(str(n))
+                                    for n in range(8)])
+
+            def check(entries, before):
+                # Each action that was kept must be where the entries say:
+                mappers = [index_mapper(entry) for entry in entries]
+                after = [action['luid'] for action in project._actions]
+                for index, luid in enumerate(before):
+                    for mapper in mappers:
+                        if index is not None:
+                            index = mapper(index)
+                    if index is not None:
+                        self.assertEqual(after[index], luid)
+                    else:
+                        self.assertNotIn(luid, after)
+
+            def luids():
+                return [action['luid'] for action in project._actions]
+
+            before = luids()
+            project.insert_many(2, [anewcommit.new_version("a"),
+                                    anewcommit.new_version("b")])
+            project.insert_many(0, [anewcommit.new_version("c")])
+            check(calls[-2] + calls[-1], before)
+            before = luids()
+            project.remove_many([9, 0, 4])
+            check(calls[-1], before)
+            before = luids()
+            project.move_range(1, 4, 5)
+            check(calls[-1], before)
+            before = luids()
+            project.reorder([3, 0, 1, 2, 7, 6, 5, 4])
+            check(calls[-1], before)
+            project.swap(0, 5)
+            project.remove(2)
+            project.append_statement_many(luids()[:2], "use as www")
+            self.assertEqual([entry[0] for entry in calls[-1]], ["set", "set"])
+            for count in range(4):
+                before = luids()
+                results, err = project.undo()
+                self.assertIsNone(err)
+                check(results['entries'], before)
+            before = luids()
+            results, err = project.undo(redo=True)
+            check(results['entries'], before)
+            self.assertEqual(len(calls), 7)  # Undo doesn't notify.
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_statement_cache(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            project = ANCProject()
+            project.project_dir = tmp
+            action = project.add_version("1")
+            luid = action['luid']
+            project.append_statement_where(luid, "use as www")
+            commands = project.get_commands(luid)
+            self.assertEqual(commands[0][1]['destination'], "www")
+            self.assertIs(project.get_commands(luid), commands)
+            project.append_statement_where(luid, "use sub as sub")
+            commands = project.get_commands(luid)
+            self.assertEqual(len(commands), 2)
+            self.assertIs(project.get_commands(luid), commands)
+            action['statements'].append("bad statement")
+            project.save()
+            self.assertIsNotNone(project.get_commands(luid)[2][2])
+            loaded = ANCProject()
+            self.assertTrue(loaded.load(project.path)[0])
+            self.assertEqual(len(loaded.statement_errors), 1)
+            self.assertIn("bad", loaded.statement_errors[0])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_destination_index(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            project = ANCProject()
+            project.project_dir = tmp
+            project.auto_save = False
+            luids = [project.add_version(str(number), do_save=False)['luid']
+                     for number in range(1, 5)]
+            project.append_statement_where(luids[0], "use as www")
+            project.append_statement_where(luids[1], "use src as www/about")
+            project.append_statement_where(luids[3], "use as ./www/")
+            self.assertEqual(project.find_destination("www", before=3), 0)
+            self.assertEqual(project.find_destination("www", before=0), -1)
+            self.assertEqual(
+                project.find_destination("www/about", before=3, root=True),
+                1
+            )
+            self.assertEqual(project.destination_indices("www", root=True),
+                             [0, 1, 3])
+            self.assertEqual(project.destination_indices("www", before=3),
+                             [0])
+            project.set_field(luids[2], 'statements', ["use as www"])
+            self.assertEqual(project.destination_indices("www"), [0, 2, 3])
+            project.check_indices()
+            project.remove(0)
+            self.assertEqual(project.destination_indices("www", root=True),
+                             [0, 1, 2])
+            project.undo()
+            self.assertEqual(project.destination_indices("www"), [0, 2, 3])
+            project.remove_statement_where(luids[3], "use as ./www/")
+            self.assertEqual(project.find_destination("www"), 2)
+            project.check_indices()
+            action = project.get_action(luids[1])
+            self.assertEqual(project.version_pairs(luids[1]),
+                             anewcommit.version_pairs(action))
+            self.assertEqual(project.version_pairs(luids[1])[0][1],
+                             os.path.join("www", "about"))
+            index = project._get_dest_index()
+            used = anewcommit.new_version("5")
+            used['statements'] = ["use as www"]
+            project.swap(0, 3)
+            project.move_range(0, 2, 2)
+            project.reorder([3, 1, 0, 2])
+            project.insert_many(1, [used, anewcommit.new_version("6")])
+            project.remove_many([0, 3])
+            project.insert(0, anewcommit.new_version("7"))
+            project.undo()
+            self.assertIs(project._get_dest_index(), index)
+            # ^ shifted in place, not rebuilt
+            project.check_indices()
+            self.assertEqual(
+                project.destination_indices("www"),
+                [i for i in range(len(project._actions))
+                 if "use as www" in
+                 (project._actions[i].get('statements') or ())]
+            )
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_luid_allocator(self):
+        def build(results, key):
+            project = ANCProject()
+            project.auto_save = False
+            for number in range(200):
+                project.add_version(str(number), do_save=False)
+            project.insert_many(0, [anewcommit.new_version("a"),
+                                    anewcommit.new_version("b")])
+            results[key] = [action['luid'] for action in project._actions]
+
+        results = {}
+        threads = [threading.Thread(target=build, args=(results, key))
+                   for key in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        expected = ["200", "201"] + [str(number) for number in range(200)]
+        for key in range(4):
+            self.assertEqual(results[key], expected)
+
+        project = ANCProject()
+        project.auto_save = False
+        action = project.add_version("1", do_save=False)
+        project.add_version("2", do_save=False)
+        # An action with a luid that is already in the project gets a new one:
+        project.insert(0, anewcommit.new_version("3", luid=action['luid']))
+        self.assertEqual([action['luid'] for action in project._actions],
+                         ["2", "0", "1"])
+
+    @unittest.skipIf(shutil.which("rsync") is None, "rsync is not installed")
+    def test_async(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            for number in range(3):
+                sub = os.path.join(tmp, "v{}".format(number), "www")
+                os.makedirs(sub)
+                with open(os.path.join(sub, "{}.txt".format(number)),
+                          'w') as outs:
+                    outs.write("{}\n".format(number))
+            project = ANCProject()
+            project.add_versions_in(tmp)
+            project.async_jobs = 2
+            luids = project.version_luids()
+            project.append_statement_many(luids, "use www as www")
+            # Walk the files before the cache is in the project directory:
+            dates = asyncio.run(project.scan_all())
+            project.clear_undo()
+            self.assertEqual(dates, project.mark_dates())
+
+            last = project.find_path(os.path.join(tmp, "v2"))[0]
+            luid = project._actions[last]['luid']
+            sync_dir = project.generate_cache(luid, progress=lambda *a: None)
+            expected = sorted(os.listdir(os.path.join(sync_dir, "www")))
+            shutil.rmtree(sync_dir)
+            async_dir = asyncio.run(project.build_cache(luid))
+            self.assertEqual(async_dir, sync_dir)
+            self.assertEqual(sorted(os.listdir(os.path.join(async_dir,
+                                                            "www"))),
+                             expected)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_run_process_cancel(self):
+        started = []
+        real_exec = asyncio.create_subprocess_exec
+
+        async def tracking_exec(*args, **kwargs):
+            process = await real_exec(*args, **kwargs)
+            started.append(process)
+            return process
+
+        async def cancel_soon():
+            task = asyncio.ensure_future(anewcommit.run_process(
+                [sys.executable, "-c", "import time; time.sleep(60)"]
+            ))
+            while not started:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with mock.patch.object(asyncio, 'create_subprocess_exec',
+                               tracking_exec):
+            asyncio.run(cancel_soon())
+        self.assertIsNotNone(started[0].returncode)
+        # ^ The child was stopped before the cancellation finished.
+
+    def test_date_index(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            project = ANCProject()
+            project.project_dir = tmp
+            project.journaled = True
+            dates = ["2021-03-01", "2020-01-01", None, "2021-03-01",
+                     "2020-06-15"]
+            for number, date_str in enumerate(dates):
+                action = project.add_version(str(number))
+                if date_str is not None:
+                    project.set_field(action['luid'], 'date', date_str)
+            # A post_process stays with its version:
+            project.insert(2, anewcommit.new_post_process())
+            paths = [action.get('path') for action in project._actions]
+            self.assertEqual(paths, ["0", "1", None, "2", "3", "4"])
+            self.assertEqual(project.versions_between("2020-01-01",
+                                                      "2021-01-01"),
+                             [1, 5])
+            self.assertEqual(project.versions_between(start="2021-03-01"),
+                             [0, 4])
+            self.assertEqual(project.version_before("2021-03-01"), 5)
+            self.assertEqual(project.version_before("2020-01-01"), -1)
+            self.assertEqual(project.dates_out_of_order(),
+                             [(1, 0), (5, 0)])
+            project.set_field(project._actions[3]['luid'], 'date',
+                              "2019-12-31")
+            self.assertEqual(project.version_before("2020-01-01"), 3)
+            project.check_indices()
 
+            project.sort_versions_by_date()
+            paths = [action.get('path') for action in project._actions]
+            self.assertEqual(paths, ["2", "1", None, "4", "0", "3"])
+            self.assertEqual(project.dates_out_of_order(), [])
+            project.flush()
+            loaded = ANCProject()
+            loaded.load(project.path)
+            self.assertEqual(loaded._actions, project._actions)
+            project.undo()  # one step
+            paths = [action.get('path') for action in project._actions]
+            self.assertEqual(paths, ["0", "1", None, "2", "3", "4"])
+            project.undo(redo=True)
+            paths = [action.get('path') for action in project._actions]
+            self.assertEqual(paths, ["2", "1", None, "4", "0", "3"])
+        finally:
+            shutil.rmtree(tmp)
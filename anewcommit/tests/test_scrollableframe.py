@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+
+from anewcommit.scrollableframe import SFContainer
+
+
+class FakeCanvas:
+    '''
+    Stand in for the canvas so the row bookkeeping can be tested without
+    a display.
+    '''
+    def __init__(self, height):
+        self.height = height
+        self.y = 0
+        self.coords_of = {}
+
+    def canvasy(self, y):
+        return self.y + y
+
+    def winfo_width(self):
+        return 100
+
+    def winfo_height(self):
+        return self.height
+
+    def configure(self, **kwargs):
+        pass
+
+    def create_window(self, *args, **kwargs):
+        return len(self.coords_of)
+
+    def coords(self, window, x, y):
+        self.coords_of[window] = y
+
+    def itemconfigure(self, window, **kwargs):
+        pass
+
+
+class FakeRow:
+    def update_idletasks(self):
+        pass
+
+    def winfo_reqheight(self):
+        return 1
+
+
+class ListContainer(SFContainer):
+    def __init__(self, height):
+        # Skip the widgets (See FakeCanvas).
+        self.canvas = FakeCanvas(height)
+        self.row_height = 10
+        self.row_margin = 2
+        self._row_count = 0
+        self._shown = {}
+        self._free = {}
+        self._update_id = None
+        self._updating = False
+        self.made = 0
+
+    def make_row(self, kind, index):
+        self.made += 1
+        return FakeRow()
+
+    def bind_row(self, row, index):
+        row.index = index
+
+    def _header_height(self):
+        return 0
+
+
+class TestSFContainer(unittest.TestCase):
+    def test_visible_range(self):
+        container = ListContainer(50)
+        container._row_count = 100
+        self.assertEqual(container._visible_range(), (0, 8))
+        container.canvas.y = 200
+        self.assertEqual(container._visible_range(), (18, 28))
+        container._row_count = 20
+        self.assertEqual(container._visible_range(), (18, 20))
+
+    def test_move_rows(self):
+        container = ListContainer(50)
+        container.set_row_count(100)
+        self.assertEqual([index for index, row in container.shown_rows()],
+                         list(range(8)))
+        moved = container.row_at(3)
+        container.move_rows(lambda index: None if index == 0 else index - 1,
+                            count=99)
+        self.assertIs(container.row_at(2), moved)
+        self.assertEqual(moved.index, 3)
+        # ^ moved, not bound again
+        self.assertEqual(container.canvas.coords_of[moved.window], 20)
+        self.assertEqual(container.row_at(7).index, 7)
+        # ^ The row that came into view reused the removed one:
+        self.assertEqual(container.made, 8)
+        self.assertEqual(container._free, {None: []})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import io
+import json
+import shutil
+import tarfile
+import tempfile
+import subprocess
+
+from anewcommit import (
+    ANCProject,
+)
+from anewcommit.subprojects import (
+    SnapshotIndex,
+    export_subprojects,
+    interpolate,
+    load_subsnap_entries,
+    resolve_entry,
+    subproject_name,
+)
+
+
+def write_tar(path, files):
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    with tarfile.open(path, 'w:bz2') as tf:
+        for name, text in files.items():
+            data = text.encode("utf-8")
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = 1600000000
+            tf.addfile(info, io.BytesIO(data))
+
+
+def write_json(path, data):
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    with open(path, 'w') as outs:
+        json.dump(data, outs)
+
+
+class TestSubprojects(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        os.environ['GIT_COMMITTER_NAME'] = "Tester"
+        os.environ['GIT_COMMITTER_EMAIL'] = "tester@example.com"
+        self.conf = os.path.join(self.tmp, "conf")
+        write_json(os.path.join(self.conf, "subsnaps", "mtsrc", "lj.json"), [
+            {
+                "upstream_commit": "61464b0a5",
+                "archive": "luajit-git-<upstream_commit>.tar.bz2",
+            },
+            {
+                "archive": "solib64.tar.bz2",
+                "ignore_subs": "solib64.tar.bz2",
+            },
+        ])
+        self.versions = os.path.join(self.tmp, "versions")
+        for name in ["1", "2"]:
+            mtsrc = os.path.join(self.versions, name, "kit", "mtsrc")
+            write_tar(os.path.join(mtsrc, "luajit-git-61464b0a5.tar.bz2"),
+                      {"luajit/README": "luajit\n",
+                       "luajit/src/lj.c": "int v = {};\n".format(name)})
+            write_tar(os.path.join(mtsrc, "solib64.tar.bz2"),
+                      {"lib.so": "binary\n"})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_load_subsnap_entries(self):
+        entries = load_subsnap_entries(self.conf)
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0]['archive'],
+                         "luajit-git-61464b0a5.tar.bz2")
+        self.assertEqual(entries[0]['_rel_dir'], "mtsrc")
+        self.assertEqual(subproject_name(entries[0]), "luajit")
+
+    def test_interpolate(self):
+        entry = interpolate({
+            'upstream_commit': "61464b0a5",
+            'tarball': "luajit-git-<upstream_commit>",
+            'archive': "<tarball>.tar.bz2",
+            'patch': "<missing>.patch",
+            'count': 2,
+        })
+        self.assertEqual(entry['tarball'], "luajit-git-61464b0a5")
+        self.assertEqual(entry['archive'], "luajit-git-61464b0a5.tar.bz2")
+        self.assertEqual(entry['patch'], "<missing>.patch")
+        self.assertEqual(entry['count'], 2)
+
+    def test_resolve_entry(self):
+        entries = load_subsnap_entries(self.conf)
+        version = os.path.join(self.versions, "1")
+        os.makedirs(os.path.join(version, "other"))
+        write_tar(os.path.join(version, "other",
+                               "luajit-git-61464b0a5.tar.bz2"), {"a": "a"})
+        index = SnapshotIndex(version)
+        self.assertEqual(resolve_entry(entries[0], version, index=index),
+                         os.path.join(version, "kit", "mtsrc",
+                                      "luajit-git-61464b0a5.tar.bz2"))
+        self.assertEqual(resolve_entry(entries[0], version),
+                         resolve_entry(entries[0], version, index=index))
+        entry = dict(entries[0], archive="missing.tar.bz2")
+        self.assertIsNone(resolve_entry(entry, version, index=index))
+
+    def test_resolve_entry_in_conf_name(self):
+        write_json(os.path.join(self.conf, "subsnaps", "mtsrc",
+                                "leveldb.json"), [
+            {"archive": "irrlicht-snappy.tar.bz2"},
+        ])
+        version = os.path.join(self.versions, "1")
+        path = os.path.join(version, "kit", "mtsrc", "leveldb",
+                            "irrlicht-snappy.tar.bz2")
+        write_tar(path, {"a": "a"})
+        entries = [entry for entry in load_subsnap_entries(self.conf)
+                   if entry['_conf_name'] == "leveldb"]
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(resolve_entry(entries[0], version), path)
+        self.assertEqual(subproject_name(entries[0]), "irrlicht-snappy")
+        # ^ The repository is still named after the archive.
+
+    @unittest.skipIf(shutil.which("git") is None, "git is not installed")
+    def test_export_subprojects(self):
+        project = ANCProject()
+        project.project_dir = self.versions
+        for name in ["1", "2"]:
+            project.add_version(os.path.join(self.versions, name),
+                                do_save=False)
+        out_dir = os.path.join(self.tmp, "out")
+        results = export_subprojects(project, self.conf, out_dir, jobs=2)
+        self.assertEqual([r['name'] for r in results], ["luajit"])
+        self.assertEqual(results[0]['commits'], 2)
+        self.assertTrue(os.path.isdir(os.path.join(
+            self.versions, "_anewcommit_cache", "archive-index", "ids"
+        )))
+        self.assertFalse(os.path.isdir(os.path.join(out_dir, "solib64")))
+        repo = os.path.join(out_dir, "luajit")
+        files = subprocess.check_output(
+            ["git", "ls-tree", "-r", "--name-only", "main"],
+            cwd=repo,
+        ).decode("utf-8").split()
+        self.assertEqual(files, ["README", "src/lj.c"])
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+'''
+Keep undo steps within a size budget, optionally in a file next to the
+project file so undo survives a restart.
+
+Each step is kept encoded as JSON (which is much smaller than the
+lists and dictionaries it describes), and once a step is in the file,
+only its offset in the file is kept in memory.
+
+The file is a log of changes to the list of steps, one JSON list per
+line:
+["step", index, step] -- Insert a step.
+["set", index, step] -- Replace a step.
+["drop", start, stop] -- Delete steps start to stop (exclusive).
+["state", state, position] -- Mark the end of a consistent set of
+    changes, where state identifies the project file contents the steps
+    apply to, and position is the index of the next step to undo.
+Lines after the last "state" line are ignored. The file is rewritten
+from the current steps once it is more than twice as large as they are.
+'''
+from __future__ import print_function
+
+import os
+import json
+
+DEFAULT_UNDO_BYTES = 4 * 1024 * 1024
+UNDO_SUFFIX = "-undo.jsonl"
+
+
+def undo_path(project_path):
+    '''
+    Get the undo file path for a project file, such as
+    "anewcommit-undo.jsonl" for "anewcommit.json".
+    '''
+    return os.path.splitext(project_path)[0] + UNDO_SUFFIX
+
+
+class _Step:
+    def __init__(self, text, size):
+        self.text = text  # the JSON, or None if it is only in the file
+        self.offset = None  # the offset of its line in the file
+        self.size = size
+
+
+class UndoStore:
+    '''
+    A list of undo steps that only keeps the newest steps that fit in
+    max_bytes (counting the size of each step as JSON).
+
+    Public Properties:
+    max_bytes -- The budget. The newest step is kept even if it is
+        larger.
+    total -- The size of all steps as JSON.
+    path -- The file (See sync), or None to keep steps only in memory.
+    '''
+    def __init__(self, max_bytes=DEFAULT_UNDO_BYTES, path=None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.total = 0
+        self._steps = []
+        self._ops = []  # changes not yet in the file
+        self._file_size = 0
+
+    def __len__(self):
+        return len(self._steps)
+
+    def __iter__(self):
+        for index in range(len(self._steps)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        return json.loads(self._text(self._steps[index]))
+
+    def _text(self, step):
+        if step.text is not None:
+            return step.text
+        with open(self.path, 'rb') as ins:
+            ins.seek(step.offset)
+            line = ins.readline().decode("utf-8")
+        # Avoid decoding the whole line just to get the step back out:
+        return line[line.index(",", line.index(",") + 1) + 1:].rstrip()[:-1]
+
+    def _new_step(self, step):
+        text = json.dumps(step, sort_keys=True)
+        return _Step(text, len(text))
+
+    def __setitem__(self, index, step):
+        new_step = self._new_step(step)
+        self.total += new_step.size - self._steps[index].size
+        self._steps[index] = new_step
+        self._ops.append(("set", index, new_step))
+
+    def insert(self, index, step):
+        new_step = self._new_step(step)
+        self._steps.insert(index, new_step)
+        self.total += new_step.size
+        self._ops.append(("step", index, new_step))
+
+    def append(self, step):
+        self.insert(len(self._steps), step)
+
+    def drop(self, start, stop):
+        '''
+        Delete the steps from start to stop (exclusive).
+        '''
+        if stop <= start:
+            return
+        for step in self._steps[start:stop]:
+            self.total -= step.size
+        del self._steps[start:stop]
+        self._ops.append(("drop", start, stop))
+
+    def evict(self):
+        '''
+        Delete the oldest steps until the rest fit in max_bytes.
+
+        Returns:
+        the number of steps deleted.
+        '''
+        count = 0
+        size = self.total
+        while (size > self.max_bytes) and (count < len(self._steps) - 1):
+            size -= self._steps[count].size
+            count += 1
+        self.drop(0, count)
+        return count
+
+    def clear(self):
+        self.drop(0, len(self._steps))
+
+    def sync(self, state, position):
+        '''
+        Write the changes since the last sync to self.path (if not None)
+        followed by a "state" line, and make sure they are on disk.
+        '''
+        if self.path is None:
+            return False
+        if (self._file_size > 2 * self.total + 65536) or (
+                not os.path.isfile(self.path)):
+            return self._rewrite(state, position)
+        with open(self.path, 'r+b') as outs:
+            offset = self._file_size
+            outs.seek(offset)
+            # ^ Overwrite anything after the last sync (such as a partial
+            #   line if the program stopped during a write).
+            for op, index, value in self._ops:
+                if op == "drop":
+                    line = json.dumps([op, index, value])
+                else:
+                    line = '["{}", {}, {}]'.format(op, index, value.text)
+                    value.offset = offset
+                data = (line + "\n").encode("utf-8")
+                outs.write(data)
+                offset += len(data)
+            data = (json.dumps(["state", state, position]) + "\n")
+            outs.write(data.encode("utf-8"))
+            offset += len(data.encode("utf-8"))
+            outs.truncate()
+            outs.flush()
+            os.fsync(outs.fileno())
+        self._file_size = offset
+        self._forget_texts()
+        return True
+
+    def _forget_texts(self):
+        for op, index, value in self._ops:
+            if op != "drop":
+                value.text = None
+        self._ops = []
+
+    def _rewrite(self, state, position):
+        tmp_path = self.path + ".tmp"
+        offsets = []
+        with open(tmp_path, 'wb') as outs:
+            offset = 0
+            for index, step in enumerate(self._steps):
+                line = '["step", {}, {}]'.format(index, self._text(step))
+                data = (line + "\n").encode("utf-8")
+                outs.write(data)
+                offsets.append(offset)
+                offset += len(data)
+            data = (json.dumps(["state", state, position]) + "\n")
+            outs.write(data.encode("utf-8"))
+            offset += len(data.encode("utf-8"))
+            outs.flush()
+            os.fsync(outs.fileno())
+        os.replace(tmp_path, self.path)
+        for step, step_offset in zip(self._steps, offsets):
+            step.text = None
+            step.offset = step_offset
+        self._ops = []
+        self._file_size = offset
+        return True
+
+    def load(self, path):
+        '''
+        Use the steps in path (only their offsets are read into memory).
+
+        Returns:
+        a tuple (state, position) from the last complete sync, or
+        (None, -1) if there is none (in which case there are no steps).
+        '''
+        self.path = path
+        self._steps = []
+        self._ops = []
+        self.total = 0
+        self._file_size = 0
+        result = (None, -1)
+        if not os.path.isfile(path):
+            return result
+        end = 0  # the end of the last "state" line
+        offset = 0
+        with open(path, 'rb') as ins:
+            for data in ins:
+                offset += len(data)
+                if not data.startswith(b'["state"'):
+                    continue
+                try:
+                    entry = json.loads(data.decode("utf-8"))
+                except ValueError:
+                    break  # The last line may be partial after a crash.
+                result = (entry[1], entry[2])
+                end = offset
+        offset = 0
+        with open(path, 'rb') as ins:
+            while offset < end:
+                data = ins.readline()
+                if not data.startswith(b'["state"'):
+                    entry = json.loads(data.decode("utf-8"))
+                    if entry[0] == "drop":
+                        self.drop(entry[1], entry[2])
+                    else:
+                        step = _Step(None, len(data))
+                        # ^ about the same as the size of the step
+                        step.offset = offset
+                        if entry[0] == "set":
+                            self.total -= self._steps[entry[1]].size
+                            self._steps[entry[1]] = step
+                        else:
+                            self._steps.insert(entry[1], step)
+                        self.total += step.size
+                offset += len(data)
+        self._ops = []
+        self._file_size = end
+        return result
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+benchmark_pack
+--------------
+This script is part of <https://github.com/Poikilos/anewcommit>.
+
+Compare exporting a history with delta-compressed packs (pack=True)
+against plain fast-import followed by "git gc".
+
+Synthetic snapshots are generated where each version makes small edits
+to a large SQL dump and a bundled JavaScript file, which is the case
+the pack writer is for.
+
+Usage:
+benchmark_pack.py [<versions> [<dump_lines>]]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+
+from find_anewcommit import anewcommit
+
+from anewcommit import (
+    ANCProject,
+)
+from anewcommit.gitexport import (
+    commit_project,
+)
+
+
+def echo0(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+def make_versions(parent, count, dump_lines):
+    rand = random.Random(0)
+    rows = ["INSERT INTO posts VALUES ({}, '{}');\n"
+            "".format(i, rand.getrandbits(128)) for i in range(dump_lines)]
+    script = ["function f{}(){{return {};}}\n"
+              "".format(i, rand.getrandbits(64))
+              for i in range(dump_lines // 4)]
+    paths = []
+    for number in range(1, count + 1):
+        for _ in range(5):
+            rows[rand.randrange(len(rows))] = (
+                "INSERT INTO posts VALUES (0, '{}');\n"
+                "".format(rand.getrandbits(128))
+            )
+        rows.append("INSERT INTO posts VALUES ({}, 'new');\n"
+                    "".format(len(rows)))
+        script[rand.randrange(len(script))] = "// edited\n"
+        path = os.path.join(parent, "site-{}".format(number))
+        os.makedirs(os.path.join(path, "js"))
+        with open(os.path.join(path, "dump.sql"), 'w') as outs:
+            outs.writelines(rows)
+        with open(os.path.join(path, "js", "bundle.js"), 'w') as outs:
+            outs.writelines(script)
+        mtime = 1600000000 + number * 86400
+        for sub in ["dump.sql", os.path.join("js", "bundle.js")]:
+            os.utime(os.path.join(path, sub), (mtime, mtime))
+        paths.append(path)
+    return paths
+
+
+def dir_size(path):
+    total = 0
+    for parent, dirs, files in os.walk(path):
+        for sub in files:
+            total += os.path.getsize(os.path.join(parent, sub))
+    return total
+
+
+def export(versions_dir, paths, repo, pack):
+    project = ANCProject()
+    project.project_dir = versions_dir
+    for path in paths:
+        project.add_version(path, do_save=False)
+    start = time.time()
+    commit_project(project, repo, materialize=False, pack=pack,
+                   ident="Benchmark <benchmark@example.com>")
+    if not pack:
+        subprocess.check_call(["git", "gc", "-q"], cwd=repo)
+    seconds = time.time() - start
+    return seconds, dir_size(os.path.join(repo, ".git", "objects"))
+
+
+def main():
+    count = 20
+    dump_lines = 50000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        dump_lines = int(sys.argv[2])
+    tmp = tempfile.mkdtemp()
+    try:
+        versions_dir = os.path.join(tmp, "versions")
+        paths = make_versions(versions_dir, count, dump_lines)
+        echo0("{} versions, {} bytes".format(count, dir_size(versions_dir)))
+        results = []
+        for label, pack in [("fast-import + git gc", False),
+                            ("pack=True", True)]:
+            repo = os.path.join(tmp, "repo-{}".format(pack))
+            seconds, size = export(versions_dir, paths, repo, pack)
+            results.append((label, seconds, size))
+        for label, seconds, size in results:
+            print("{:<24} {:>8.2f} s {:>12} bytes".format(label, seconds,
+                                                          size))
+    finally:
+        shutil.rmtree(tmp)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -75,6 +75,7 @@ setuptools.setup(
         'console_scripts': [
             'duminus=anewcommit.duminus:main',
             'anewcommit=anewcommit.gui_tkinter:main',
+            'anewcommit-cli=anewcommit.cli:main',
         ],
     },
     install_requires=install_requires,